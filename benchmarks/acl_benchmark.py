@@ -0,0 +1,259 @@
+""" Micro-benchmarks of ACL evaluation.
+
+Measures the cost of parsing RAML ACLs, applying callable principals,
+generating ACLs of a collection page and objectifying ACLs stored in
+ES documents. Elasticsearch and database engine are replaced with local
+stand-ins, so benchmarks may be run without any services running.
+
+Usage:
+    python benchmarks/acl_benchmark.py --aces 20 --callables 5 \
+        --items 100 --principals 10
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+import timeit
+
+import six
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.security import Allow, Deny
+from nefertari.utils import dict2obj
+
+from ramses import registry
+from ramses.acl import (
+    BaseACL, DatabaseACLMixin, CachingACLAuthorizationPolicy,
+    parse_acl, batch_principal, compile_acl)
+
+
+PERMISSIONS = ('view', 'create', 'update', 'delete')
+
+
+class Request(object):
+    """ Request stand-in. Principals memo is stored on request. """
+    def __init__(self, principals):
+        self.effective_principals = principals
+
+
+class Item(object):
+    """ Database object stand-in. """
+    def __init__(self, id, owner):
+        self.id = id
+        self.owner = owner
+
+
+def owner_principal(ace, request, obj):
+    """ Callable principal which grants :ace: permissions to object
+    owner.
+    """
+    if obj is None:
+        return []
+    return [(Allow, 'user:{}'.format(obj.owner), ace[2])]
+
+
+@batch_principal
+def batch_owner_principal(ace, request, objs):
+    return [owner_principal(ace, request, obj) for obj in objs]
+
+
+def setup_engine():
+    """ Use ACL encoder of nefertari-guards in place of engine-specific
+    ACLField, which is only available once engine is configured.
+    """
+    from nefertari_guards import engine as guards_engine
+    from nefertari_guards.base import ACLEncoderMixin
+    if not hasattr(guards_engine, 'ACLField'):
+        guards_engine.ACLField = ACLEncoderMixin
+    return guards_engine
+
+
+def make_acl_string(aces, callables, callable_name):
+    """ Generate RAML ACL string of :aces: static ACEs followed by
+    :callables: ACEs with callable principals.
+    """
+    lines = []
+    for index in range(aces):
+        action = 'deny' if index % 5 == 4 else 'allow'
+        permissions = ','.join(PERMISSIONS[:index % len(PERMISSIONS) + 1])
+        lines.append('{} g:group{} {}'.format(action, index, permissions))
+    for index in range(callables):
+        lines.append('allow {{{{{}}}}} view,update'.format(callable_name))
+    return '\n'.join(lines)
+
+
+def make_principals(count):
+    return ['system.Everyone', 'system.Authenticated', 'user:user0'] + [
+        'g:group{}'.format(index * 2) for index in range(count)]
+
+
+def make_es_docs(items, acl_variants, guards_engine):
+    """ Generate ES documents stand-ins of :items: with stored ACLs.
+
+    Documents share :acl_variants: distinct ACLs, as documents do when
+    their ACLs are generated from the same RAML ACL.
+    """
+    docs = []
+    for index in range(items):
+        acl = [
+            (Allow, 'g:group{}'.format(index % acl_variants), 'view'),
+            (Allow, 'user:user{}'.format(index % acl_variants), 'update'),
+            (Deny, 'g:banned', 'view'),
+        ]
+        docs.append(dict2obj({
+            '_type': 'Item',
+            'id': index,
+            '_acl': guards_engine.ACLField.stringify_acl(acl),
+        }))
+    return docs
+
+
+def make_acl_class(acl, database_acls=False, docs=None):
+    """ Generate ACL class which uses :acl: both as collection and item
+    ACL.
+    """
+    docs = docs or []
+
+    class BenchmarkACLBase(object):
+        item_model = Item
+
+        def __init__(self, request, es_based=True):
+            super(BenchmarkACLBase, self).__init__(request=request)
+            self.es_based = es_based
+            self._collection_acl = acl
+            self._item_acl = acl
+
+        def get_es_item(self, key):
+            return docs[int(key)]
+
+    bases = [BenchmarkACLBase]
+    if database_acls:
+        bases.append(DatabaseACLMixin)
+    bases.append(BaseACL)
+    return type('BenchmarkACL', tuple(bases), {})
+
+
+def run(name, func, number, repeat, per=1):
+    """ Time :func: and print time of a single call in microseconds.
+
+    :param per: Number of operations performed by a single call of
+        :func:. Time of a single operation is printed.
+    """
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    best = min(timings) / number / per * 1e6
+    print('{:<40} {:>12.2f} us'.format(name, best))
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run ACL evaluation micro-benchmarks.')
+    parser.add_argument(
+        '--aces', type=int, default=10,
+        help='Number of static ACEs in ACL')
+    parser.add_argument(
+        '--callables', type=int, default=2,
+        help='Number of ACEs with callable principals in ACL')
+    parser.add_argument(
+        '--items', type=int, default=50,
+        help='Number of items per collection page')
+    parser.add_argument(
+        '--principals', type=int, default=5,
+        help='Number of principals of user')
+    parser.add_argument(
+        '--acl-variants', type=int, default=3,
+        help='Number of distinct ACLs stored in ES documents')
+    parser.add_argument(
+        '--number', type=int, default=100,
+        help='Number of calls per timing')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Number of timings; the best one is reported')
+    args = parser.parse_args(argv)
+
+    guards_engine = setup_engine()
+    registry.add('benchmark_owner', owner_principal)
+    registry.add('benchmark_batch_owner', batch_owner_principal)
+
+    acl_string = make_acl_string(
+        args.aces, args.callables, 'benchmark_owner')
+    batch_acl_string = make_acl_string(
+        args.aces, args.callables, 'benchmark_batch_owner')
+    acl = parse_acl(acl_string)
+    batch_acl = parse_acl(batch_acl_string)
+    principals = make_principals(args.principals)
+    items = [Item(id=index, owner='user{}'.format(index % 7))
+             for index in range(args.items)]
+    docs = make_es_docs(args.items, max(args.acl_variants, 1), guards_engine)
+
+    acl_cls = make_acl_class(acl)
+    batch_acl_cls = make_acl_class(batch_acl)
+    db_acl_cls = make_acl_class(acl, database_acls=True, docs=docs)
+
+    def new_acl(cls=acl_cls):
+        return cls(Request(principals))
+
+    warm_acl = new_acl()
+    warm_acl.generate_items_acl(items)
+
+    def generate_page(cls):
+        acl_obj = new_acl(cls)
+        return [acl_obj.generate_item_acl(item) for item in items]
+
+    def objectify_page(cold):
+        if cold:
+            DatabaseACLMixin._es_acls_cache.clear()
+        acl_obj = new_acl(db_acl_cls)
+        return [acl_obj.item_acl(doc) for doc in docs]
+
+    static_acl = parse_acl(make_acl_string(args.aces, 0, None))
+    static_acl_obj = make_acl_class(static_acl)(Request(principals))
+    static_acl_obj._compiled_collection_acl = compile_acl(static_acl)
+    policy = ACLAuthorizationPolicy()
+    caching_policy = CachingACLAuthorizationPolicy()
+
+    def permits(policy):
+        return [policy.permits(static_acl_obj, principals, perm)
+                for perm in PERMISSIONS]
+
+    def getitem_page():
+        acl_obj = new_acl(db_acl_cls)
+        return [acl_obj[six.text_type(index)] for index in range(len(docs))]
+
+    print('ACEs: {}, callable principals: {}, items per page: {}, '
+          'principals per user: {}'.format(
+              args.aces, args.callables, args.items, args.principals))
+    print('{:<40} {:>15}'.format('Benchmark', 'Time per op'))
+
+    number, repeat = args.number, args.repeat
+    run('parse_acl', lambda: parse_acl(acl_string), number, repeat)
+    run('_apply_callables (new request)',
+        lambda: new_acl()._apply_callables(acl, items[0]),
+        number, repeat)
+    run('_apply_callables (memoized)',
+        lambda: warm_acl._apply_callables(acl, items[0]),
+        number, repeat)
+    run('generate_item_acl per item',
+        lambda: generate_page(acl_cls), number, repeat, per=len(items))
+    run('generate_items_acl per item',
+        lambda: new_acl().generate_items_acl(items),
+        number, repeat, per=len(items))
+    run('generate_items_acl per item (batch)',
+        lambda: new_acl(batch_acl_cls).generate_items_acl(items),
+        number, repeat, per=len(items))
+    run('item_query_filter', lambda: new_acl().item_query_filter('view'),
+        number, repeat)
+    run('ACLAuthorizationPolicy.permits',
+        lambda: permits(policy), number, repeat, per=len(PERMISSIONS))
+    run('CachingACLAuthorizationPolicy.permits',
+        lambda: permits(caching_policy), number, repeat,
+        per=len(PERMISSIONS))
+    run('DatabaseACLMixin.item_acl (cold)',
+        lambda: objectify_page(cold=True), number, repeat, per=len(docs))
+    run('DatabaseACLMixin.item_acl (cached)',
+        lambda: objectify_page(cold=False), number, repeat, per=len(docs))
+    run('DatabaseACLMixin getitem',
+        getitem_page, number, repeat, per=len(docs))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -49,11 +49,20 @@ def includeme(config):
 
     if root_auth:
         from .auth import setup_auth_policies, get_authuser_model
+        from .passwords import setup_password_hasher
+        setup_password_hasher(config)
         if getattr(config.registry, 'auth_model', None) is None:
             config.registry.auth_model = get_authuser_model()
         setup_auth_policies(config, raml_root)
 
+    from .indexing import (
+        setup_indexing_queue, setup_index_aliases, setup_model_indices,
+        setup_type_mappings)
+    setup_indexing_queue(config)
+    setup_index_aliases(config)
     config.include('nefertari.elasticsearch')
+    setup_type_mappings(config)
+    setup_model_indices(config)
 
     log.info('Starting server generation')
     generate_server(raml_root, config)
@@ -62,8 +71,9 @@ def includeme(config):
     from nefertari.engine import setup_database
     setup_database(config)
 
-    from nefertari.elasticsearch import ES
-    ES.setup_mappings()
+    from .indexing import setup_partitioned_indices, setup_mappings
+    setup_partitioned_indices(config)
+    setup_mappings()
 
     if root_auth:
         config.include('ramses.auth')
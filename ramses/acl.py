@@ -1,15 +1,22 @@
+import copy
+import json
 import logging
 
 import six
 from pyramid.security import (
     Allow, Deny,
     Everyone, Authenticated,
-    ALL_PERMISSIONS)
+    ALL_PERMISSIONS, ACLAllowed, ACLDenied)
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.location import lineage
+from pyramid.compat import is_nonstr_iter
 from nefertari.acl import CollectionACL
 from nefertari.resource import PERMISSIONS
 from nefertari.elasticsearch import ES
+from nefertari.json_httpexceptions import JHTTPNotFound
 
 from .utils import resolve_to_callable, is_callable_tag
+from .cache import LRUCache
 
 
 log = logging.getLogger(__name__)
@@ -58,6 +65,100 @@ def parse_permissions(perms):
     return validate_permissions(perms)
 
 
+def request_principal(func):
+    """ Mark callable principal as depending only on request.
+
+    Result of such principal does not depend on `obj` it is called with,
+    thus it is only called once per request for each ACE it is used in.
+    Should be used as decorator on callable principals.
+
+    :param func: Callable principal.
+    """
+    func._request_only = True
+    return func
+
+
+def batch_principal(func):
+    """ Mark callable principal as accepting a list of objects.
+
+    Batch principals are called with `objs` argument, which is a list of
+    objects, instead of `obj` and must return a list of results: single
+    ACE, list of ACEs or None for each object of `objs`.
+    Should be used as decorator on callable principals.
+
+    :param func: Callable principal.
+    """
+    func._batch = True
+    return func
+
+
+def principal_query_filter(principal):
+    """ Register ES query filter form of callable :principal:.
+
+    Query filter is called with `ace` and `request` arguments and must
+    return a query string which matches documents :principal: grants
+    permissions of `ace` to. If it grants permissions to no documents,
+    None should be returned. Query filters are used to filter
+    collections by item ACLs when collection is read from ES.
+    Should be used as decorator on query filter functions.
+
+    :param principal: Callable principal.
+    """
+    def wrapper(func):
+        principal._query_filter = func
+        return func
+    return wrapper
+
+
+def _principal_flag(principal, name):
+    return getattr(principal, name, False) is True
+
+
+def _request_memo(request, name):
+    """ Get dict stored on :request: under attribute :name:.
+
+    New dict is returned on each call if :request: does not support
+    attributes assignment.
+    """
+    memo = getattr(request, name, None)
+    if not isinstance(memo, dict):
+        memo = {}
+        try:
+            setattr(request, name, memo)
+        except AttributeError:
+            pass
+    return memo
+
+
+def generate_stringified_item_acl(request, factory, obj):
+    """ Generate item ACL of :obj: and stringify it to be stored in
+    database.
+
+    ACL :factory: is instantiated once per request. If item ACL does not
+    depend on objects, stringified ACL is also generated once per request
+    and each object gets a copy of it.
+
+    :param request: Current request object.
+    :param factory: ACL class.
+    :param obj: Object ACL is generated for.
+    """
+    from nefertari_guards import engine as guards_engine
+    memo = _request_memo(request, '_item_acls_memo')
+    if factory not in memo:
+        memo[factory] = [factory(request), None]
+    acl_obj, string_acl = memo[factory]
+    if string_acl is not None:
+        return copy.deepcopy(string_acl)
+
+    acl = acl_obj.generate_item_acl(obj)
+    string_acl = guards_engine.ACLField.stringify_acl(acl)
+    depends_on_object = getattr(acl_obj, 'item_acl_depends_on_object', None)
+    if depends_on_object is not None and not depends_on_object():
+        memo[factory][1] = string_acl
+        return copy.deepcopy(string_acl)
+    return string_acl
+
+
 def parse_acl(acl_string):
     """ Parse raw string :acl_string: of RAML-defined ACLs.
 
@@ -107,13 +208,165 @@ def parse_acl(acl_string):
     return result_acl
 
 
+class CompiledACL(object):
+    """ Lookup table of a static ACL.
+
+    ACEs are grouped by principal, so only ACEs of given principals are
+    checked when looking for an ACE that matches a permission.
+    """
+    def __init__(self, acl):
+        """
+        :param acl: Sequence of Pyramid ACEs without callable principals.
+        """
+        self.acl = tuple(acl)
+        self.table = {}
+        for index, (action, principal, permissions) in enumerate(self.acl):
+            if not is_nonstr_iter(permissions):
+                permissions = [permissions]
+            self.table.setdefault(principal, []).append((index, permissions))
+
+    def match(self, principals, permission):
+        """ Get first ACE of ACL which matches any of :principals: and
+        :permission:. Returns None if there is no such ACE.
+        """
+        first = None
+        for principal in principals:
+            for index, permissions in self.table.get(principal, ()):
+                if first is not None and index > first:
+                    break
+                if permission in permissions:
+                    first = index
+                    break
+        return None if first is None else self.acl[first]
+
+
+def compile_acl(acl):
+    """ Compile :acl: to CompiledACL if it is static.
+
+    :param acl: Sequence of Pyramid ACEs.
+    :returns: CompiledACL instance or None if :acl: contains callable
+        principals.
+    """
+    if any(six.callable(ace[1]) for ace in acl):
+        return None
+    return CompiledACL(acl)
+
+
+class CachingACLAuthorizationPolicy(ACLAuthorizationPolicy):
+    """ ACL authorization policy which caches decisions for static ACLs.
+
+    Locations in context lineage may provide `_compiled_acl` attribute
+    containing CompiledACL of their ACL. If all the locations with ACLs
+    have it, decision is looked up in compiled ACLs and cached by
+    (compiled ACLs, principals, permission). Otherwise decision is made
+    by ACLAuthorizationPolicy.
+    """
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: Maximum number of cached decisions.
+        """
+        self.cache = LRUCache(max_size=max_size)
+
+    def _compiled_lineage(self, context):
+        """ Get list of (location, CompiledACL) of :context: lineage.
+        Returns None if any location has dynamic ACL.
+        """
+        locations = []
+        for location in lineage(context):
+            if not hasattr(location, '__acl__'):
+                continue
+            compiled = getattr(location, '_compiled_acl', None)
+            if not isinstance(compiled, CompiledACL):
+                return None
+            locations.append((location, compiled))
+        return locations
+
+    def _decide(self, locations, principals, permission):
+        for index, (location, compiled) in enumerate(locations):
+            ace = compiled.match(principals, permission)
+            if ace is not None:
+                return (ace[0] == Allow, ace, compiled.acl, index)
+        return (
+            False, '<default deny>',
+            '<No ACL found on any object in resource lineage>', None)
+
+    def permits(self, context, principals, permission):
+        locations = self._compiled_lineage(context)
+        if locations is None:
+            return super(CachingACLAuthorizationPolicy, self).permits(
+                context, principals, permission)
+
+        key = (tuple(id(compiled) for _, compiled in locations),
+               frozenset(principals), permission)
+        decision = self.cache.get(key)
+        if decision is None:
+            decision = self._decide(locations, principals, permission)
+            self.cache.set(key, decision)
+
+        allowed, ace, acl, index = decision
+        location = context if index is None else locations[index][0]
+        result_cls = ACLAllowed if allowed else ACLDenied
+        return result_cls(ace, acl, permission, principals, location)
+
+
 class BaseACL(CollectionACL):
     """ ACL Base class. """
 
     es_based = False
+    _cache = None
+    _compiled_collection_acl = None
+    _compiled_item_acl = None
     _collection_acl = (ALLOW_ALL, )
     _item_acl = (ALLOW_ALL, )
 
+    def _principals_memo(self):
+        """ Get dict of callable principals results of current request.
+
+        Results are stored on request, so they are shared by all ACLs
+        used while processing it.
+        """
+        return _request_memo(self.request, '_acl_principals_memo')
+
+    def _call_principal(self, ace, objs, memo):
+        """ Call principal of :ace: for each of :objs: it was not called
+        for during current request.
+
+        Principals marked with `request_principal` are called once per
+        :ace: regardless of objects. Principals marked with
+        `batch_principal` are called once for all the objects. Objects
+        are compared by identity because an object may change during
+        request. Memoized ACEs and objects are kept in :memo: so their
+        ids are not reused.
+
+        :returns: List of principal results for each of :objs:.
+        """
+        principal = ace[1]
+        request_only = _principal_flag(principal, '_request_only')
+
+        def key(obj):
+            return (id(ace), None if request_only else id(obj))
+
+        missing = []
+        missing_keys = set()
+        for obj in objs:
+            obj_key = key(obj)
+            if obj_key not in memo and obj_key not in missing_keys:
+                missing.append(obj)
+                missing_keys.add(obj_key)
+
+        if missing:
+            if _principal_flag(principal, '_batch'):
+                results = principal(
+                    ace=ace, request=self.request, objs=missing)
+            else:
+                results = [
+                    principal(ace=ace, request=self.request, obj=obj)
+                    for obj in missing]
+            for obj, result in zip(missing, results):
+                memo[key(obj)] = (ace, obj, result)
+
+        return [memo[key(obj)][2] for obj in objs]
+
     def _apply_callables(self, acl, obj=None):
         """ Iterate over ACEs from :acl: and apply callable principals
         if any.
@@ -124,24 +377,40 @@ class BaseACL(CollectionACL):
             :request: Current request object
             :obj: Object instance to be accessed via the ACL
         Principals must return a single ACE or a list of ACEs.
+        Results of principals are memoized per request.
 
         :param acl: Sequence of valid Pyramid ACEs which will be processed
         :param obj: Object to be accessed via the ACL
         """
-        new_acl = []
-        for i, ace in enumerate(acl):
-            principal = ace[1]
-            if six.callable(principal):
-                ace = principal(ace=ace, request=self.request, obj=obj)
-                if not ace:
+        return self._apply_callables_many(acl, [obj])[0]
+
+    def _apply_callables_many(self, acl, objs):
+        """ Apply callable principals from :acl: for each of :objs:.
+
+        :param acl: Sequence of valid Pyramid ACEs which will be processed
+        :param objs: List of objects to be accessed via the ACL
+        :returns: List of ACLs for each of :objs:.
+        """
+        memo = self._principals_memo()
+        new_acls = [[] for obj in objs]
+        for ace in acl:
+            if not six.callable(ace[1]):
+                for new_acl in new_acls:
+                    new_acl.append(ace)
+                continue
+            results = self._call_principal(ace, objs, memo)
+            for new_acl, result in zip(new_acls, results):
+                if not result:
                     continue
-                if not isinstance(ace[0], (list, tuple)):
-                    ace = [ace]
-                ace = [(a, b, validate_permissions(c)) for a, b, c in ace]
-            else:
-                ace = [ace]
-            new_acl += ace
-        return tuple(new_acl)
+                if not isinstance(result[0], (list, tuple)):
+                    result = [result]
+                new_acl += [
+                    (a, b, validate_permissions(c)) for a, b, c in result]
+        return [tuple(new_acl) for new_acl in new_acls]
+
+    @property
+    def _compiled_acl(self):
+        return self._compiled_collection_acl
 
     def __acl__(self):
         """ Apply callables to `self._collection_acl` and return result. """
@@ -155,28 +424,142 @@ class BaseACL(CollectionACL):
             acl = self.__acl__()
         return acl
 
+    def item_acl_depends_on_object(self):
+        """ Check whether `self._item_acl` contains callable principals
+        which depend on objects.
+        """
+        return any(
+            six.callable(ace[1]) and
+            not _principal_flag(ace[1], '_request_only')
+            for ace in self._item_acl)
+
+    def generate_items_acl(self, items):
+        """ Generate ACLs of all :items: at once.
+
+        Batch principals are called once for all the :items:, thus this
+        method should be used when ACLs of a whole collection page are
+        needed.
+
+        :param items: List of objects.
+        :returns: List of ACLs for each of :items:.
+        """
+        return self._apply_callables_many(acl=self._item_acl, objs=items)
+
     def item_acl(self, item):
         """ Apply callables to `self._item_acl` and return result. """
         return self.generate_item_acl(item)
 
+    def items_need_check(self, permission):
+        """ Check whether items of collection read from ES have to be
+        checked against item ACL because collection query could not be
+        filtered by it.
+
+        :param permission: Name of permission being checked.
+        """
+        return (self.item_acl_depends_on_object() and
+                self.item_query_filter(permission) is None)
+
+    def item_query_filter(self, permission):
+        """ Build ES query string which matches items :permission: is
+        granted to by `self._item_acl`.
+
+        Items can only be filtered when item ACL contains principals with
+        query filters registered using `principal_query_filter`. Query
+        string is made of query filters of Allow ACEs which precede the
+        first static ACE matching user's principals.
+
+        :param permission: Name of permission being checked.
+        :returns: Query string. None if items should not be filtered.
+            False if no items are permitted.
+        """
+        principals = getattr(self.request, 'effective_principals', None)
+        principals = set(principals or [])
+        has_filters = False
+        clauses = []
+        for ace in self._item_acl:
+            action, principal, permissions = ace
+            if not is_nonstr_iter(permissions):
+                permissions = [permissions]
+            if permission not in permissions:
+                continue
+            if six.callable(principal):
+                query_filter = getattr(principal, '_query_filter', None)
+                if action != Allow or not six.callable(query_filter):
+                    return None
+                has_filters = True
+                clause = query_filter(ace=ace, request=self.request)
+                if clause:
+                    clauses.append(clause)
+            elif principal in principals:
+                if action == Allow:
+                    return None
+                break
+
+        if not has_filters:
+            return None
+        if not clauses:
+            return False
+        return ' OR '.join('({})'.format(clause) for clause in clauses)
+
     def item_db_id(self, key):
         # ``self`` can be used for current authenticated user key
         if key != 'self':
             return key
         user = getattr(self.request, 'user', None)
-        if user is None or not isinstance(user, self.item_model):
+        if user is None:
             return key
-        return getattr(user, user.pk_field())
+        if isinstance(user, self.item_model):
+            return getattr(user, user.pk_field())
+        from .auth import LazyUser
+        if isinstance(user, LazyUser) and user.user_model is self.item_model:
+            return user.userid
+        return key
 
     def __getitem__(self, key):
         """ Get item using method depending on value of `self.es_based` """
         if not self.es_based:
-            return super(BaseACL, self).__getitem__(key)
-        return self.getitem_es(self.item_db_id(key))
+            obj = super(BaseACL, self).__getitem__(key)
+        else:
+            obj = self.getitem_es(self.item_db_id(key))
+        obj._compiled_acl = self._compiled_item_acl
+        return obj
+
+    def get_es_item_index(self, key):
+        """ Get name of ES index item with ID :key: is stored in.
+
+        Returns None if item is stored in the default index of model.
+        Items of time-partitioned models are looked up in partitions.
+        """
+        from .indexing import get_partitioned_index
+        model_name = self.item_model.__name__
+        partitioned = get_partitioned_index(model_name)
+        if partitioned is None:
+            return None
+        key = six.text_type(key)
+        index_name = partitioned.find_indices([key]).get(key)
+        if index_name is None:
+            raise JHTTPNotFound("'{}({})' resource not found".format(
+                model_name, key))
+        return index_name
+
+    def get_es_item(self, key):
+        es = ES(self.item_model.__name__,
+                index_name=self.get_es_item_index(key))
+        return es.get_item(id=key)
 
     def getitem_es(self, key):
-        es = ES(self.item_model.__name__)
-        obj = es.get_item(id=key)
+        """ Get item from ES and set its ACL.
+
+        If resource cache is used, item is loaded from cache.
+        """
+        if self._cache is None:
+            obj = self.get_es_item(key)
+        else:
+            principals = getattr(
+                self.request, 'effective_principals', None)
+            obj = self._cache.get_or_load(
+                self._cache.item_key(key, principals),
+                lambda: self.get_es_item(key))
         obj.__acl__ = self.item_acl(obj)
         obj.__parent__ = self
         obj.__name__ = key
@@ -186,35 +569,59 @@ class BaseACL(CollectionACL):
 class DatabaseACLMixin(object):
     """ Mixin to be used when ACLs are stored in database. """
 
+    def item_query_filter(self, permission):
+        """ Collections are filtered by ACLs stored in database. """
+        return None
+
+    def items_need_check(self, permission):
+        """ Collections are filtered by ACLs stored in database. """
+        return False
+
+    # Objectified ACLs of ES documents by their stored representation
+    _es_acls_cache = LRUCache(max_size=10000)
+
+    def get_es_item_acl(self, item):
+        """ Objectify ACL stored in ES document :item:.
+
+        Identical ACLs are stored in many documents, thus objectified
+        ACLs are cached by their stored JSON representation. Cached ACLs
+        are tuples, so they can be safely shared.
+        """
+        from nefertari_guards.elasticsearch import get_es_item_acl
+        aces = [ace._data for ace in getattr(item, '_acl', None) or ()]
+        key = json.dumps(aces, sort_keys=True, default=str)
+        acl = self._es_acls_cache.get(key)
+        if acl is None:
+            acl = tuple(tuple(ace) for ace in get_es_item_acl(item))
+            self._es_acls_cache.set(key, acl)
+        return acl
+
     def item_acl(self, item):
         """ Objectify ACL if ES is used or call item.get_acl() if
         db is used.
         """
         if self.es_based:
-            from nefertari_guards.elasticsearch import get_es_item_acl
-            return get_es_item_acl(item)
+            return self.get_es_item_acl(item)
         return item.get_acl()
 
-    def getitem_es(self, key):
+    def get_es_item(self, key):
         """ Override to support ACL filtering.
 
         To do so: passes `self.request` to `get_item` and uses
         `ACLFilterES`.
         """
         from nefertari_guards.elasticsearch import ACLFilterES
-        es = ACLFilterES(self.item_model.__name__)
+        es = ACLFilterES(self.item_model.__name__,
+                         index_name=self.get_es_item_index(key))
         params = {
             'id': key,
             'request': self.request,
         }
-        obj = es.get_item(**params)
-        obj.__acl__ = self.item_acl(obj)
-        obj.__parent__ = self
-        obj.__name__ = key
-        return obj
+        return es.get_item(**params)
 
 
-def generate_acl(config, model_cls, raml_resource, es_based=True):
+def generate_acl(config, model_cls, raml_resource, es_based=True,
+                 cache=None):
     """ Generate an ACL.
 
     Generated ACL class has a `item_model` attribute set to
@@ -232,6 +639,8 @@ def generate_acl(config, model_cls, raml_resource, es_based=True):
         for which ACL is being generated
     :param es_based: Boolean inidicating whether ACL should query ES or
         not when getting an object
+    :param cache: Instance of ramses.cache.ResourceCache used to cache
+        items loaded from ES
     """
     schemes = raml_resource.security_schemes or []
     schemes = [sch for sch in schemes if sch.type == 'x-ACL']
@@ -248,6 +657,11 @@ def generate_acl(config, model_cls, raml_resource, es_based=True):
 
     class GeneratedACLBase(object):
         item_model = model_cls
+        _cache = cache
+        _compiled_collection_acl = compile_acl(collection_acl)
+        _compiled_item_acl = (
+            None if config.registry.database_acls
+            else compile_acl(item_acl))
 
         def __init__(self, request, es_based=es_based):
             super(GeneratedACLBase, self).__init__(request=request)
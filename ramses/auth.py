@@ -8,20 +8,31 @@ In particular:
     :create_system_user: Function that creates system/admin user
     :_setup_ticket_policy: Setup Pyramid AuthTktAuthenticationPolicy
     :_setup_apikey_policy: Setup nefertari.ApiKeyAuthenticationPolicy
+    :_setup_signed_token_policy: Setup SignedTokenAuthenticationPolicy
+    :setup_user_cache: Setup process-level cache of authenticated users
+    :setup_token_cache: Setup cache of verified ApiKey tokens
     :setup_auth_policies: Runs generation of particular auth policy
 """
+import hmac
+import json
+import time
+import base64
+import hashlib
 import logging
 
+import six
 import transaction
-from pyramid.authentication import AuthTktAuthenticationPolicy
+from pyramid.authentication import (
+    AuthTktAuthenticationPolicy, CallbackAuthenticationPolicy)
 from pyramid.authorization import ACLAuthorizationPolicy
-from pyramid.security import Allow, ALL_PERMISSIONS
-import cryptacular.bcrypt
+from pyramid.security import Allow, ALL_PERMISSIONS, forget
 
 from nefertari.utils import dictset
 from nefertari.json_httpexceptions import *
 from nefertari.authentication.policies import ApiKeyAuthenticationPolicy
 
+from .passwords import hasher
+
 log = logging.getLogger(__name__)
 
 
@@ -34,15 +45,308 @@ class ACLAssignRegisterMixin(object):
         user = self.request._user
         mapping = self.request.registry._model_collections
         if not user._acl and self.Model.__name__ in mapping:
-            from nefertari_guards import engine as guards_engine
+            from .acl import generate_stringified_item_acl
             factory = mapping[self.Model.__name__].view._factory
-            acl = factory(self.request).generate_item_acl(user)
-            acl = guards_engine.ACLField.stringify_acl(acl)
+            acl = generate_stringified_item_acl(self.request, factory, user)
             user.update({'_acl': acl})
 
         return response
 
 
+class LazyUser(object):
+    """ Authenticated user known by primary key and groups.
+
+    Used as `request.user` when primary key and groups of user are
+    known without accessing database, e.g. from signed token or user
+    cache, so privacy of responses is checked without loading user.
+    Auth model instance of user is loaded on first access of any other
+    attribute, or explicitly with `get_instance`.
+    """
+    def __init__(self, request, user_model, userid, groups, **fields):
+        """
+        :param request: Pyramid Request instance.
+        :param user_model: Auth model class.
+        :param userid: Primary key of user.
+        :param groups: Names of user's groups.
+        :param fields: Other known fields of user, e.g. username.
+        """
+        self.request = request
+        self.user_model = user_model
+        self.userid = userid
+        self.groups = groups
+        for name, value in fields.items():
+            setattr(self, name, value)
+        setattr(self, user_model.pk_field(), userid)
+
+    @classmethod
+    def is_admin(cls, user):
+        """ Determine if :user: is an admin. Used by `apply_privacy`
+        wrapper.
+        """
+        return 'admin' in user.groups
+
+    def get_instance(self):
+        """ Load auth model instance of user from database. """
+        from nefertari.authentication.models import cache_request_user
+        cache_request_user(self.user_model, self.request, self.userid)
+        return self.request._user
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in (
+                'request', 'user_model', 'userid', 'groups'):
+            raise AttributeError(name)
+        instance = self.get_instance()
+        if instance is None:
+            raise AttributeError(name)
+        return getattr(instance, name)
+
+
+class AuthUserCache(object):
+    """ Process-level cache of authenticated users' ids and groups.
+
+    Implements auth model methods used by authentication policies and
+    `request.user`, so it may be used in place of auth model. Primary
+    keys and groups of users are cached by the field users are looked
+    up by for `ttl` seconds.
+
+    Only plain values are cached, as model instances are bound to the
+    DB session of the request which loaded them. Users found in cache
+    are returned as LazyUser, which loads user from the database only
+    when fields other than primary key and groups are accessed.
+    """
+    def __init__(self, auth_model, ttl=60, max_size=1000):
+        """
+        :param auth_model: Auth model class.
+        :param ttl: Entries time to live in seconds.
+        :param max_size: Maximum number of cached users.
+        """
+        from .cache import LRUCache
+        self.auth_model = auth_model
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def _load(self, field, value):
+        """ Load user with :field: equal to :value: and cache its
+        primary key and groups.
+
+        Returns loaded user and cached entry.
+        """
+        user = self.auth_model.get_item(**{field: value})
+        if not user:
+            return None, (None, None)
+        pk = getattr(user, self.auth_model.pk_field())
+        entry = (pk, ['g:%s' % g for g in user.groups])
+        self.cache.set((field, value), entry)
+        return user, entry
+
+    def get_user(self, field, value, request):
+        """ Get user with :field: equal to :value:.
+
+        Returns auth model instance if user was loaded or LazyUser if
+        it was found in cache.
+        """
+        entry = self.cache.get((field, value))
+        if entry is None:
+            user, entry = self._load(field, value)
+            if user is not None:
+                request._user = user
+            return user
+        pk, groups = entry
+        groups = [group[2:] for group in groups]
+        return LazyUser(
+            request, self.auth_model, pk, groups, **{field: value})
+
+    def get_groups(self, field, value):
+        """ Get group identifiers of user with :field: equal to :value:.
+        """
+        entry = self.cache.get((field, value))
+        if entry is None:
+            user, entry = self._load(field, value)
+        return entry[1]
+
+    def get_groups_by_userid(self, userid, request):
+        """ Cached version of `auth_model.get_groups_by_userid`. """
+        try:
+            groups = self.get_groups(self.auth_model.pk_field(), userid)
+        except Exception as ex:
+            log.error(str(ex))
+            forget(request)
+        else:
+            return groups
+
+    def get_authuser_by_userid(self, request):
+        """ Cached version of `auth_model.get_authuser_by_userid`. """
+        userid = request.authenticated_userid
+        if userid:
+            return self.get_user(
+                self.auth_model.pk_field(), userid, request)
+
+    def get_authuser_by_name(self, request):
+        """ Cached version of `auth_model.get_authuser_by_name`. """
+        username = request.authenticated_userid
+        if username:
+            return self.get_user('username', username, request)
+
+    def invalidate(self, event):
+        """ Auth model event subscriber that drops changed users. """
+        from nefertari import events
+        instance = event.instance
+        if instance is None or isinstance(
+                event, (events.AfterUpdateMany, events.AfterDeleteMany)):
+            return self.cache.clear()
+        pk_field = self.auth_model.pk_field()
+        self.cache.delete((pk_field, getattr(instance, pk_field, None)))
+        self.cache.delete(('username', getattr(instance, 'username', None)))
+
+
+def setup_user_cache(config):
+    """ Setup AuthUserCache if `auth_cache.enable` setting is true.
+
+    Cache is invalidated by update and delete events of auth model.
+
+    Supported settings:
+        :auth_cache.ttl: Time users are cached for in seconds. Defaults
+            to 60.
+        :auth_cache.max_size: Maximum number of cached users. Defaults
+            to 1000.
+
+    :param config: Pyramid Configurator instance.
+    :returns: AuthUserCache instance or None.
+    """
+    from nefertari import events
+    settings = dictset(config.registry.settings)
+    if not settings.asbool('auth_cache.enable'):
+        return None
+    auth_model = config.registry.auth_model
+    log.info('Enabling cache of authenticated users')
+    user_cache = AuthUserCache(
+        auth_model,
+        ttl=settings.asint('auth_cache.ttl', 60),
+        max_size=settings.asint('auth_cache.max_size', 1000))
+    write_events = [
+        events.AfterUpdate, events.AfterReplace, events.AfterDelete,
+        events.AfterUpdateMany, events.AfterDeleteMany,
+    ]
+    config.subscribe_to_events(
+        user_cache.invalidate, write_events, model=auth_model)
+    return user_cache
+
+
+class ApiKeyTokenCache(object):
+    """ Cache of groups of users whose username and ApiKey token pairs
+    were verified by `auth_model.get_groups_by_token`.
+
+    Tokens are not stored; entries are keyed by username and token hash.
+    Keys also include generation number of username, so all the entries
+    of a user are dropped at once when user's token is reset.
+    """
+    def __init__(self, auth_model, ttl=60, max_size=1000):
+        """
+        :param auth_model: Auth model class.
+        :param ttl: Entries time to live in seconds.
+        :param max_size: Maximum number of cached tokens.
+        """
+        from .cache import LRUCache
+        self.auth_model = auth_model
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def _key(self, username, token):
+        token_hash = hashlib.sha256(
+            six.text_type(token).encode('utf-8')).hexdigest()
+        return (username, self.cache.counter(username), token_hash)
+
+    def get_groups_by_token(self, username, token, request):
+        """ Cached version of `auth_model.get_groups_by_token`.
+
+        Only successfully verified tokens are cached.
+        """
+        key = self._key(username, token)
+        groups = self.cache.get(key)
+        if groups is None:
+            groups = self.auth_model.get_groups_by_token(
+                username, token, request)
+            if groups is None:
+                return None
+            groups = tuple(groups)
+            self.cache.set(key, groups)
+        return list(groups)
+
+    def invalidate_user(self, username):
+        """ Drop verified tokens of user :username:. """
+        self.cache.incr(username)
+
+    def remember_username(self, event):
+        """ Auth model before-event subscriber that stores username of
+        user which is about to be changed.
+
+        Instance is changed in place, so its previous username is not
+        available to `invalidate` otherwise.
+        """
+        if event.instance is not None and event.view is not None:
+            event.view._previous_username = getattr(
+                event.instance, 'username', None)
+
+    def invalidate(self, event):
+        """ Auth model event subscriber that drops tokens of changed
+        users.
+
+        Tokens of both previous and new username are dropped when
+        username is changed.
+        """
+        from nefertari import events
+        instance = event.instance
+        if instance is None or isinstance(
+                event, (events.AfterUpdateMany, events.AfterDeleteMany)):
+            return self.cache.clear()
+        usernames = set([
+            getattr(instance, 'username', None),
+            getattr(event.view, '_previous_username', None),
+        ])
+        field = (event.fields or {}).get('username')
+        if field is not None:
+            usernames.add(field.new_value)
+        for username in usernames:
+            if username is not None:
+                self.invalidate_user(username)
+
+
+def setup_token_cache(config, params):
+    """ Setup ApiKeyTokenCache if `token_cache_ttl` security scheme
+    setting is set.
+
+    Cache settings are popped from :params:. Cache is invalidated by
+    update and delete events of auth model and when token is reset.
+
+    Supported settings:
+        :token_cache_ttl: Time verified tokens are cached for in seconds.
+        :token_cache_max_size: Maximum number of cached tokens. Defaults
+            to 1000.
+
+    :param config: Pyramid Configurator instance.
+    :param params: Nefertari dictset which contains security scheme
+        `settings`.
+    :returns: ApiKeyTokenCache instance or None.
+    """
+    from nefertari import events
+    ttl = params.pop('token_cache_ttl', None)
+    max_size = params.pop('token_cache_max_size', 1000)
+    if not ttl or not float(ttl):
+        return None
+    auth_model = config.registry.auth_model
+    log.info('Enabling cache of verified ApiKey tokens')
+    token_cache = ApiKeyTokenCache(
+        auth_model, ttl=float(ttl), max_size=int(max_size))
+    write_events = [
+        events.AfterUpdate, events.AfterReplace, events.AfterDelete,
+        events.AfterUpdateMany, events.AfterDeleteMany,
+    ]
+    config.subscribe_to_events(
+        token_cache.remember_username,
+        [events.BeforeUpdate, events.BeforeReplace], model=auth_model)
+    config.subscribe_to_events(
+        token_cache.invalidate, write_events, model=auth_model)
+    return token_cache
+
+
 def _setup_ticket_policy(config, params):
     """ Setup Pyramid AuthTktAuthenticationPolicy.
 
@@ -50,6 +354,8 @@ def _setup_ticket_policy(config, params):
       * Initial `secret` params value is considered to be a name of config
         param that represents a cookie name.
       * `auth_model.get_groups_by_userid` is used as a `callback`.
+      * If `auth_cache.enable` setting is true, users and their groups
+        are loaded using AuthUserCache.
       * Also connects basic routes to perform authentication actions.
 
     :param config: Pyramid Configurator instance.
@@ -67,10 +373,11 @@ def _setup_ticket_policy(config, params):
     params['secret'] = config.registry.settings[params['secret']]
 
     auth_model = config.registry.auth_model
-    params['callback'] = auth_model.get_groups_by_userid
+    users = setup_user_cache(config) or auth_model
+    params['callback'] = users.get_groups_by_userid
 
     config.add_request_method(
-        auth_model.get_authuser_by_userid, 'user', reify=True)
+        users.get_authuser_by_userid, 'user', reify=True)
 
     policy = AuthTktAuthenticationPolicy(**params)
 
@@ -112,6 +419,10 @@ def _setup_apikey_policy(config, params):
         token check
       * `auth_model.get_token_credentials` is used to get username and
         token from userid
+      * If `auth_cache.enable` setting is true, `request.user` is loaded
+        using AuthUserCache.
+      * If `token_cache_ttl` security scheme setting is set, verified
+        tokens are cached using ApiKeyTokenCache.
       * Also connects basic routes to perform authentication actions.
 
     Arguments:
@@ -124,11 +435,13 @@ def _setup_apikey_policy(config, params):
     log.info('Configuring ApiKey Authn policy')
 
     auth_model = config.registry.auth_model
-    params['check'] = auth_model.get_groups_by_token
+    token_cache = setup_token_cache(config, params)
+    params['check'] = (token_cache or auth_model).get_groups_by_token
     params['credentials_callback'] = auth_model.get_token_credentials
     params['user_model'] = auth_model
+    users = setup_user_cache(config) or auth_model
     config.add_request_method(
-        auth_model.get_authuser_by_name, 'user', reify=True)
+        users.get_authuser_by_name, 'user', reify=True)
 
     policy = ApiKeyAuthenticationPolicy(**params)
 
@@ -147,6 +460,13 @@ def _setup_apikey_policy(config, params):
     class RamsesTokenAuthResetView(TokenAuthResetView):
         Model = auth_model
 
+        def reset_token(self, *args, **kwargs):
+            response = super(RamsesTokenAuthResetView, self).reset_token(
+                *args, **kwargs)
+            if token_cache is not None and self.user:
+                token_cache.invalidate_user(self.user.username)
+            return response
+
     common_kw = {
         'prefix': 'auth',
         'factory': 'nefertari.acl.AuthenticationACL',
@@ -160,6 +480,208 @@ def _setup_apikey_policy(config, params):
     return policy
 
 
+class SignedTokenAuthenticationPolicy(CallbackAuthenticationPolicy):
+    """ Stateless authentication policy which uses HMAC-signed expiring
+    tokens.
+
+    Token contains userid, user's groups and expiration time, so
+    requests are authenticated without accessing database. Token is
+    passed in `Authorization` header, e.g.:
+        `Authorization: SignedToken <token>`
+
+    User is loaded from database only when token is issued. Changes of
+    user's groups take effect when token expires. Tokens can't be
+    revoked before they expire, except by changing the secret.
+    """
+    scheme = 'SignedToken'
+    hash_algorithms = ('sha256', 'sha384', 'sha512')
+
+    def __init__(self, secret, user_model, expires=3600,
+                 hashalg='sha256', debug=False):
+        """
+        :param secret: Secret used to sign tokens.
+        :param user_model: Auth model class.
+        :param expires: Token time to live in seconds.
+        :param hashalg: Name of hashlib algorithm used by HMAC. One of
+            `hash_algorithms`.
+        :param debug: Boolean indicating whether to log authentication
+            debug messages.
+        """
+        if isinstance(secret, six.text_type):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.user_model = user_model
+        self.expires = int(expires)
+        if hashalg not in self.hash_algorithms:
+            raise ValueError(
+                'Unsupported signed token hashalg `{}`. Supported '
+                'algorithms: {}'.format(
+                    hashalg, ', '.join(self.hash_algorithms)))
+        self.digestmod = getattr(hashlib, hashalg)
+        self.debug = debug
+
+    def _sign(self, data):
+        return hmac.new(self.secret, data, self.digestmod).digest()
+
+    @staticmethod
+    def _b64encode(data):
+        return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+    @staticmethod
+    def _b64decode(data):
+        return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+    def encode_token(self, userid, groups):
+        """ Make signed token of user :userid: with :groups:. """
+        payload = json.dumps({
+            'userid': userid,
+            'groups': list(groups),
+            'expires': int(time.time()) + self.expires,
+        }, sort_keys=True).encode('utf-8')
+        token = b'.'.join([
+            self._b64encode(payload),
+            self._b64encode(self._sign(payload))])
+        return token.decode('ascii')
+
+    def decode_token(self, token):
+        """ Get payload of :token:.
+
+        :returns: Dict with `userid`, `groups` and `expires` keys or None
+            if token is malformed, has invalid signature or is expired.
+        """
+        try:
+            payload, signature = token.encode('ascii').split(b'.')
+            payload = self._b64decode(payload)
+            signature = self._b64decode(signature)
+        except (ValueError, TypeError, UnicodeError):
+            return None
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            data = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            return None
+        if data.get('expires', 0) <= time.time():
+            return None
+        return data
+
+    def _get_payload(self, request):
+        authorization = request.headers.get('Authorization')
+        if not authorization:
+            return None
+        try:
+            authmeth, token = authorization.split(' ', 1)
+        except ValueError:
+            return None
+        if authmeth.lower() != self.scheme.lower():
+            return None
+        return self.decode_token(token.strip())
+
+    def unauthenticated_userid(self, request):
+        """ Userid of valid token from `Authorization` header. """
+        payload = self._get_payload(request)
+        if payload is not None:
+            return payload.get('userid')
+
+    def callback(self, userid, request):
+        """ Groups from token of user :userid:. """
+        payload = self._get_payload(request)
+        if payload is not None and payload.get('userid') == userid:
+            return payload.get('groups') or []
+
+    def get_user(self, request):
+        """ Get LazyUser of valid token from `Authorization` header.
+
+        Is added as request method to populate `request.user`.
+        """
+        payload = self._get_payload(request)
+        if payload is None or payload.get('userid') is None:
+            return None
+        groups = [group[2:] if group.startswith('g:') else group
+                  for group in payload.get('groups') or []]
+        return LazyUser(request, self.user_model, payload['userid'], groups)
+
+    def remember(self, request, userid, **kw):
+        """ Returns 'WWW-Authenticate' header with a value that should be
+        used in 'Authorization' header.
+        """
+        from nefertari.authentication.models import cache_request_user
+        cache_request_user(self.user_model, request, userid)
+        user = request._user
+        if not user:
+            return []
+        groups = ['g:%s' % g for g in user.groups]
+        token = self.encode_token(userid, groups)
+        return [('WWW-Authenticate', '{} {}'.format(self.scheme, token))]
+
+    def forget(self, request):
+        """ Tokens are stateless, thus there is nothing to forget. """
+        return []
+
+
+def _setup_signed_token_policy(config, params):
+    """ Setup SignedTokenAuthenticationPolicy.
+
+    Notes:
+      * Initial `secret` params value is considered to be a name of config
+        param that represents a secret used to sign tokens.
+      * `expires` param sets token time to live in seconds. Defaults to
+        3600.
+      * `hashalg` param sets hash algorithm used to sign tokens: sha256,
+        sha384 or sha512. Defaults to sha256.
+      * `request.user` is LazyUser built from the token, which loads
+        the user from database only when its model fields are accessed.
+      * Also connects basic routes to perform authentication actions.
+        Token is returned in `WWW-Authenticate` header of register and
+        login responses.
+
+    :param config: Pyramid Configurator instance.
+    :param params: Nefertari dictset which contains security scheme
+        `settings`.
+    """
+    from nefertari.authentication.views import (
+        TicketAuthRegisterView, TicketAuthLoginView,
+        TicketAuthLogoutView)
+
+    log.info('Configuring SignedToken Authn policy')
+    if 'secret' not in params:
+        raise ValueError(
+            'Missing required security scheme settings: secret')
+    params['secret'] = config.registry.settings[params['secret']]
+
+    auth_model = config.registry.auth_model
+    params['user_model'] = auth_model
+    policy = SignedTokenAuthenticationPolicy(**params)
+    config.add_request_method(policy.get_user, 'user', reify=True)
+
+    RegisterViewBase = TicketAuthRegisterView
+    if config.registry.database_acls:
+        class RegisterViewBase(ACLAssignRegisterMixin,
+                               TicketAuthRegisterView):
+            pass
+
+    class RamsesSignedTokenRegisterView(RegisterViewBase):
+        Model = auth_model
+
+    class RamsesSignedTokenLoginView(TicketAuthLoginView):
+        Model = auth_model
+
+    class RamsesSignedTokenLogoutView(TicketAuthLogoutView):
+        Model = auth_model
+
+    common_kw = {
+        'prefix': 'auth',
+        'factory': 'nefertari.acl.AuthenticationACL',
+    }
+
+    root = config.get_root_resource()
+    root.add('register', view=RamsesSignedTokenRegisterView, **common_kw)
+    root.add('login', view=RamsesSignedTokenLoginView, **common_kw)
+    root.add('logout', view=RamsesSignedTokenLogoutView, **common_kw)
+
+    return policy
+
+
 """ Map of `security_scheme_type`: `generator_function`, where:
 
   * `security_scheme_type`: String that represents RAML security scheme type
@@ -172,6 +694,7 @@ def _setup_apikey_policy(config, params):
 AUTHENTICATION_POLICIES = {
     'x-ApiKey': _setup_apikey_policy,
     'x-Ticket': _setup_ticket_policy,
+    'x-SignedToken': _setup_signed_token_policy,
 }
 
 
@@ -213,18 +736,23 @@ def setup_auth_policies(config, raml_root):
     config.set_authentication_policy(authn_policy)
 
     # Setup Authorization policy
-    authz_policy = ACLAuthorizationPolicy()
+    settings = dictset(config.registry.settings)
+    if settings.asbool('acl_cache.enable'):
+        from .acl import CachingACLAuthorizationPolicy
+        authz_policy = CachingACLAuthorizationPolicy(
+            max_size=settings.asint('acl_cache.max_size', 10000))
+    else:
+        authz_policy = ACLAuthorizationPolicy()
     config.set_authorization_policy(authz_policy)
 
 
 def create_system_user(config):
     log.info('Creating system user')
-    crypt = cryptacular.bcrypt.BCRYPTPasswordManager()
     settings = config.registry.settings
     try:
         auth_model = config.registry.auth_model
         s_user = settings['system.user']
-        s_pass = str(crypt.encode(settings['system.password']))
+        s_pass = hasher.encode(settings['system.password'])
         s_email = settings['system.email']
         defaults = dict(
             password=s_pass,
@@ -246,8 +774,9 @@ def get_authuser_model():
     """ Define and return AuthUser model using nefertari base classes """
     from nefertari.authentication.models import AuthUserMixin
     from nefertari import engine
+    from .passwords import RehashPasswordMixin
 
-    class AuthUser(AuthUserMixin, engine.BaseDocument):
+    class AuthUser(RehashPasswordMixin, AuthUserMixin, engine.BaseDocument):
         __tablename__ = 'ramses_authuser'
 
     return AuthUser
@@ -0,0 +1,841 @@
+"""
+Caching of generated views' responses.
+
+In particular:
+    :LRUCache: Thread-safe in-process LRU cache with entries' TTL
+    :SharedMemoryCache: Cache stored in a memory-mapped file which is
+        shared by all worker processes of a host
+    :SingleFlight: Coalesces concurrent identical calls into one
+    :ResourceCache: Cache of ES documents read by views and ACLs of a
+        single resource
+    :setup_resource_cache: Creates ResourceCache for a RAML resource
+        and connects its invalidation to model events
+    :get_stats: Hit/miss counters of resource caches of application
+"""
+import os
+import sys
+import copy
+import json
+import mmap
+import time
+import struct
+import stat
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import six
+from nefertari.utils import dict2obj, dictset
+
+from .utils import call_after_commit
+
+
+log = logging.getLogger(__name__)
+
+
+def make_key(*parts):
+    """ Generate cache key from JSON-serializable :parts:. """
+    key = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """ Thread-safe least-recently-used cache with entries' TTL.
+
+    Apart from cached values, cache holds integer counters which are not
+    subject to LRU eviction. Counters are used as generation numbers of
+    cached data: bumping a counter which is a part of cache keys makes all
+    the entries stored under old keys unreachable.
+    """
+    def __init__(self, max_size=1000, ttl=None, max_counters=None):
+        """
+        :param max_size: Maximum number of entries cache holds.
+        :param ttl: Default entry time to live in seconds. Entries don't
+            expire if None.
+        :param max_counters: Maximum number of counters. When exceeded,
+            whole cache is cleared. Defaults to 10 * :max_size:.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_counters = max_counters or max_size * 10
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def lookup(self, key):
+        """ Get cached value and its age in seconds.
+
+        :returns: Tuple of (value, age). (None, None) is returned if
+            value is missing or expired.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                value, stored_at, ttl = entry
+                age = time.time() - stored_at
+                if ttl is None or age < ttl:
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value, age
+            self.misses += 1
+            return None, None
+
+    def get(self, key, default=None):
+        value, age = self.lookup(key)
+        return default if age is None else value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time(), ttl)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._counters.clear()
+
+    def counter(self, name):
+        """ Get current value of counter :name:. """
+        return self._counters.get(name, 0)
+
+    def incr(self, name):
+        """ Increment counter :name: and return its new value. """
+        with self._lock:
+            if (name not in self._counters and
+                    len(self._counters) >= self.max_counters):
+                self._data.clear()
+                self._counters.clear()
+            value = self._counters.get(name, 0) + 1
+            self._counters[name] = value
+            return value
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self),
+        }
+
+
+class SharedMemoryCache(object):
+    """ Cache stored in a memory-mapped file shared by worker processes.
+
+    Implements LRUCache interface. Storage is a set-associative table of
+    fixed-size slots: key hash determines a set of slots the entry may
+    be stored in and the oldest entry of a set is evicted when it is
+    full. Values which don't fit into a slot are not cached.
+
+    Counters are stored in a separate table of the same file, so
+    invalidation performed by one process is visible to all the others.
+    When counters table is full, whole cache is cleared.
+
+    Access is synchronized with `fcntl.flock`, thus storage file must be
+    placed on a local filesystem. File is reopened after fork, so
+    instances may be created before workers are forked. Hit and miss
+    counters are kept per process.
+
+    Storage file must be placed in a directory which is only writable
+    by the user application runs as and must be owned by this user.
+    Values are stored as JSON, so only JSON-serializable values are
+    cached.
+    """
+    MAGIC = b'RAMSESC2'
+    HEADER = struct.Struct('<8sIII')
+    COUNTER = struct.Struct('<16sQ')
+    SLOT = struct.Struct('<16sddI')
+    WAYS = 4
+
+    def __init__(self, path, slots=4096, slot_size=16384,
+                 counter_slots=None, ttl=None, namespace=''):
+        """
+        :param path: Path to storage file. File is created if it doesn't
+            exist and reinitialized if it has different layout.
+        :param slots: Number of value slots.
+        :param slot_size: Size of a slot in bytes.
+        :param counter_slots: Number of counters. Defaults to :slots:.
+        :param ttl: Default entry time to live in seconds.
+        :param namespace: Prefix of keys, so that applications which use
+            the same file don't read each other's entries.
+        """
+        self.path = path
+        self.namespace = namespace
+        self.slots = max(slots - slots % self.WAYS, self.WAYS)
+        self.slot_size = slot_size
+        self.counter_slots = counter_slots or slots
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._counters_offset = self.HEADER.size
+        self._data_offset = (
+            self._counters_offset + self.counter_slots * self.COUNTER.size)
+        self._file_size = self._data_offset + self.slots * self.slot_size
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._mmap = None
+
+    def _header(self):
+        return self.HEADER.pack(
+            self.MAGIC, self.slots, self.slot_size, self.counter_slots)
+
+    def _check_directory(self):
+        """ Check that directory of storage file is owned by current
+        user and is not writable by others.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        dir_stat = os.stat(directory)
+        if dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o022:
+            raise ValueError(
+                'Directory of shared cache file {} must be owned by current '
+                'user and not writable by others'.format(self.path))
+
+    def _check_file(self, fd):
+        """ Check that opened storage file :fd: is a regular file owned
+        by current user and make it private.
+        """
+        file_stat = os.fstat(fd)
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise ValueError(
+                'Shared cache file {} is not a regular file'.format(
+                    self.path))
+        if file_stat.st_uid != os.getuid():
+            raise ValueError(
+                'Shared cache file {} is not owned by current user'.format(
+                    self.path))
+        if stat.S_IMODE(file_stat.st_mode) != 0o600:
+            os.fchmod(fd, 0o600)
+
+    def _open(self):
+        import fcntl
+        self._check_directory()
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0)
+        fd = os.open(self.path, flags, 0o600)
+        try:
+            self._check_file(fd)
+        except Exception:
+            os.close(fd)
+            raise
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(fd, self.HEADER.size)
+            size = os.fstat(fd).st_size
+            if header != self._header() or size != self._file_size:
+                log.info('Initializing shared cache file {}'.format(
+                    self.path))
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self._file_size)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self._header())
+            self._mmap = mmap.mmap(fd, self._file_size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        import fcntl
+        with self._thread_lock:
+            if self._pid != os.getpid():
+                self._open()
+            flag = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            fcntl.flock(self._fd, flag)
+            try:
+                yield self._mmap
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _digest(self, key):
+        key = '{}:{}'.format(self.namespace, key)
+        return hashlib.md5(key.encode('utf-8')).digest()
+
+    def _slot_offsets(self, digest):
+        sets = self.slots // self.WAYS
+        first = (struct.unpack('<Q', digest[:8])[0] % sets) * self.WAYS
+        return [self._data_offset + (first + way) * self.slot_size
+                for way in range(self.WAYS)]
+
+    def _read_slot(self, mm, offset):
+        return self.SLOT.unpack(mm[offset:offset + self.SLOT.size])
+
+    def lookup(self, key):
+        """ Get cached value and its age in seconds.
+
+        :returns: Tuple of (value, age). (None, None) is returned if
+            value is missing or expired.
+        """
+        digest = self._digest(key)
+        payload = None
+        with self._locked() as mm:
+            for offset in self._slot_offsets(digest):
+                slot_digest, stored_at, ttl, length = self._read_slot(
+                    mm, offset)
+                if slot_digest != digest:
+                    continue
+                age = time.time() - stored_at
+                if ttl < 0 or age < ttl:
+                    start = offset + self.SLOT.size
+                    payload = mm[start:start + length]
+                break
+        if payload is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return json.loads(payload.decode('utf-8')), age
+
+    def get(self, key, default=None):
+        value, age = self.lookup(key)
+        return default if age is None else value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        try:
+            payload = json.dumps(value, separators=(',', ':'))
+        except (TypeError, ValueError):
+            log.debug('Value of type {} can not be cached'.format(
+                type(value).__name__))
+            return
+        payload = payload.encode('utf-8')
+        if len(payload) > self.slot_size - self.SLOT.size:
+            log.debug('Value of {} bytes is too big to be cached'.format(
+                len(payload)))
+            return
+        digest = self._digest(key)
+        header = self.SLOT.pack(
+            digest, time.time(), -1 if ttl is None else ttl, len(payload))
+        with self._locked(exclusive=True) as mm:
+            target = None
+            oldest = None
+            for offset in self._slot_offsets(digest):
+                slot_digest, stored_at, _, _ = self._read_slot(mm, offset)
+                if slot_digest == digest:
+                    target = offset
+                    break
+                if oldest is None or stored_at < oldest[0]:
+                    oldest = (stored_at, offset)
+            if target is None:
+                target = oldest[1]
+            data = header + payload
+            mm[target:target + len(data)] = data
+
+    def delete(self, key):
+        digest = self._digest(key)
+        empty = b'\0' * self.SLOT.size
+        with self._locked(exclusive=True) as mm:
+            for offset in self._slot_offsets(digest):
+                if self._read_slot(mm, offset)[0] == digest:
+                    mm[offset:offset + self.SLOT.size] = empty
+
+    def _clear(self, mm):
+        start = self._counters_offset
+        mm[start:self._file_size] = b'\0' * (self._file_size - start)
+
+    def clear(self):
+        with self._locked(exclusive=True) as mm:
+            self._clear(mm)
+
+    def _find_counter(self, mm, digest):
+        """ Get offset of counter :digest: or of an empty counter slot
+        it should be stored at. Returns None if counters table is full.
+        """
+        start = struct.unpack('<Q', digest[:8])[0] % self.counter_slots
+        for i in range(self.counter_slots):
+            index = (start + i) % self.counter_slots
+            offset = self._counters_offset + index * self.COUNTER.size
+            slot_digest, _ = self.COUNTER.unpack(
+                mm[offset:offset + self.COUNTER.size])
+            if slot_digest in (digest, b'\0' * 16):
+                return offset
+        return None
+
+    def counter(self, name):
+        """ Get current value of counter :name:. """
+        digest = self._digest(name)
+        with self._locked() as mm:
+            offset = self._find_counter(mm, digest)
+            if offset is None:
+                return 0
+            slot_digest, value = self.COUNTER.unpack(
+                mm[offset:offset + self.COUNTER.size])
+            return value if slot_digest == digest else 0
+
+    def incr(self, name):
+        """ Increment counter :name: and return its new value. """
+        digest = self._digest(name)
+        with self._locked(exclusive=True) as mm:
+            offset = self._find_counter(mm, digest)
+            if offset is None:
+                self._clear(mm)
+                offset = self._find_counter(mm, digest)
+            slot_digest, value = self.COUNTER.unpack(
+                mm[offset:offset + self.COUNTER.size])
+            value = value + 1 if slot_digest == digest else 1
+            mm[offset:offset + self.COUNTER.size] = self.COUNTER.pack(
+                digest, value)
+            return value
+
+    def __len__(self):
+        size = 0
+        with self._locked() as mm:
+            for i in range(self.slots):
+                offset = self._data_offset + i * self.slot_size
+                if self._read_slot(mm, offset)[0] != b'\0' * 16:
+                    size += 1
+        return size
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self),
+        }
+
+
+def get_shared_backend(config):
+    """ Get SharedMemoryCache of application.
+
+    Single instance is shared by all cached resources. It is configured
+    with following settings:
+        :cache.shared.path: Path to storage file in a directory which is
+            only writable by the user application runs as. Required.
+        :cache.shared.namespace: Prefix of cache keys. Defaults to
+            name of application package.
+        :cache.shared.slots: Number of cached values. Defaults to 4096.
+        :cache.shared.slot_size: Maximum size of a cached value in
+            bytes. Defaults to 16384.
+
+    :param config: Pyramid Configurator instance.
+    """
+    backend = getattr(config.registry, '_ramses_shared_cache', None)
+    if backend is not None:
+        return backend
+    settings = dictset(config.registry.settings or {})
+    path = settings.get('cache.shared.path')
+    if not path:
+        raise ValueError(
+            '`cache.shared.path` setting is required by shared cache')
+    namespace = settings.get('cache.shared.namespace') or getattr(
+        config.registry, 'package_name', '')
+    backend = SharedMemoryCache(
+        path=path,
+        slots=settings.asint('cache.shared.slots', 4096),
+        slot_size=settings.asint('cache.shared.slot_size', 16384),
+        namespace=namespace)
+    log.info('Using shared cache file {}'.format(path))
+    config.registry._ramses_shared_cache = backend
+    return backend
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls with the same key.
+
+    While a call with some key is in flight, other threads which make a
+    call with the same key wait for it to finish and get its result
+    instead of making their own calls. Exceptions raised by the call are
+    reraised in all the waiting threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """ Call :func: unless a call with :key: is in flight.
+
+        :returns: Tuple of (result, shared) where `shared` is a boolean
+            indicating whether result of another thread's call was
+            returned.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                six.reraise(*call.error)
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+def _is_es_docs(result):
+    return isinstance(result, list) and hasattr(result, '_nefertari_meta')
+
+
+def _plain_copy(value):
+    """ Deep copy :value: converting dict subclasses to plain dicts. """
+    if isinstance(value, dict):
+        return {key: _plain_copy(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain_copy(val) for val in value]
+    return copy.deepcopy(value)
+
+
+def freeze(result):
+    """ Convert ES document or collection :result: to plain data which
+    is safe to share between requests.
+    """
+    if _is_es_docs(result):
+        return {
+            'documents': [_plain_copy(doc._data) for doc in result],
+            'meta': _plain_copy(result._nefertari_meta),
+        }
+    if hasattr(result, '_data'):
+        return {'document': _plain_copy(result._data)}
+    return {'value': _plain_copy(result)}
+
+
+def thaw(data):
+    """ Build new ES document or collection from data produced by
+    `freeze`.
+    """
+    from nefertari.elasticsearch import _ESDocs
+    if 'documents' in data:
+        documents = _ESDocs([
+            dict2obj(_plain_copy(doc)) for doc in data['documents']])
+        documents._nefertari_meta = _plain_copy(data['meta'])
+        return documents
+    if 'document' in data:
+        return dict2obj(_plain_copy(data['document']))
+    return _plain_copy(data['value'])
+
+
+def _instance_id(instance):
+    """ Get primary key value of ES or DB document :instance:. """
+    if instance is None:
+        return None
+    if hasattr(instance, 'pk_field'):
+        return getattr(instance, instance.pk_field(), None)
+    return getattr(instance, '_pk', None)
+
+
+class ResourceCache(object):
+    """ Cache of ES documents and collections of a single resource.
+
+    Cached values are stored frozen, thus each request gets its own copy
+    of documents. Keys include effective principals of the user, so
+    results filtered by ACLs are never shared between users with
+    different permissions.
+
+    Concurrent requests which miss the same key share a single call to
+    the loader.
+
+    When :hard_ttl: is set, entries are stored for :hard_ttl: seconds.
+    Entries older than :ttl: are then either reloaded or, if revalidation
+    is requested, returned stale while being reloaded in a background
+    thread.
+
+    Cache is invalidated by model events:
+      * Creation of an object invalidates cached collections.
+      * Update and deletion of an object invalidates cached collections
+        and the object.
+      * Bulk updates and deletions invalidate everything.
+
+    Entries are invalidated when event is handled and once again after
+    changes are committed to the database and written to Elasticsearch,
+    so that entries loaded by concurrent requests in the meantime are
+    dropped.
+    """
+    def __init__(self, model_name, backend, ttl=None, hard_ttl=None):
+        """
+        :param model_name: Name of model which documents are cached.
+        :param backend: Storage object which implements LRUCache
+            interface.
+        :param ttl: Entries time to live in seconds. When 0, values are
+            not stored but concurrent loads are still coalesced.
+        :param hard_ttl: Maximum age of stale entries in seconds.
+        """
+        self.model_name = model_name
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale = 0
+        self.hard_ttl = hard_ttl
+        self._flight = SingleFlight()
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+
+    def _counter_name(self, *parts):
+        return ':'.join([self.model_name] + [str(p) for p in parts])
+
+    def _generation(self, *parts):
+        return self.backend.counter(self._counter_name(*parts))
+
+    def collection_key(self, route, params, principals):
+        """ Generate cache key of a collection.
+
+        :param route: Request path.
+        :param params: Dict of query params.
+        :param principals: Effective principals of current user.
+        """
+        return make_key(
+            self.model_name, 'collection',
+            self._generation('all'), self._generation('collection'),
+            route, sorted(params.items()), sorted(principals or []))
+
+    def item_key(self, item_id, principals):
+        """ Generate cache key of an item.
+
+        :param item_id: Item primary key value.
+        :param principals: Effective principals of current user.
+        """
+        item_id = str(item_id)
+        return make_key(
+            self.model_name, 'item',
+            self._generation('all'), self._generation('item', item_id),
+            item_id, sorted(principals or []))
+
+    def _load(self, key, loader):
+        """ Call :loader: and store the value it returns under :key:. """
+        log.debug('{} cache miss'.format(self.model_name))
+        data = freeze(loader())
+        if self.ttl != 0:
+            self.backend.set(key, data, ttl=self.hard_ttl or self.ttl)
+        return data
+
+    def _refresh(self, key, loader):
+        """ Reload value stored under :key: in a background thread. """
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._flight.do(key, lambda: self._load(key, loader))
+            except Exception as ex:
+                log.error('Failed to refresh {} cache entry: {}'.format(
+                    self.model_name, ex))
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def get_or_load(self, key, loader, revalidate=False,
+                    refresh_loader=None):
+        """ Get value stored under :key: or call :loader: and store
+        the value it returns.
+
+        :param revalidate: Boolean indicating whether stale value may be
+            returned while it is reloaded in background.
+        :param refresh_loader: Function used to reload stale value in
+            background thread. Defaults to :loader:.
+        :returns: Fresh copy of cached value.
+        """
+        data, age = self.backend.lookup(key)
+        if age is not None and self.ttl is not None and age >= self.ttl:
+            if not (revalidate and self.hard_ttl):
+                age = None
+            else:
+                self.stale += 1
+                self._refresh(key, refresh_loader or loader)
+                return thaw(data)
+
+        if age is not None:
+            self.hits += 1
+            return thaw(data)
+
+        self.misses += 1
+        data, shared = self._flight.do(key, lambda: self._load(key, loader))
+        if shared:
+            self.coalesced += 1
+        return thaw(data)
+
+    def invalidate_collections(self):
+        self.backend.incr(self._counter_name('collection'))
+
+    def invalidate_item(self, item_id):
+        self.backend.incr(self._counter_name('item', str(item_id)))
+
+    def invalidate_all(self):
+        self.backend.incr(self._counter_name('all'))
+
+    def _invalidate_twice(self, event, func):
+        """ Call :func: now and once again when changes made by request
+        of :event: are committed and written to Elasticsearch.
+        """
+        func()
+        request = getattr(getattr(event, 'view', None), 'request', None)
+        registry = getattr(request, 'registry', None)
+        queue = getattr(registry, 'indexing_queue', None)
+
+        def after_commit():
+            # Without indexing queue, documents are indexed on flush
+            if queue is None:
+                return func()
+            queue.call_after_flush(func)
+        call_after_commit(request, after_commit)
+
+    def invalidate(self, event):
+        """ Model event subscriber that invalidates affected entries. """
+        from nefertari import events
+        if isinstance(event, (events.AfterCreate, events.AfterRegister)):
+            return self._invalidate_twice(event, self.invalidate_collections)
+
+        item_events = (
+            events.AfterUpdate, events.AfterReplace, events.AfterDelete)
+        item_id = _instance_id(event.instance)
+        if isinstance(event, item_events) and item_id is not None:
+            def invalidate():
+                self.invalidate_collections()
+                self.invalidate_item(item_id)
+            return self._invalidate_twice(event, invalidate)
+
+        self._invalidate_twice(event, self.invalidate_all)
+
+    def invalidate_related(self, event):
+        """ Event subscriber for models nested in cached documents. """
+        self._invalidate_twice(event, self.invalidate_all)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'stale': self.stale,
+            'size': len(self.backend),
+        }
+
+
+def get_cache_settings(raml_resource):
+    """ Get settings of the first `x-Cache` security scheme of
+    :raml_resource:.
+
+    :param raml_resource: Instance of ramlfications.raml.ResourceNode.
+    :returns: Dict of scheme settings or None if resource doesn't use
+        `x-Cache` scheme.
+    """
+    schemes = raml_resource.security_schemes or []
+    schemes = [sch for sch in schemes if sch.type == 'x-Cache']
+    if not schemes:
+        return None
+    return schemes[0].settings or {}
+
+
+def setup_resource_cache(config, model_cls, raml_resource,
+                         parent_model=None):
+    """ Create ResourceCache for :raml_resource: if it uses `x-Cache`
+    security scheme.
+
+    Cache invalidation subscribers are connected to write events of
+    :model_cls:, of models nested in its documents and of :parent_model:
+    as nested collections depend on parent objects.
+
+    Supported scheme settings:
+        :ttl: Entries time to live in seconds. Defaults to 60. When 0,
+            responses are not cached but concurrent identical requests
+            are still coalesced.
+        :hard_ttl: Maximum age of collections in seconds. When set,
+            collections older than `ttl` are served stale while they are
+            refreshed in background.
+        :max_size: Maximum number of cached entries. Defaults to 1000.
+        :backend: `memory` to cache entries in memory of each process or
+            `shared` to use SharedMemoryCache of application. Defaults to
+            `memory`.
+
+    :param config: Pyramid Configurator instance.
+    :param model_cls: Model class documents of which are cached.
+    :param raml_resource: Instance of ramlfications.raml.ResourceNode.
+    :param parent_model: Model class of parent resource if resource is
+        nested.
+    :returns: ResourceCache instance or None.
+    """
+    from nefertari import engine, events
+    settings = get_cache_settings(raml_resource)
+    if settings is None:
+        return None
+
+    ttl = int(settings.get('ttl', 60))
+    hard_ttl = settings.get('hard_ttl')
+    if hard_ttl is not None:
+        hard_ttl = int(hard_ttl)
+        if hard_ttl < ttl:
+            raise ValueError(
+                '`hard_ttl` of `{}` cache is less than `ttl`'.format(
+                    raml_resource.path))
+    backend_name = settings.get('backend', 'memory')
+    if backend_name == 'shared':
+        backend = get_shared_backend(config)
+    elif backend_name == 'memory':
+        max_size = int(settings.get('max_size', 1000))
+        backend = LRUCache(max_size=max_size)
+    else:
+        raise ValueError('Unknown cache backend: {}'.format(backend_name))
+    cache = ResourceCache(
+        model_cls.__name__, backend=backend, ttl=ttl, hard_ttl=hard_ttl)
+    log.info('Caching `{}` responses for {} seconds'.format(
+        raml_resource.path, ttl))
+
+    write_events = [
+        events.AfterCreate, events.AfterUpdate, events.AfterReplace,
+        events.AfterDelete, events.AfterUpdateMany,
+        events.AfterDeleteMany, events.AfterRegister,
+    ]
+    config.subscribe_to_events(
+        cache.invalidate, write_events, model=model_cls)
+    related_models = [
+        engine.get_relationship_cls(field, model_cls)
+        for field in getattr(model_cls, '_nested_relationships', None) or []]
+    if parent_model is not None:
+        related_models.append(parent_model)
+    for related_cls in related_models:
+        config.subscribe_to_events(
+            cache.invalidate_related, write_events, model=related_cls)
+
+    caches = getattr(config.registry, '_ramses_caches', None)
+    if caches is None:
+        caches = config.registry._ramses_caches = {}
+    caches[raml_resource.path] = cache
+    return cache
+
+
+def get_stats(registry):
+    """ Get hit/miss counters of all resource caches.
+
+    :param registry: Pyramid Registry instance.
+    :returns: Dict of {resource path: stats dict}.
+    """
+    caches = getattr(registry, '_ramses_caches', None) or {}
+    return {path: cache.stats() for path, cache in six.iteritems(caches)}
@@ -0,0 +1,358 @@
+"""
+Counter caches module.
+
+Counter cache is a number of items of relationship field stored in a
+field of model, e.g. number of stories of a user. Counters are updated
+incrementally by subscribers of events of requests which create, update
+or delete related items, so counts are read without loading
+relationships.
+
+In particular:
+    :CounterCache: Counter of items of relationship field
+    :counter_caches: Counter caches of application
+    :setup_counter_cache: Validate `_counter_cache` property of field
+        and connect counter event subscribers
+"""
+import logging
+from collections import Counter
+
+from nefertari import engine
+from nefertari.utils import dictset
+
+from .utils import get_events_map
+
+
+log = logging.getLogger(__name__)
+
+
+def _sqla_increment(model_cls, ids, field, delta):
+    from pyramid_sqlalchemy import Session
+    column = getattr(model_cls, model_cls.pk_field())
+    counter = getattr(model_cls, field)
+    Session().query(model_cls).filter(column.in_(ids)).update(
+        {counter: counter + delta}, synchronize_session='fetch')
+
+
+def _sqla_reload(obj):
+    from sqlalchemy.orm import object_session
+    session = object_session(obj)
+    if session is not None:
+        session.expire(obj)
+
+
+def _mongodb_increment(model_cls, ids, field, delta):
+    query = model_cls.objects(**{model_cls.pk_field() + '__in': ids})
+    query.update(**{'inc__' + field: delta})
+
+
+def _mongodb_reload(obj):
+    # Documents are loaded from the database by every query
+    pass
+
+
+""" Map of engine names to functions which atomically add a number to
+counter field of objects with given primary keys.
+"""
+incrementers = {
+    'nefertari_sqla': _sqla_increment,
+    'nefertari_mongodb': _mongodb_increment,
+}
+
+""" Map of engine names to functions which make object reload its fields
+from the database when they are accessed next time.
+"""
+reloaders = {
+    'nefertari_sqla': _sqla_reload,
+    'nefertari_mongodb': _mongodb_reload,
+}
+
+
+""" Map of (model name, field name) pairs to counter caches of fields. """
+counter_caches = {}
+
+
+class CounterCache(object):
+    """ Counter of items of relationship field.
+
+    Relationship field `field` of `parent_model` holds items of
+    `child_model`, which refer to their parents with `backref_name`
+    field. Number of items is stored in `counter_field` of parent.
+
+    Changes made to items through API are tracked by event subscribers:
+        * Counter is incremented when item is created and decremented
+          when item is deleted.
+        * Counters of old and new parents are updated when item is
+          moved to another parent.
+        * Counters of parent and previous parents of items are
+          recounted when relationship field of parent is changed.
+        * Items changed by `update_many` and `delete_many` requests
+          are loaded before the change to update counters of their
+          parents.
+
+    Counter field can't be set through API. Items changed outside of
+    API requests are not tracked. Use `reset` to recount their parents.
+    """
+    def __init__(self, parent_model, field, child_model, backref_name,
+                 counter_field, engine_name):
+        """
+        :param parent_model: Model class which has relationship field.
+        :param field: Name of relationship field.
+        :param child_model: Model class of relationship items.
+        :param backref_name: Name of backref field of items.
+        :param counter_field: Name of integer field of parent counter is
+            stored in.
+        :param engine_name: Name of nefertari engine, e.g.
+            'nefertari_sqla'.
+        """
+        self.parent_model = parent_model
+        self.field = field
+        self.child_model = child_model
+        self.backref_name = backref_name
+        self.counter_field = counter_field
+        self.increment = incrementers[engine_name]
+        self.reload = reloaders[engine_name]
+        self._state_attr = '_counter_cache_{}_{}'.format(
+            parent_model.__name__, field)
+
+    def _pk(self, model_cls, obj):
+        """ Get primary key of :obj:, which may be DB object, ES document
+        or primary key itself.
+        """
+        if isinstance(obj, dict):
+            obj = dictset(obj)
+        return getattr(obj, model_cls.pk_field(), obj)
+
+    def get_parent_ids(self, obj):
+        """ Get primary keys of parents of item :obj:. """
+        parents = getattr(obj, self.backref_name, None)
+        if parents is None:
+            return []
+        if not isinstance(parents, (list, tuple)):
+            parents = [parents]
+        return [self._pk(self.parent_model, parent) for parent in parents]
+
+    def get_child(self, instance, reload=False):
+        """ Load item :instance: from the database.
+
+        :param reload: Boolean indicating whether fields of item already
+            loaded in current session should be reloaded.
+        """
+        pk_field = self.child_model.pk_field()
+        pk = self._pk(self.child_model, instance)
+        child = self.child_model.get_item(
+            _raise_on_empty=False, **{pk_field: pk})
+        if reload and child is not None:
+            self.reload(child)
+        return child
+
+    def get_parent(self, pk):
+        pk_field = self.parent_model.pk_field()
+        return self.parent_model.get_item(
+            _raise_on_empty=False, **{pk_field: pk})
+
+    def apply(self, old_ids, new_ids, request=None):
+        """ Update counters of parents after item was moved from parents
+        :old_ids: to parents :new_ids:.
+        """
+        deltas = Counter(new_ids)
+        deltas.subtract(Counter(old_ids))
+        ids_by_delta = {}
+        for pk, delta in deltas.items():
+            if delta:
+                ids_by_delta.setdefault(delta, []).append(pk)
+        if not ids_by_delta:
+            return
+
+        for delta, ids in sorted(ids_by_delta.items()):
+            log.debug('Adding {} to `{}` of {}({})'.format(
+                delta, self.counter_field, self.parent_model.__name__,
+                ', '.join(str(pk) for pk in ids)))
+            self.increment(self.parent_model, ids, self.counter_field, delta)
+
+        # Counters are changed in the database directly, so ES documents
+        # of parents are updated explicitly
+        for pk in sorted(deltas, key=str):
+            if not deltas[pk]:
+                continue
+            parent = self.get_parent(pk)
+            update_fields = getattr(parent, '_es_update_fields', None)
+            if update_fields is not None:
+                update_fields([self.counter_field], request=request)
+            elif getattr(parent, '_index_enabled', False):
+                from nefertari.elasticsearch import ES
+                ES(parent.__class__.__name__).index(
+                    parent.to_dict(), request=request)
+
+    def reset(self, ids, request=None):
+        """ Recount items of parents with primary keys :ids:. """
+        for pk in ids:
+            parent = self.get_parent(pk)
+            if parent is None:
+                continue
+            count = len(getattr(parent, self.field, None) or [])
+            if getattr(parent, self.counter_field) != count:
+                parent.update({self.counter_field: count}, request)
+
+    def before_child_change(self, event):
+        """ Remember parents of item which is going to be updated or
+        deleted.
+        """
+        old_ids = []
+        if event.instance is not None:
+            old_ids = self.get_parent_ids(self.get_child(event.instance))
+        setattr(event.view, self._state_attr, old_ids)
+
+    def after_child_create(self, event):
+        new_ids = self.get_parent_ids(event.response)
+        self.apply([], new_ids, request=event.view.request)
+
+    def after_child_update(self, event):
+        old_ids = getattr(event.view, self._state_attr, [])
+        new_ids = []
+        if event.instance is not None:
+            child = self.get_child(event.instance, reload=True)
+            new_ids = self.get_parent_ids(child)
+        self.apply(old_ids, new_ids, request=event.view.request)
+
+    def after_child_delete(self, event):
+        old_ids = getattr(event.view, self._state_attr, [])
+        self.apply(old_ids, [], request=event.view.request)
+
+    def before_children_change(self, event):
+        """ Remember items which are going to be changed by bulk
+        request and their parents.
+
+        Items are selected the same way view of collection selects
+        them.
+        """
+        view = event.view
+        if hasattr(view, 'get_dbcollection_with_es'):
+            objects = view.get_dbcollection_with_es()
+        else:
+            objects = view.get_collection()
+        state = [(self._pk(self.child_model, obj), self.get_parent_ids(obj))
+                 for obj in objects]
+        setattr(view, self._state_attr, state)
+
+    def after_children_update(self, event):
+        state = getattr(event.view, self._state_attr, [])
+        old_ids, new_ids = [], []
+        for pk, parent_ids in state:
+            old_ids += parent_ids
+            child = self.get_child(pk, reload=True)
+            if child is not None:
+                new_ids += self.get_parent_ids(child)
+        self.apply(old_ids, new_ids, request=event.view.request)
+
+    def after_children_delete(self, event):
+        state = getattr(event.view, self._state_attr, [])
+        old_ids = [pk for _, parent_ids in state for pk in parent_ids]
+        self.apply(old_ids, [], request=event.view.request)
+
+    def protect_counter_field(self, event):
+        """ Drop value of counter field sent in request to parent.
+
+        Counter field is only changed by counter cache.
+        """
+        params = getattr(event.view, '_json_params', None)
+        if params is not None and self.counter_field in params:
+            log.debug('Ignoring `{}` of {} sent in request'.format(
+                self.counter_field, self.parent_model.__name__))
+            params.pop(self.counter_field)
+        event.fields.pop(self.counter_field, None)
+
+    def before_parent_change(self, event):
+        """ Remember current parents of items which are going to be set
+        to relationship field of parent.
+        """
+        if self.field not in event.fields:
+            return
+        items = event.fields[self.field].new_value or []
+        if not isinstance(items, (list, tuple)):
+            items = [items]
+        old_ids = set()
+        for item in items:
+            child = self.get_child(item)
+            old_ids.update(self.get_parent_ids(child))
+        setattr(event.view, self._state_attr, old_ids)
+
+    def after_parent_change(self, event):
+        """ Recount items of parent and of previous parents of its items
+        after relationship field of parent was changed.
+        """
+        if self.field not in event.fields:
+            return
+        parent = event.instance
+        if parent is None:
+            parent = event.response
+        ids = set(getattr(event.view, self._state_attr, ()))
+        if parent is not None:
+            ids.add(self._pk(self.parent_model, parent))
+        self.reset(sorted(ids, key=str), request=event.view.request)
+
+
+def setup_counter_cache(config, model_cls, field_name, schema):
+    """ Set up counter cache of relationship field :field_name: of
+    :model_cls: if `_counter_cache` property of field is set.
+
+    `_counter_cache` is a name of integer field of :model_cls: counter
+    is stored in, or true to use `<field_name>_count` field.
+
+    :param config: Pyramid Configurator instance.
+    :param model_cls: Model class which has relationship field.
+    :param field_name: Name of relationship field.
+    :param schema: Dict of model JSON schema.
+    :returns: CounterCache instance or None.
+    """
+    properties = schema.get('properties', {})
+    props = properties.get(field_name) or {}
+    counter_field = props.get('_counter_cache')
+    if not counter_field:
+        return None
+    if counter_field is True:
+        counter_field = '{}_count'.format(field_name)
+
+    db_settings = props.get('_db_settings', {})
+    document = db_settings.get('document')
+    backref_name = db_settings.get('backref_name')
+    if not (db_settings.get('type') == 'relationship' and
+            document and backref_name):
+        raise ValueError(
+            'Counter cache of `{}` requires relationship field with '
+            '`document` and `backref_name` settings'.format(field_name))
+    counter_props = properties.get(counter_field) or {}
+    counter_type = counter_props.get('_db_settings', {}).get('type')
+    if counter_type not in ('integer', 'big_integer', 'small_integer'):
+        raise ValueError('Counter field `{}` of `{}` must be of integer '
+                         'type'.format(counter_field, field_name))
+
+    child_cls = engine.get_document_cls(document)
+    counter = CounterCache(
+        model_cls, field_name, child_cls, backref_name, counter_field,
+        engine_name=config.registry.settings['nefertari.engine'])
+
+    events_map = get_events_map()
+    before, after = events_map['before'], events_map['after']
+    subscribers = [
+        (counter.before_child_change, child_cls,
+         [before['update'], before['replace'], before['delete']]),
+        (counter.after_child_create, child_cls, [after['create']]),
+        (counter.after_child_update, child_cls,
+         [after['update'], after['replace']]),
+        (counter.after_child_delete, child_cls, [after['delete']]),
+        (counter.before_children_change, child_cls,
+         [before['update_many'], before['delete_many']]),
+        (counter.after_children_update, child_cls, [after['update_many']]),
+        (counter.after_children_delete, child_cls, [after['delete_many']]),
+        (counter.protect_counter_field, model_cls,
+         [before['create'], before['update'], before['replace'],
+          before['update_many']]),
+        (counter.before_parent_change, model_cls,
+         [before['create'], before['update'], before['replace']]),
+        (counter.after_parent_change, model_cls,
+         [after['create'], after['update'], after['replace']]),
+    ]
+    for subscriber, model, events in subscribers:
+        config.subscribe_to_events(subscriber, events, model=model)
+    counter_caches[(model_cls.__name__, field_name)] = counter
+    return counter
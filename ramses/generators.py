@@ -4,6 +4,7 @@ from inflection import singularize
 
 from .views import generate_rest_view
 from .acl import generate_acl
+from .cache import setup_resource_cache
 from .utils import (
     is_dynamic_uri, resource_view_attrs, generate_model_name,
     dynamic_part_name, attr_subresource, singular_subresource,
@@ -72,12 +73,25 @@ def generate_resource(config, raml_resource, parent_resource):
 
     resource_kwargs = {}
 
+    # Set up responses cache. Only collection resources are cached
+    cache = None
+    if not (is_attr_res or is_singular):
+        parent_model = None
+        if not parent_resource.is_root:
+            parent_model = parent_resource.view.Model
+        cache = setup_resource_cache(
+            config,
+            model_cls=model_cls,
+            raml_resource=raml_resource,
+            parent_model=parent_model)
+
     # Generate ACL
     log.info('Generating ACL for `{}`'.format(route_name))
     resource_kwargs['factory'] = generate_acl(
         config,
         model_cls=model_cls,
-        raml_resource=raml_resource)
+        raml_resource=raml_resource,
+        cache=cache)
 
     # Generate dynamic part name
     if not is_singular:
@@ -95,6 +109,7 @@ def generate_resource(config, raml_resource, parent_resource):
         attrs=view_attrs,
         attr_view=is_attr_res,
         singular=is_singular,
+        cache=cache,
     )
 
     # In case of singular resource, model still needs to be generated,
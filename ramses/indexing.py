@@ -0,0 +1,1279 @@
+"""
+Elasticsearch indexing module.
+
+Nefertari engines index documents in request threads as soon as objects
+are saved, so every write waits for Elasticsearch and bursts of writes
+produce lots of single-document bulk requests. When indexing queue is
+enabled, bulk actions are queued after transaction commit and sent to
+Elasticsearch by a background thread in batches.
+
+Index may also be accessed through an alias which points to one of
+versioned physical indices, so that index can be rebuilt in background
+and swapped without search downtime.
+
+In particular:
+    :IndexingQueue: Queue of ES bulk actions flushed by a background thread
+    :merge_actions: Coalesce two bulk actions of one document
+    :setup_indexing_queue: Configure queue from settings and make
+        nefertari use it
+    :IndexAlias: Versioned physical indices behind an alias
+    :setup_index_aliases: Configure index aliases from settings
+    :rebuilding_index: Get name of index being rebuilt
+    :register_model_index: Store documents of model in its own index
+    :setup_model_indices: Create indices of models and make nefertari
+        use them
+    :get_type_mapping: Get mapping of model document type
+    :skip_indexing: Make nefertari skip indexing of a document
+    :PartitionedIndex: Time-partitioned index of append-only model
+    :setup_partitioned_indices: Create templates of partitioned indices
+        and route documents to partitions
+    :setup_mappings: Set up ES mappings of models unless disabled with
+        `mappings_setup_disabled`
+"""
+import os
+import re
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+
+import six
+from nefertari.utils import dictset, split_strip
+
+from .utils import call_after_commit
+
+
+log = logging.getLogger(__name__)
+
+
+def _action_key(action):
+    return (action.get('_index'), action.get('_type'), action.get('_id'))
+
+
+def merge_actions(old, new):
+    """ Coalesce bulk actions :old: and :new: of one document into a
+    single action.
+
+    `index` and `delete` actions replace any pending action. `update`
+    action is merged into pending `index` or `update` action.
+
+    :param old: Pending action or None.
+    :param new: Action being queued.
+    """
+    if old is None or new.get('_op_type', 'index') != 'update':
+        return new
+    old_op = old.get('_op_type', 'index')
+    if old_op not in ('index', 'update'):
+        return new
+    data_key = '_source' if old_op == 'index' else 'doc'
+    merged = dict(old)
+    merged[data_key] = dict(old[data_key])
+    merged[data_key].update(new['doc'])
+    if old_op == 'update' and 'upsert' in new:
+        merged['upsert'] = new['upsert']
+    return merged
+
+
+def is_missing_delete(error):
+    """ Check whether bulk action error :error: is a result of deleting
+    document which does not exist.
+    """
+    return error.get('delete', {}).get('status') == 404
+
+
+class IndexingQueue(object):
+    """ Queue of Elasticsearch bulk actions flushed by a background
+    thread.
+
+    Actions are coalesced per document, so many writes of one document
+    made before queue is flushed result in one action. Queue is flushed
+    when `batch_size` documents are queued or `flush_interval` seconds
+    passed since the first of them was queued.
+
+    Queue is bounded: threads which queue actions wait for free space up
+    to `timeout` seconds. If queue is still full, or if it is closed,
+    actions are executed synchronously.
+
+    Worker thread is started on first use and is restarted after fork.
+
+    Functions in `routers` are applied to each batch before it is sent,
+    e.g. to point actions to partitions of documents.
+    """
+    def __init__(self, max_size=10000, batch_size=500, flush_interval=1.0,
+                 timeout=10.0, sync_bulk=None):
+        """
+        :param max_size: Maximum number of queued documents.
+        :param batch_size: Maximum number of actions per bulk request.
+        :param flush_interval: Maximum time in seconds actions wait in
+            queue.
+        :param timeout: Time in seconds to wait for free space in full
+            queue.
+        :param sync_bulk: Function which executes bulk actions
+            synchronously. Called with `documents_actions` and `request`
+            arguments.
+        """
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.sync_bulk = sync_bulk
+        self.routers = []
+        self._actions = OrderedDict()
+        self._seqs = {}
+        self._seq = 0
+        self._batch_seq = 0
+        self._callbacks = []
+        self._in_flight = 0
+        self._closed = False
+        self._thread = None
+        self._pid = None
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._actions)
+
+    def put(self, actions):
+        """ Queue bulk :actions:.
+
+        Returns True if actions were queued and False if queue is closed
+        or remained full for `timeout` seconds.
+        """
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    return False
+                new_keys = set(
+                    _action_key(action) for action in actions
+                    if _action_key(action) not in self._actions)
+                size = len(self._actions)
+                if not size or size + len(new_keys) <= self.max_size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    log.warning('Indexing queue is full')
+                    return False
+                self._cond.wait(remaining)
+
+            self._seq += 1
+            for action in actions:
+                key = _action_key(action)
+                self._actions[key] = merge_actions(
+                    self._actions.pop(key, None), action)
+                self._seqs[key] = self._seq
+            self._ensure_worker()
+            self._cond.notify_all()
+            return True
+
+    def bulk_body(self, documents_actions, request=None):
+        """ Queue :documents_actions: once transaction of :request: is
+        committed. Actions are queued immediately if request is not
+        handled in a transaction, e.g. by engines which don't use
+        pyramid_tm.
+
+        Has the signature of `nefertari.elasticsearch._bulk_body` which
+        it replaces. Actions of requests which ask for index refresh are
+        executed synchronously.
+        """
+        if request is not None and '_refresh_index' in request.params:
+            return self.sync_bulk(documents_actions, request)
+
+        def put():
+            if not self.put(documents_actions):
+                self.sync_bulk(documents_actions, request)
+        call_after_commit(request, put)
+
+    def call_after_flush(self, func):
+        """ Call :func: once actions queued so far are executed.
+
+        :func: is called without arguments in worker thread, or right
+        away if there are no pending actions.
+        """
+        with self._cond:
+            pending = (self._actions or self._in_flight) and not (
+                self._closed or self._pid != os.getpid())
+            if pending:
+                self._callbacks.append((self._seq, func))
+        if not pending:
+            func()
+
+    def _run_callbacks(self, done_seq=None):
+        """ Call callbacks waiting for actions up to :done_seq: or all
+        the callbacks if :done_seq: is None.
+        """
+        with self._cond:
+            ready = [func for seq, func in self._callbacks
+                     if done_seq is None or seq <= done_seq]
+            self._callbacks = [
+                (seq, func) for seq, func in self._callbacks
+                if not (done_seq is None or seq <= done_seq)]
+        for func in ready:
+            try:
+                func()
+            except Exception:
+                log.exception('Indexing queue callback failed')
+
+    def _ensure_worker(self):
+        """ Start worker thread if it is not running in this process.
+
+        Must be called with `_cond` acquired.
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # Actions queued in parent process are flushed by parent
+            self._actions.clear()
+            self._seqs.clear()
+            self._callbacks = []
+            self._in_flight = 0
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name='ramses-indexing')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next_batch(self):
+        """ Wait for actions and pop a batch of them. Returns None when
+        queue is closed and empty.
+        """
+        with self._cond:
+            while not self._actions:
+                if self._closed:
+                    return None
+                self._cond.wait(self.flush_interval)
+            deadline = time.time() + self.flush_interval
+            while len(self._actions) < self.batch_size and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = []
+            while self._actions and len(batch) < self.batch_size:
+                key, action = self._actions.popitem(last=False)
+                batch.append(action)
+                self._batch_seq = self._seqs.pop(key, self._batch_seq)
+            self._in_flight += len(batch)
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            done_seq = self._batch_seq
+            try:
+                self._send(batch)
+            finally:
+                with self._cond:
+                    self._in_flight -= len(batch)
+                    self._cond.notify_all()
+                self._run_callbacks(done_seq)
+
+    def _send(self, batch):
+        from elasticsearch import helpers
+        from nefertari.elasticsearch import ES
+        try:
+            for route in self.routers:
+                batch = route(batch)
+            if not batch:
+                return
+            executed_num, errors = helpers.bulk(
+                client=ES.api, actions=batch, raise_on_error=False)
+        except Exception:
+            log.exception('Failed to execute {} queued Elasticsearch '
+                          'action(s)'.format(len(batch)))
+            return
+        log.info('Successfully executed {} queued Elasticsearch '
+                 'action(s)'.format(executed_num))
+        errors = [error for error in errors if not is_missing_delete(error)]
+        if errors:
+            log.error('Errors happened when executing queued '
+                      'Elasticsearch actions: {}'.format(errors))
+
+    def flush(self, timeout=None):
+        """ Wait until all queued actions are executed.
+
+        Returns False if actions are still queued after :timeout:
+        seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._actions or self._in_flight:
+                if self._thread is None or not self._thread.is_alive():
+                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self._cond.wait(remaining)
+            return not (self._actions or self._in_flight)
+
+    def close(self, timeout=None):
+        """ Stop accepting actions and drain the queue. Actions queued
+        after queue is closed are executed synchronously.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        drained = self.flush(timeout)
+        self._run_callbacks()
+        if not drained:
+            log.warning('{} queued Elasticsearch action(s) were not '
+                        'executed'.format(len(self._actions)))
+        return drained
+
+
+def setup_indexing_queue(config):
+    """ Setup indexing queue if it is enabled and make nefertari use it.
+
+    All bulk actions of nefertari ES wrapper are executed by
+    module-level `nefertari.elasticsearch._bulk_body` function, which is
+    replaced by `IndexingQueue.bulk_body`. Queue is drained when process
+    exits.
+
+    Must be called before `_bulk_body` is wrapped by index aliases, so
+    that actions are queued after they are duplicated. Actions of
+    partitioned indices are routed when queue is flushed.
+
+    Supported settings:
+        :indexing_queue.enable: Boolean. Defaults to false.
+        :indexing_queue.max_size: Maximum number of queued documents.
+            Defaults to 10000.
+        :indexing_queue.batch_size: Maximum number of actions per bulk
+            request. Defaults to 500.
+        :indexing_queue.flush_interval: Maximum time in seconds actions
+            wait in queue. Defaults to 1.
+        :indexing_queue.timeout: Time in seconds writers wait for free
+            space in full queue before indexing synchronously. Defaults
+            to 10.
+
+    :param config: Pyramid Configurator instance.
+    """
+    settings = dictset(config.registry.settings)
+    if not settings.asbool('indexing_queue.enable'):
+        return None
+
+    from nefertari import elasticsearch
+    queue = IndexingQueue(
+        max_size=settings.asint('indexing_queue.max_size', 10000),
+        batch_size=settings.asint('indexing_queue.batch_size', 500),
+        flush_interval=settings.asfloat('indexing_queue.flush_interval', 1),
+        timeout=settings.asfloat('indexing_queue.timeout', 10),
+        sync_bulk=elasticsearch._bulk_body)
+    elasticsearch._bulk_body = queue.bulk_body
+    config.registry.indexing_queue = queue
+    atexit.register(queue.close)
+    log.info('Elasticsearch indexing queue is enabled')
+    return queue
+
+
+def _not_found_errors():
+    from nefertari.json_httpexceptions import JHTTPNotFound
+    from nefertari.elasticsearch import IndexNotFoundException
+    return (IndexNotFoundException, JHTTPNotFound)
+
+
+class IndexAlias(object):
+    """ Versioned physical indices behind an alias.
+
+    Application reads and writes ES documents using alias `name`, which
+    points to physical index `<name>_v<version>`. Index is rebuilt into
+    a new version, while the current one keeps serving requests.
+
+    During rebuild, second alias `<name>_building` points to the new
+    index, and application processes write documents to both indices.
+    Processes check whether the rebuild is running every
+    `check_interval` seconds. Once the new index is filled, both aliases
+    are updated in one atomic request.
+    """
+    VERSION_RE = re.compile(r'_v([0-9]+)$')
+
+    def __init__(self, name, check_interval=5):
+        """
+        :param name: Alias name.
+        :param check_interval: Time in seconds rebuild status is cached
+            for.
+        """
+        self.name = name
+        self.building_alias = name + '_building'
+        self.check_interval = check_interval
+        self.sync_bulk = None
+        self._building = None
+        self._checked_at = None
+
+    def version_name(self, version):
+        return '{}_v{}'.format(self.name, version)
+
+    def _get_indices(self, alias):
+        from nefertari.elasticsearch import ES
+        try:
+            return sorted(ES.api.indices.get_alias(name=alias).keys())
+        except _not_found_errors():
+            return []
+
+    def current_index(self):
+        """ Get name of physical index alias points to. """
+        indices = self._get_indices(self.name)
+        return indices[0] if indices else None
+
+    def building_index(self):
+        """ Get name of index being rebuilt. """
+        indices = self._get_indices(self.building_alias)
+        return indices[0] if indices else None
+
+    def get_version(self, index_name):
+        match = self.VERSION_RE.search(index_name or '')
+        return int(match.group(1)) if match else 0
+
+    def create(self, body=None):
+        """ Create first version of index and point alias to it, unless
+        alias already exists.
+
+        Returns False if index named like alias already exists.
+        """
+        from nefertari.elasticsearch import ES
+        if self.current_index() is not None:
+            return True
+        if _index_exists(self.name):
+            log.warning('Index `{}` already exists and is not an alias. '
+                        'Rebuild it to start using aliases'.format(self.name))
+            return False
+        index_name = self.version_name(1)
+        log.info('Creating index `{}` with alias `{}`'.format(
+            index_name, self.name))
+        ES.api.indices.create(index=index_name, body=body)
+        ES.api.indices.put_alias(index=index_name, name=self.name)
+        return True
+
+    def start_rebuild(self, models, body=None):
+        """ Create new version of index with mappings of :models: and
+        start writing documents to it.
+
+        If rebuild is already running, its index is returned, so
+        interrupted rebuild may be resumed.
+
+        :param models: List of model classes documents of which are
+            stored in index.
+        :param body: Body of index creation request, e.g. settings.
+        :returns: Name of the new index.
+        """
+        from nefertari.elasticsearch import ES
+        index_name = self.building_index()
+        if index_name is not None:
+            log.info('Resuming rebuild of index `{}`'.format(index_name))
+            return index_name
+
+        current = self.current_index()
+        index_name = self.version_name(self.get_version(current) + 1)
+        log.info('Creating index `{}`'.format(index_name))
+        ES.api.indices.create(index=index_name, body=body)
+        for model_cls in models:
+            es = ES(model_cls.__name__, index_name=index_name)
+            es.put_mapping(body=get_type_mapping(model_cls))
+        ES.api.indices.put_alias(index=index_name, name=self.building_alias)
+        return index_name
+
+    def finish_rebuild(self, index_name, delete_old=False):
+        """ Atomically point alias to :index_name: and stop writing
+        documents to the old index.
+
+        :param index_name: Name of rebuilt index.
+        :param delete_old: Boolean indicating whether old index should be
+            deleted.
+        """
+        from nefertari.elasticsearch import ES
+        actions = [
+            {'remove': {'index': index_name, 'alias': self.building_alias}},
+            {'add': {'index': index_name, 'alias': self.name}},
+        ]
+        old_index = self.current_index()
+        if old_index is not None:
+            actions.insert(
+                0, {'remove': {'index': old_index, 'alias': self.name}})
+        elif _index_exists(self.name):
+            # Index named like alias has to be removed before alias is
+            # created
+            ES.api.indices.delete(index=self.name)
+        log.info('Pointing alias `{}` to index `{}`'.format(
+            self.name, index_name))
+        ES.api.indices.update_aliases(body={'actions': actions})
+        if delete_old and old_index is not None:
+            log.info('Deleting index `{}`'.format(old_index))
+            ES.api.indices.delete(index=old_index)
+
+    def rebuilding_index(self):
+        """ Get name of index being rebuilt. Result is cached for
+        `check_interval` seconds.
+        """
+        now = time.time()
+        expired = (self._checked_at is None or
+                   now - self._checked_at >= self.check_interval)
+        if expired:
+            self._building = self.building_index()
+            self._checked_at = now
+        return self._building
+
+    def bulk_body(self, documents_actions, request=None):
+        """ Duplicate bulk actions on documents of alias to index being
+        rebuilt.
+
+        Documents may not be copied to the new index yet, so duplicated
+        delete actions are sent separately and documents which are not
+        found are ignored. Reindexing script removes documents of rows
+        deleted after they were read from the database.
+
+        Has the signature of `nefertari.elasticsearch._bulk_body` which
+        it replaces.
+        """
+        building = self.rebuilding_index()
+        if building is None:
+            return self.sync_bulk(documents_actions, request)
+        duplicates, deletes = [], []
+        for action in documents_actions:
+            if action.get('_index') == self.name:
+                duplicate = dict(action)
+                duplicate['_index'] = building
+                if duplicate.get('_op_type') == 'delete':
+                    deletes.append(duplicate)
+                else:
+                    duplicates.append(duplicate)
+        result = self.sync_bulk(
+            list(documents_actions) + duplicates, request)
+        if deletes:
+            self._delete_duplicates(deletes, request)
+        return result
+
+    def _delete_duplicates(self, deletes, request=None):
+        from elasticsearch.helpers import BulkIndexError
+        try:
+            self.sync_bulk(deletes, request)
+        except BulkIndexError as ex:
+            errors = [
+                error for error in ex.errors
+                if not is_missing_delete(error)]
+            if errors:
+                raise
+            log.debug('{} deleted document(s) are not in index being '
+                      'rebuilt yet'.format(len(ex.errors)))
+
+
+""" Map of model names to names of ES indices documents of models are
+stored in. Only contains models which don't use default index.
+"""
+model_indices = {}
+
+""" Map of names of ES indices of models to their settings. """
+index_settings = {}
+
+""" Names of index settings which can't be changed on existing index. """
+STATIC_SETTINGS = ('number_of_shards', 'analysis')
+
+""" Index aliases of application by name, if aliases are enabled. """
+_index_aliases = {}
+
+""" Original `ES.__init__` of nefertari. """
+_es_init = None
+
+""" Original `ES.put_mapping` of nefertari. """
+_es_put_mapping = None
+
+""" Original `ES.index` and `ES.index_relations` of nefertari. """
+_es_index = None
+
+""" Documents indexing of which is skipped in current thread. """
+_skipped = threading.local()
+
+""" Whether ES mappings are set up when application is generated. """
+_mappings_enabled = True
+
+
+def _index_exists(index_name):
+    from nefertari.elasticsearch import ES
+    try:
+        return bool(ES.api.indices.exists([index_name]))
+    except _not_found_errors():
+        return False
+
+
+def register_model_index(model_name, index_name, settings=None):
+    """ Store documents of model :model_name: in ES index :index_name:.
+
+    :param model_name: String name of model.
+    :param index_name: String name of index.
+    :param settings: Dict of index settings, e.g. number_of_shards.
+    """
+    model_indices[model_name] = index_name
+    index_settings.setdefault(index_name, {}).update(settings or {})
+
+
+def get_index_name(source, default):
+    """ Get name of ES index documents of :source: are stored in.
+
+    :param source: Model name or comma-separated model names.
+    :param default: Name of default index.
+    :returns: Index name. Names of different indices of multiple models
+        are comma-separated.
+    """
+    indices = []
+    for model_name in split_strip(source or ''):
+        index_name = model_indices.get(model_name, default)
+        if index_name not in indices:
+            indices.append(index_name)
+    return ','.join(indices) or default
+
+
+def get_index_body(index_name):
+    """ Get body of creation request of index :index_name:. """
+    settings = index_settings.get(index_name)
+    return {'settings': settings} if settings else None
+
+
+def get_index_models(index_name, default):
+    """ Get indexed model classes documents of which are stored in
+    index :index_name:.
+
+    :param default: Name of default index.
+    """
+    from nefertari import engine
+    models = engine.get_document_classes()
+    return [
+        model_cls for model_name, model_cls in sorted(models.items())
+        if getattr(model_cls, '_index_enabled', False) and
+        model_indices.get(model_name, default) == index_name]
+
+
+def _route_es_wrapper():
+    """ Make nefertari ES wrapper use indices of models by default. """
+    global _es_init
+    from nefertari.elasticsearch import ES
+    if _es_init is not None:
+        return
+    _es_init = ES.__init__
+
+    def __init__(self, source='', index_name=None, chunk_size=None):
+        if index_name is None:
+            index_name = get_index_name(source, self.settings.index_name)
+        _es_init(self, source=source, index_name=index_name,
+                 chunk_size=chunk_size)
+    ES.__init__ = __init__
+
+
+def get_type_mapping(model_cls):
+    """ Get ES mapping of document type of :model_cls:.
+
+    Unlike `model_cls.get_es_mapping()`, includes `_source` mapping of
+    model, which is not valid in mappings of nested documents.
+    """
+    return _add_source_mapping(model_cls, model_cls.get_es_mapping())
+
+
+def _add_source_mapping(model_cls, mapping):
+    get_source_mapping = getattr(model_cls, 'get_es_source_mapping', None)
+    source = get_source_mapping() if get_source_mapping else None
+    if not source:
+        return mapping
+    mapping = dict(mapping)
+    mapping[model_cls.__name__] = dict(
+        mapping[model_cls.__name__], _source=source)
+    return mapping
+
+
+def _source_mapping_wrapper():
+    """ Make nefertari ES wrapper put `_source` mappings of models along
+    with mappings of their document types.
+    """
+    global _es_put_mapping
+    from nefertari.elasticsearch import ES
+    if _es_put_mapping is not None:
+        return
+    _es_put_mapping = ES.put_mapping
+
+    def put_mapping(self, body, **kwargs):
+        from nefertari import engine
+        type_mapping = body.get(self.doc_type)
+        if type_mapping is not None and '_source' not in type_mapping:
+            try:
+                model_cls = engine.get_document_cls(self.doc_type)
+            except ValueError:
+                model_cls = None
+            if model_cls is not None:
+                body = _add_source_mapping(model_cls, body)
+        return _es_put_mapping(self, body=body, **kwargs)
+    ES.put_mapping = put_mapping
+
+
+def _skipped_documents():
+    documents = getattr(_skipped, 'documents', None)
+    if documents is None:
+        documents = _skipped.documents = {}
+    return documents
+
+
+def _skip_index_wrapper():
+    """ Make nefertari ES wrapper skip indexing of documents passed to
+    `skip_indexing` and of their related documents.
+    """
+    global _es_index
+    from nefertari.elasticsearch import ES
+    if _es_index is not None:
+        return
+    _es_index = (ES.index, ES.__dict__['index_relations'].__func__)
+    es_index, es_index_relations = _es_index
+
+    def index(self, documents, request=None, **kwargs):
+        skipped = _skipped_documents()
+        if skipped:
+            if not isinstance(documents, list):
+                documents = [documents]
+            kept = []
+            for document in documents:
+                key = (document.get('_type', self.doc_type),
+                       six.text_type(document.get('_pk')))
+                if key in skipped:
+                    skipped[key]['document'] = document
+                else:
+                    kept.append(document)
+            documents = kept
+        return es_index(self, documents, request=request, **kwargs)
+
+    def index_relations(cls, db_obj, request=None, **kwargs):
+        skipped = _skipped_documents()
+        if skipped:
+            pk = getattr(db_obj, db_obj.pk_field(), None)
+            if (type(db_obj).__name__, six.text_type(pk)) in skipped:
+                return
+        return es_index_relations(cls, db_obj, request=request, **kwargs)
+
+    ES.index = index
+    ES.index_relations = classmethod(index_relations)
+
+
+@contextmanager
+def skip_indexing(model_name, pk):
+    """ Make nefertari skip indexing of document of model :model_name:
+    with primary key :pk: and of documents related to it in current
+    thread.
+
+    Yields a dict which gets document engine tried to index under
+    `document` key.
+    """
+    _skip_index_wrapper()
+    skipped = _skipped_documents()
+    key = (model_name, six.text_type(pk))
+    skipped[key] = {}
+    try:
+        yield skipped[key]
+    finally:
+        skipped.pop(key, None)
+
+
+def setup_type_mappings(config):
+    """ Make mappings of document types put by nefertari, e.g. by
+    `ES.setup_mappings`, include `_source` mappings of models.
+
+    :param config: Pyramid Configurator instance.
+    """
+    _source_mapping_wrapper()
+
+
+def setup_model_indices(config):
+    """ Create ES indices of models and make nefertari use them.
+
+    Indices which don't exist are created with their settings. Settings
+    which may be changed on existing index are applied to existing
+    indices.
+
+    Must be called after nefertari ES wrapper is set up.
+
+    :param config: Pyramid Configurator instance.
+    """
+    from nefertari.elasticsearch import ES
+    if not model_indices:
+        return
+    _route_es_wrapper()
+    for index_name, settings in sorted(index_settings.items()):
+        if not _index_exists(index_name):
+            log.info('Creating index `{}`'.format(index_name))
+            ES.api.indices.create(
+                index=index_name, body=get_index_body(index_name))
+            continue
+        dynamic = {
+            key: value for key, value in settings.items()
+            if key not in STATIC_SETTINGS}
+        if dynamic:
+            ES.api.indices.put_settings(index=index_name, body=dynamic)
+
+
+def setup_mappings():
+    """ Set up ES mappings of all indexed models.
+
+    Skipped when application is generated within
+    `mappings_setup_disabled` block.
+    """
+    from nefertari.elasticsearch import ES
+    if not _mappings_enabled:
+        log.info('Skipping setup of ES mappings')
+        return
+    ES.setup_mappings()
+
+
+@contextmanager
+def mappings_setup_disabled():
+    """ Don't set up ES mappings of application generated within this
+    block.
+
+    Used by scripts which rebuild indices, as mappings of models may
+    conflict with mappings of current indices.
+    """
+    global _mappings_enabled
+    enabled = _mappings_enabled
+    _mappings_enabled = False
+    try:
+        yield
+    finally:
+        _mappings_enabled = enabled
+
+
+def rebuilding_index():
+    """ Get name of an application index being rebuilt. Returns None if
+    index aliases are not enabled or rebuild is not running.
+    """
+    for name, alias in sorted(_index_aliases.items()):
+        index_name = alias.rebuilding_index()
+        if index_name is not None:
+            return index_name
+    return None
+
+
+def setup_index_aliases(config):
+    """ Setup aliases of ES indices if aliases are enabled.
+
+    Aliases are named after `elasticsearch.index_name` setting and
+    indices of models. Unless alias exists, first version of its index is
+    created. Module-level `nefertari.elasticsearch._bulk_body` is
+    wrapped with `IndexAlias.bulk_body` of each alias.
+
+    Must be called after models are generated and before nefertari
+    creates index.
+
+    Supported settings:
+        :index_aliases.enable: Boolean. Defaults to false.
+        :index_aliases.check_interval: Time in seconds application
+            processes cache rebuild status for. Defaults to 5.
+
+    :param config: Pyramid Configurator instance.
+    """
+    settings = dictset(config.registry.settings)
+    if not settings.asbool('index_aliases.enable'):
+        return None
+
+    from nefertari import elasticsearch
+    from nefertari.elasticsearch import ES
+    ES.setup(settings)
+    check_interval = settings.asfloat('index_aliases.check_interval', 5)
+    names = [ES.settings.index_name] + sorted(index_settings)
+    for name in names:
+        alias = IndexAlias(name, check_interval=check_interval)
+        alias.create(body=get_index_body(name))
+        alias.sync_bulk = elasticsearch._bulk_body
+        elasticsearch._bulk_body = alias.bulk_body
+        _index_aliases[name] = alias
+    config.registry.index_aliases = _index_aliases
+    return _index_aliases
+
+
+""" Query string range and comparison of date field values. """
+_RANGE_RE = re.compile(r'^[\[{]\s*(\S+)\s+TO\s+(\S+)\s*[\]}]$')
+_COMPARISON_RE = re.compile(r'^(>=|<=|>|<)\s*(.+)$')
+
+
+_DATE_RE = re.compile(
+    r'^(\d{4})(?:-(\d{2})(?:-(\d{2})'
+    r'(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?'
+    r')?)?$')
+
+
+def _parse_date(value):
+    """ Parse date of string :value:, e.g. '2015-01-31T10:00:00Z',
+    '2015-01' or '2015'. Time part is ignored.
+
+    Returns None if :value: is not a valid date in one of these formats.
+    """
+    match = _DATE_RE.match(value.strip().strip('"'))
+    if not match:
+        return None
+    year, month, day = match.groups()
+    try:
+        return datetime(int(year), int(month or 1), int(day or 1))
+    except ValueError:
+        return None
+
+
+def _parse_range(value):
+    """ Get range of dates matched by query string value :value: of date
+    field, e.g. '[2015-01-01 TO 2015-02-01]', '>=2015-01-01' or
+    '2015-01-01'.
+
+    :returns: Tuple of (start, end) dates. Open or unknown bounds are
+        None.
+    """
+    if isinstance(value, (list, tuple)):
+        ranges = [_parse_range(item) for item in value]
+        starts = [start for start, _ in ranges]
+        ends = [end for _, end in ranges]
+        return (
+            None if None in starts else min(starts),
+            None if None in ends else max(ends))
+
+    value = six.text_type(value).strip()
+    match = _RANGE_RE.match(value)
+    if match:
+        start, end = match.groups()
+        return (
+            None if start == '*' else _parse_date(start),
+            None if end == '*' else _parse_date(end))
+    match = _COMPARISON_RE.match(value)
+    if match:
+        operator, value = match.groups()
+        if operator.startswith('>'):
+            return _parse_date(value), None
+        return None, _parse_date(value)
+    value = _parse_date(value)
+    return value, value
+
+
+class PartitionedIndex(object):
+    """ Time-partitioned ES index of append-only model.
+
+    Documents are stored in partitions named `<name>-<period>`, e.g.
+    `myapp_event-2015.01.31` or `myapp_event-2015.01`, by the value of
+    datetime field `field`. Partitions are created by Elasticsearch from
+    index template when the first document is written to them. Alias
+    `name` points to all open partitions.
+
+    Searches filtered by `field` only query partitions overlapping the
+    filter. Partitions older than `retention` periods are closed or
+    deleted.
+    """
+    INTERVALS = {
+        'daily': '%Y.%m.%d',
+        'monthly': '%Y.%m',
+    }
+    RETENTION_ACTIONS = ('close', 'delete')
+
+    def __init__(self, name, model_name, field, interval='daily',
+                 retention=None, retention_action='close', settings=None):
+        """
+        :param name: Name of alias of partitions.
+        :param model_name: String name of partitioned model.
+        :param field: Name of datetime field documents are partitioned
+            by.
+        :param interval: Partitioning interval. One of 'daily' and
+            'monthly'.
+        :param retention: Number of latest partitions to keep open.
+            Defaults to keeping all partitions.
+        :param retention_action: What to do with expired partitions. One
+            of 'close' and 'delete'.
+        :param settings: Dict of settings of partitions, e.g.
+            number_of_shards.
+        """
+        if interval not in self.INTERVALS:
+            raise ValueError('Unknown partitioning interval `{}`. Valid '
+                             'intervals are: {}'.format(
+                                 interval, ', '.join(sorted(self.INTERVALS))))
+        if retention_action not in self.RETENTION_ACTIONS:
+            raise ValueError('Unknown partitions retention action `{}`. '
+                             'Valid actions are: {}'.format(
+                                 retention_action,
+                                 ', '.join(self.RETENTION_ACTIONS)))
+        self.name = name
+        self.model_name = model_name
+        self.field = field
+        self.interval = interval
+        self.retention = retention
+        self.retention_action = retention_action
+        self.settings = settings or {}
+        self.date_format = self.INTERVALS[interval]
+        self.sync_bulk = None
+        self._partitions = set()
+
+    def partition_name(self, value):
+        """ Get name of partition :value: date belongs to. """
+        return '{}-{}'.format(self.name, value.strftime(self.date_format))
+
+    def partition_date(self, index_name):
+        """ Get start date of partition named :index_name:. Returns None
+        if index is not a partition.
+        """
+        prefix = self.name + '-'
+        if not index_name.startswith(prefix):
+            return None
+        try:
+            return datetime.strptime(
+                index_name[len(prefix):], self.date_format)
+        except ValueError:
+            return None
+
+    def period_start(self, value):
+        """ Get start date of partition :value: date belongs to. """
+        return datetime.strptime(
+            value.strftime(self.date_format), self.date_format)
+
+    def get_partitions(self, expand_wildcards='open'):
+        """ Get existing partitions.
+
+        :param expand_wildcards: Whether to get 'open', 'closed' or 'all'
+            partitions.
+        :returns: Dict of partition names to their start dates.
+        """
+        from nefertari.elasticsearch import ES
+        try:
+            indices = ES.api.indices.get_settings(
+                index=self.name + '-*', expand_wildcards=expand_wildcards)
+        except _not_found_errors():
+            return {}
+        partitions = {}
+        for index_name in indices:
+            start = self.partition_date(index_name)
+            if start is not None:
+                partitions[index_name] = start
+        return partitions
+
+    def get_document_date(self, document):
+        """ Get value of partitioning field of :document:. Documents
+        without valid value go to the current partition.
+        """
+        value = document.get(self.field)
+        if isinstance(value, six.string_types):
+            value = _parse_date(value)
+        if not isinstance(value, date):
+            log.warning('Document of `{}` has no valid `{}` value, using '
+                        'current partition'.format(
+                            self.model_name, self.field))
+            value = datetime.utcnow()
+        return value
+
+    def search_index(self, params):
+        """ Get partitions which may contain documents matched by query
+        params :params:.
+
+        :returns: Comma-separated names of partitions, alias name if all
+            partitions are matched or None if no partition is matched.
+        """
+        value = params.get(self.field)
+        if value is None:
+            return self.name
+        start, end = _parse_range(value)
+        if start is None and end is None:
+            return self.name
+        partitions = self.get_partitions()
+        if start is not None:
+            start = self.period_start(start)
+        if end is not None:
+            end = self.period_start(end)
+        names = sorted(
+            index_name for index_name, date_ in partitions.items()
+            if (start is None or date_ >= start) and
+            (end is None or date_ <= end))
+        if len(names) == len(partitions):
+            return self.name
+        return ','.join(names) or None
+
+    def find_indices(self, ids):
+        """ Find partitions documents with IDs :ids: are stored in.
+
+        :returns: Dict of document IDs to partition names.
+        """
+        from nefertari.elasticsearch import ES
+        try:
+            data = ES.api.search(
+                index=self.name, doc_type=ES.src2type(self.model_name),
+                body={'query': {'ids': {'values': ids}}},
+                size=len(ids), _source=False)
+        except _not_found_errors():
+            return {}
+        return {hit['_id']: hit['_index'] for hit in data['hits']['hits']}
+
+    def route_actions(self, documents_actions):
+        """ Point bulk actions on documents of model to their partitions.
+
+        Index actions are routed by value of partitioning field. Other
+        actions are routed to partitions documents are found in, and are
+        dropped if documents are not found. As documents become
+        searchable once index is refreshed, partitions are refreshed and
+        searched again if some documents are not found.
+        """
+        from nefertari.elasticsearch import ES
+        doc_type = ES.src2type(self.model_name)
+        actions, lookup = [], []
+        for action in documents_actions:
+            if (action.get('_index') != self.name or
+                    action.get('_type') != doc_type):
+                actions.append(action)
+            elif action.get('_op_type', 'index') in ('index', 'create'):
+                value = self.get_document_date(action.get('_source', {}))
+                action = dict(action, _index=self.partition_name(value))
+                actions.append(action)
+            else:
+                lookup.append(action)
+
+        if lookup:
+            ids = [six.text_type(action['_id']) for action in lookup]
+            indices = self.find_indices(ids)
+            missing = [pk for pk in ids if pk not in indices]
+            if missing:
+                ES.api.indices.refresh(index=self.name)
+                indices.update(self.find_indices(missing))
+            for action in lookup:
+                index_name = indices.get(six.text_type(action['_id']))
+                if index_name is None and 'upsert' in action:
+                    # Missing document is indexed from `upsert`
+                    value = self.get_document_date(action['upsert'])
+                    index_name = self.partition_name(value)
+                if index_name is None:
+                    log.warning('{}({}) document is not found in `{}` '
+                                'partitions, skipping `{}` action'.format(
+                                    self.model_name, action['_id'],
+                                    self.name, action.get('_op_type')))
+                    continue
+                actions.append(dict(action, _index=index_name))
+        return actions
+
+    def route(self, documents_actions):
+        """ Route bulk actions to partitions. Old partitions are expired
+        when documents are written to a new partition.
+        """
+        actions = self.route_actions(documents_actions)
+        partitions = set(
+            action['_index'] for action in actions
+            if self.partition_date(action['_index']) is not None)
+        if not partitions.issubset(self._partitions):
+            self._partitions.update(partitions)
+            self.expire()
+        return actions
+
+    def bulk_body(self, documents_actions, request=None):
+        """ Route bulk actions to partitions and execute them.
+
+        Has the signature of `nefertari.elasticsearch._bulk_body` which
+        it replaces.
+        """
+        actions = self.route(documents_actions)
+        if actions:
+            return self.sync_bulk(actions, request)
+
+    def setup(self, mapping=None):
+        """ Put index template of partitions, create current partition
+        and expire old ones.
+
+        :param mapping: ES mapping of partitioned model.
+        """
+        from nefertari.elasticsearch import ES
+        body = {
+            'template': self.name + '-*',
+            'aliases': {self.name: {}},
+        }
+        if self.settings:
+            body['settings'] = self.settings
+        if mapping:
+            body['mappings'] = mapping
+        ES.api.indices.put_template(name=self.name, body=body)
+        current = self.partition_name(datetime.utcnow())
+        # Partition may be created concurrently by another process
+        ES.api.indices.create(index=current, ignore=400)
+        self._partitions.add(current)
+        self.expire()
+
+    def expire(self, now=None):
+        """ Close or delete partitions older than `retention` periods.
+
+        Closed partitions are removed from alias, so searches don't fail.
+
+        :returns: List of names of expired partitions.
+        """
+        from nefertari.elasticsearch import ES
+        if not self.retention:
+            return []
+        oldest = self.period_start(now or datetime.utcnow())
+        if self.interval == 'monthly':
+            months = oldest.year * 12 + oldest.month - self.retention
+            oldest = datetime(months // 12, months % 12 + 1, 1)
+        else:
+            oldest -= timedelta(days=self.retention - 1)
+
+        delete = self.retention_action == 'delete'
+        partitions = self.get_partitions('all' if delete else 'open')
+        expired = sorted(
+            index_name for index_name, start in partitions.items()
+            if start < oldest)
+        if not expired:
+            return []
+        log.info('{} expired partitions: {}'.format(
+            'Deleting' if delete else 'Closing', ', '.join(expired)))
+        try:
+            if delete:
+                ES.api.indices.delete(index=','.join(expired))
+            else:
+                ES.api.indices.update_aliases(body={'actions': [
+                    {'remove': {'index': index_name, 'alias': self.name}}
+                    for index_name in expired]})
+                ES.api.indices.close(index=','.join(expired))
+        except Exception:
+            log.exception('Failed to expire partitions of `{}`'.format(
+                self.name))
+            return []
+        return expired
+
+
+""" Map of model names to time-partitioned indices of their documents. """
+partitioned_indices = {}
+
+
+def register_partitioned_index(partitioned):
+    """ Store documents of model in time-partitioned index.
+
+    :param partitioned: PartitionedIndex instance.
+    """
+    partitioned_indices[partitioned.model_name] = partitioned
+    model_indices[partitioned.model_name] = partitioned.name
+
+
+def get_partitioned_index(model_name):
+    """ Get PartitionedIndex of model named :model_name: or None if
+    model is not partitioned.
+    """
+    return partitioned_indices.get(model_name)
+
+
+def setup_partitioned_indices(config):
+    """ Create templates and current partitions of partitioned indices
+    and make nefertari write documents to partitions.
+
+    Module-level `nefertari.elasticsearch._bulk_body` is wrapped with
+    `PartitionedIndex.bulk_body` of each partitioned index. If indexing
+    queue is enabled, actions are routed when queue is flushed instead,
+    so that updates and deletes of documents which are queued but not
+    sent yet are routed to their partitions.
+
+    Must be called after database is set up and before ES mappings are
+    set up.
+
+    :param config: Pyramid Configurator instance.
+    """
+    from nefertari import engine, elasticsearch
+    queue = getattr(config.registry, 'indexing_queue', None)
+    for model_name, partitioned in sorted(partitioned_indices.items()):
+        model_cls = engine.get_document_cls(model_name)
+        partitioned.setup(mapping=get_type_mapping(model_cls))
+        if queue is not None:
+            queue.routers.append(partitioned.route)
+            partitioned.sync_bulk = queue.sync_bulk
+            queue.sync_bulk = partitioned.bulk_body
+        else:
+            partitioned.sync_bulk = elasticsearch._bulk_body
+            elasticsearch._bulk_body = partitioned.bulk_body
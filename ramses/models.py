@@ -1,5 +1,7 @@
+import copy
 import logging
 
+import six
 from nefertari import engine
 from inflection import pluralize
 
@@ -82,6 +84,354 @@ def prepare_relationship(config, model_name, raml_resource):
         setup_data_model(config, res, model_name)
 
 
+class ESSettingsMixin(object):
+    """ Model mixin which applies `_es_settings` of schema properties to
+    ES mapping of model.
+
+    `_es_settings` is a map of field names to dicts of ES mapping
+    parameters which are merged into mappings of fields, e.g.
+    {"index": "not_analyzed"} or {"doc_values": false}. Special
+    `_source` key set to false excludes field from `_source`.
+
+    `_source` settings are only valid in mappings of document types, so
+    they are returned by `get_es_source_mapping` instead of being part
+    of `get_es_mapping`, which is also used to map nested documents.
+    """
+    _es_settings = {}
+
+    @classmethod
+    def get_es_mapping(cls, *args, **kwargs):
+        mapping = super(ESSettingsMixin, cls).get_es_mapping(
+            *args, **kwargs)
+        properties = mapping[cls.__name__].setdefault('properties', {})
+        for field_name, settings in cls._es_settings.items():
+            settings = dict(settings)
+            settings.pop('_source', None)
+            if settings:
+                properties.setdefault(field_name, {}).update(settings)
+        return mapping
+
+    @classmethod
+    def get_es_source_mapping(cls):
+        """ Get `_source` mapping of model document type or None if
+        all fields are stored in `_source`.
+        """
+        excludes = sorted(
+            field_name for field_name, settings in cls._es_settings.items()
+            if settings.get('_source', True) is False)
+        if excludes:
+            return {'excludes': excludes}
+
+
+class PartialIndexMixin(object):
+    """ Model mixin which sends only changed fields of document to ES
+    when object is updated.
+
+    Added to models which set `_es_partial_updates` schema property.
+
+    Engine reindexes whole document along with its nested relationships
+    on every update. Instead, values of non-relationship fields are
+    compared before and after update and only changed fields are sent to
+    ES using partial update. Reindexing is skipped completely when all
+    changed fields are excluded from index, i.e. have `_es_settings` with
+    `_source` set to false and either `index` set to "no" or `enabled`
+    set to false. Document produced by engine is sent as `upsert` of
+    partial update, so missing documents are indexed in full.
+
+    Updates which change relationship fields, updates made while index
+    is being rebuilt and updates of models which have indexed fields
+    excluded from `_source` are indexed by engine as usual. ES rebuilds
+    updated documents from their `_source`, so such fields would be
+    lost from index.
+    """
+    @classmethod
+    def _es_excluded_fields(cls):
+        """ Get names of fields which are neither indexed nor stored in
+        `_source` of ES documents.
+        """
+        excluded = set()
+        for field_name, settings in getattr(cls, '_es_settings', {}).items():
+            if settings.get('_source', True) is not False:
+                continue
+            not_indexed = (
+                settings.get('index') == 'no' or
+                settings.get('enabled') is False)
+            if not_indexed:
+                excluded.add(field_name)
+        return excluded
+
+    @classmethod
+    def _es_partial_updates_safe(cls):
+        """ Check whether all indexed fields are stored in `_source`. """
+        source_excluded = set(
+            field_name
+            for field_name, settings in getattr(
+                cls, '_es_settings', {}).items()
+            if settings.get('_source', True) is False)
+        return not (source_excluded - cls._es_excluded_fields())
+
+    @classmethod
+    def _es_partial_update_allowed(cls):
+        """ Check whether documents of model may be updated partially.
+
+        Documents may be missing from index being rebuilt, so they
+        can't be updated partially while index is rebuilt.
+        """
+        from .indexing import rebuilding_index
+        return (rebuilding_index() is None and
+                cls._es_partial_updates_safe())
+
+    def _es_fields_values(self):
+        """ Get copies of values of non-relationship fields. """
+        model_cls = self.__class__
+        return {
+            field: copy.deepcopy(getattr(self, field, None))
+            for field in model_cls.native_fields()
+            if not engine.is_relationship_field(field, model_cls)}
+
+    def update(self, params, request=None):
+        from .indexing import skip_indexing
+        model_cls = self.__class__
+        relationships = [
+            field for field in params
+            if engine.is_relationship_field(field, model_cls)]
+        if relationships or not model_cls._es_partial_update_allowed():
+            return super(PartialIndexMixin, self).update(params, request)
+
+        old_values = self._es_fields_values()
+        pk = getattr(self, model_cls.pk_field())
+        with skip_indexing(model_cls.__name__, pk) as skipped:
+            obj = super(PartialIndexMixin, self).update(params, request)
+        new_values = self._es_fields_values()
+        changed = set(
+            field for field, value in new_values.items()
+            if old_values.get(field) != value)
+        changed -= model_cls._es_excluded_fields()
+        self._es_partial_update(
+            {field: new_values[field] for field in changed}, request,
+            upsert=skipped.get('document'))
+        return obj
+
+    def _es_update_fields(self, fields, request=None):
+        """ Send values of :fields: changed outside of `update` to ES.
+
+        Fields are updated partially when it is allowed. Otherwise whole
+        document is reindexed.
+
+        :param fields: Names of changed fields.
+        :param request: Pyramid Request instance.
+        """
+        model_cls = self.__class__
+        if model_cls._es_partial_update_allowed():
+            self._es_partial_update(
+                {field: getattr(self, field) for field in fields}, request)
+            return
+        from nefertari.elasticsearch import ES
+        es = ES(model_cls.__name__)
+        es.index(self.to_dict(), request=request)
+        es.index_relations(self, request=request, nested_only=True)
+
+    def _es_partial_update(self, doc, request=None, upsert=None):
+        """ Update ES document of object with fields :doc: and reindex
+        documents :self: is nested into.
+
+        :param doc: Dict of changed fields values.
+        :param request: Pyramid Request instance.
+        :param upsert: Whole document which is indexed if document is
+            missing from index. Generated from object if not provided.
+        """
+        model_cls = self.__class__
+        pk = getattr(self, model_cls.pk_field())
+        if not doc:
+            log.debug('No indexed fields of {}({}) changed, skipping '
+                      'reindexing'.format(model_cls.__name__, pk))
+            return
+        from nefertari.elasticsearch import ES, _bulk_body
+        if upsert is None:
+            upsert = self.to_dict()
+        upsert = dict(upsert)
+        upsert.pop('_type', None)
+        es = ES(model_cls.__name__)
+        action = {
+            '_op_type': 'update',
+            '_index': es.index_name,
+            '_type': es.doc_type,
+            '_id': str(pk),
+            'doc': doc,
+            'upsert': upsert,
+        }
+        log.debug('Partially updating {}({}) fields: {}'.format(
+            model_cls.__name__, pk, sorted(doc)))
+        _bulk_body([action], request=request)
+        es.index_relations(self, request=request, nested_only=True)
+
+
+def _parse_index(index, properties):
+    """ Normalize index definition :index: from `_indexes` schema section.
+
+    Index may be defined as a field name, a list of field names or a dict
+    with keys:
+        :fields: List of field names. Names prefixed with `-` are
+            indexed in descending order.
+        :name: Index name. Generated from field names if not provided.
+        :unique: Boolean indicating whether index is unique.
+        :where: Condition of partial index. SQL expression string for
+            SQLA engine or query dict for MongoDB engine.
+
+    :param index: Index definition.
+    :param properties: Dict of schema properties.
+    """
+    if not isinstance(index, dict):
+        if not isinstance(index, (list, tuple)):
+            index = [index]
+        index = {'fields': list(index)}
+    index = dict(index)
+    fields = index.get('fields')
+    if not fields:
+        raise ValueError('Index fields are not specified: {}'.format(index))
+    if not isinstance(fields, (list, tuple)):
+        fields = [fields]
+    index['fields'] = list(fields)
+    for field in index['fields']:
+        if field.lstrip('-') not in properties:
+            raise ValueError('Unknown index field: {}'.format(field))
+    index['unique'] = bool(index.get('unique'))
+    return index
+
+
+def _index_name(index, table_name):
+    if index.get('name'):
+        return index['name']
+    prefix = 'uq' if index['unique'] else 'ix'
+    fields = [field.lstrip('-') for field in index['fields']]
+    return '_'.join([prefix, table_name] + fields)
+
+
+def _sqla_indexes(indexes, table_name):
+    import sqlalchemy as sa
+    table_args = []
+    for index in indexes:
+        columns = [
+            sa.text('{} DESC'.format(field[1:])) if field.startswith('-')
+            else field
+            for field in index['fields']]
+        kwargs = {'unique': index['unique']}
+        where = index.get('where')
+        if where is not None:
+            if not isinstance(where, six.string_types):
+                raise ValueError(
+                    'Partial index condition must be an SQL string')
+            kwargs['postgresql_where'] = sa.text(where)
+            kwargs['sqlite_where'] = sa.text(where)
+        table_args.append(sa.Index(
+            _index_name(index, table_name), *columns, **kwargs))
+    return {'__table_args__': tuple(table_args)}
+
+
+def _mongodb_indexes(indexes, table_name):
+    meta_indexes = []
+    for index in indexes:
+        definition = {
+            'fields': index['fields'],
+            'name': _index_name(index, table_name),
+            'unique': index['unique'],
+        }
+        where = index.get('where')
+        if where is not None:
+            if not isinstance(where, dict):
+                raise ValueError(
+                    'Partial index condition must be a query dict')
+            definition['partialFilterExpression'] = where
+        meta_indexes.append(definition)
+    return {'meta': {'indexes': meta_indexes}}
+
+
+""" Map of nefertari engine names to index definition generators """
+index_generators = {
+    'nefertari_sqla': _sqla_indexes,
+    'nefertari_mongodb': _mongodb_indexes,
+}
+
+
+def generate_indexes(config, schema, table_name):
+    """ Generate engine-specific index definitions from `_indexes`
+    section of :schema:.
+
+    Indexes are defined using `__table_args__` for SQLA engine and
+    `meta` for MongoDB engine, so they are created by
+    `nefertari.engine.setup_database`.
+
+    :param config: Pyramid Configurator instance.
+    :param schema: Model schema dict parsed from RAML.
+    :param table_name: Name of model table.
+    :returns: Dict of model class attributes.
+    """
+    indexes = schema.get('_indexes') or []
+    if not indexes:
+        return {}
+    properties = schema.get('properties', {})
+    indexes = [_parse_index(index, properties) for index in indexes]
+    engine_name = config.registry.settings.get('nefertari.engine')
+    if engine_name not in index_generators:
+        raise ValueError('Indexes are not supported by engine: {}'.format(
+            engine_name))
+    return index_generators[engine_name](indexes, table_name)
+
+
+def setup_es_index(config, schema, model_name):
+    """ Place ES documents of model in its own index if `_es_index` or
+    `_es_partitions` property of :schema: is set.
+
+    `_es_index` may be true or a dict of index settings, e.g.
+    number_of_shards, number_of_replicas or refresh_interval. Index is
+    named `<elasticsearch.index_name>_<model name>` unless `name` key is
+    present. Models with the same index name share an index.
+
+    `_es_partitions` is a dict with `field` key naming datetime or date
+    field documents are partitioned by and optional `interval`,
+    `retention` and `retention_action` keys. See
+    `ramses.indexing.PartitionedIndex` for details.
+
+    :param config: Pyramid Configurator instance.
+    :param schema: Model schema dict parsed from RAML.
+    :param model_name: String name of model.
+    :returns: Name of model index or None.
+    """
+    from .indexing import (
+        register_model_index, register_partitioned_index,
+        PartitionedIndex)
+    es_index = schema.get('_es_index')
+    partitions = schema.get('_es_partitions')
+    if not (es_index or partitions):
+        return None
+    settings = dict(es_index) if isinstance(es_index, dict) else {}
+    index_name = settings.pop('name', None)
+    if index_name is None:
+        index_name = '{}_{}'.format(
+            config.registry.settings['elasticsearch.index_name'],
+            model_name.lower())
+    if not partitions:
+        register_model_index(model_name, index_name, settings)
+        return index_name
+
+    partitions = dict(partitions)
+    field = partitions.pop('field', None)
+    unknown = set(partitions) - {'interval', 'retention', 'retention_action'}
+    if unknown:
+        raise ValueError('Unknown partitioning options: {}'.format(
+            ', '.join(sorted(unknown))))
+    properties = schema.get('properties', {})
+    if field not in properties:
+        raise ValueError('Unknown partitioning field: {}'.format(field))
+    field_type = properties[field].get('_db_settings', {}).get('type')
+    if field_type not in ('datetime', 'date'):
+        raise ValueError('Partitioning field `{}` must be of datetime or '
+                         'date type'.format(field))
+    register_partitioned_index(PartitionedIndex(
+        index_name, model_name, field, settings=settings, **partitions))
+    return index_name
+
+
 def generate_model_cls(config, schema, model_name, raml_resource,
                        es_based=True):
     """ Generate model class.
@@ -98,6 +448,7 @@ def generate_model_cls(config, schema, model_name, raml_resource,
         Defaults to True.
     """
     from nefertari.authentication.models import AuthModelMethodsMixin
+    from .passwords import RehashPasswordMixin
     base_cls = engine.ESBaseDocument if es_based else engine.BaseDocument
     model_name = str(model_name)
     metaclass = type(base_cls)
@@ -108,7 +459,18 @@ def generate_model_cls(config, schema, model_name, raml_resource,
         from nefertari_guards import engine as guards_engine
         bases.append(guards_engine.DocumentACLMixin)
     if auth_model:
+        bases.append(RehashPasswordMixin)
         bases.append(AuthModelMethodsMixin)
+
+    properties = schema.get('properties', {})
+    es_settings = {
+        field_name: props['_es_settings']
+        for field_name, props in properties.items()
+        if props and props.get('_es_settings')}
+    if es_based and es_settings:
+        bases.append(ESSettingsMixin)
+    if es_based and schema.get('_es_partial_updates'):
+        bases.append(PartialIndexMixin)
     bases.append(base_cls)
 
     attrs = {
@@ -120,9 +482,14 @@ def generate_model_cls(config, schema, model_name, raml_resource,
     }
     if '_nesting_depth' in schema:
         attrs['_nesting_depth'] = schema.get('_nesting_depth')
+    if '_version_field' in schema:
+        attrs['_version_field'] = schema.get('_version_field')
+    attrs.update(generate_indexes(
+        config, schema, attrs['__tablename__']))
+    if es_based and es_settings:
+        attrs['_es_settings'] = es_settings
 
     # Generate fields from properties
-    properties = schema.get('properties', {})
     for field_name, props in properties.items():
         if field_name in attrs:
             continue
@@ -164,6 +531,8 @@ def generate_model_cls(config, schema, model_name, raml_resource,
 
     # Generate new model class
     model_cls = metaclass(model_name, tuple(bases), attrs)
+    if es_based:
+        setup_es_index(config, schema, model_name)
     setup_model_event_subscribers(config, model_cls, schema)
     setup_fields_processors(config, model_cls, schema)
     return model_cls, auth_model
@@ -215,10 +584,14 @@ def handle_model_generation(config, raml_resource, route_name):
 def setup_model_event_subscribers(config, model_cls, schema):
     """ Set up model event subscribers.
 
+    Subscribers which maintain counter caches of relationship fields
+    with `_counter_cache` property are connected as well.
+
     :param config: Pyramid Configurator instance.
     :param model_cls: Model class for which handlers should be connected.
     :param schema: Dict of model JSON schema.
     """
+    from .counters import setup_counter_cache
     events_map = get_events_map()
     model_events = schema.get('_event_handlers', {})
     event_kwargs = {'model': model_cls}
@@ -235,6 +608,10 @@ def setup_model_event_subscribers(config, model_cls, schema):
             config.subscribe_to_events(
                 sub_func, event_objects, **event_kwargs)
 
+    for field_name, props in schema.get('properties', {}).items():
+        if props and props.get('_counter_cache'):
+            setup_counter_cache(config, model_cls, field_name, schema)
+
 
 def setup_fields_processors(config, model_cls, schema):
     """ Set up model fields' processors.
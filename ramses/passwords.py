@@ -0,0 +1,233 @@
+"""
+Password hashing module.
+
+Bcrypt hashing takes a lot of CPU time, so passwords may be hashed and
+verified in a pool of worker processes to not block threads which serve
+other requests.
+
+In particular:
+    :PasswordHasher: Bcrypt password manager which uses process pool
+    :RehashPasswordMixin: Auth model mixin which upgrades password hashes
+    :setup_password_hasher: Configure `hasher` from settings
+"""
+import os
+import re
+import logging
+import weakref
+import threading
+import multiprocessing
+
+import cryptacular.bcrypt
+
+log = logging.getLogger(__name__)
+
+
+def _encode(text, rounds):
+    crypt = cryptacular.bcrypt.BCRYPTPasswordManager()
+    return str(crypt.encode(text, rounds=rounds))
+
+
+def _check(encoded, text):
+    crypt = cryptacular.bcrypt.BCRYPTPasswordManager()
+    return crypt.check(encoded, text)
+
+
+_hashers = weakref.WeakSet()
+
+
+def _after_fork():
+    for instance in list(_hashers):
+        instance._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class PasswordHasher(object):
+    """ Bcrypt password manager which hashes and verifies passwords in a
+    pool of worker processes.
+
+    Implements interface of `cryptacular.bcrypt.BCRYPTPasswordManager`.
+    Number of worker processes limits number of passwords processed
+    concurrently; up to `queue_size` other calls wait for a free worker
+    for at most `timeout` seconds. Calls made when queue is full or
+    which time out raise JHTTPServiceUnavailable. When number of
+    workers is 0, passwords are processed in calling thread.
+
+    Pool is created on first use in each process which serves
+    requests, or by `start` which may be called from a post-fork hook of
+    the server. Pool of a parent process is never used after fork.
+    """
+    ROUNDS_RE = re.compile(r'^\$2a\$([0-9]{2})\$')
+
+    def __init__(self, rounds=10, workers=0, queue_size=None, timeout=10):
+        """
+        :param rounds: Bcrypt cost of new hashes.
+        :param workers: Number of worker processes.
+        :param queue_size: Maximum number of calls waiting for a free
+            worker. Defaults to 4 times number of workers.
+        :param timeout: Seconds a call may take before it fails.
+        """
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._crypt = cryptacular.bcrypt.BCRYPTPasswordManager()
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = self._make_slots()
+        _hashers.add(self)
+
+    def _make_slots(self):
+        queue_size = self.queue_size
+        if queue_size is None:
+            queue_size = self.workers * 4
+        return threading.BoundedSemaphore(max(self.workers + queue_size, 1))
+
+    def _after_fork(self):
+        """ Forget pool of parent process in a forked child. """
+        self._lock = threading.Lock()
+        self._slots = self._make_slots()
+        self._pool = None
+        self._pid = None
+
+    def configure(self, rounds=None, workers=None, queue_size=None,
+                  timeout=None):
+        """ Change settings of hasher. Running pool is closed. """
+        if rounds is not None:
+            self.rounds = rounds
+        if workers is not None:
+            self.workers = workers
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if timeout is not None:
+            self.timeout = timeout
+        self.close()
+        self._slots = self._make_slots()
+
+    def start(self):
+        """ Start pool of worker processes in current process.
+
+        Call it from a post-fork hook of the server, e.g. gunicorn's
+        `post_fork`, if the app is loaded before workers are forked.
+        """
+        if self.workers:
+            self._get_pool()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+            self._pid = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                log.info('Starting {} password hashing workers'.format(
+                    self.workers))
+                self._pool = multiprocessing.Pool(processes=self.workers)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        from nefertari.json_httpexceptions import JHTTPServiceUnavailable
+        if not self._slots.acquire(False):
+            log.warning('Password hashing queue is full')
+            raise JHTTPServiceUnavailable(
+                'Too many concurrent password checks, try again later')
+        try:
+            result = self._get_pool().apply_async(func, args)
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            log.warning('Password hashing timed out after {} seconds'.format(
+                self.timeout))
+            raise JHTTPServiceUnavailable(
+                'Password check timed out, try again later')
+        finally:
+            self._slots.release()
+
+    def encode(self, text, rounds=None):
+        """ Hash password :text:. """
+        return self._run(_encode, text, rounds or self.rounds)
+
+    def check(self, encoded, text):
+        """ Check password :text: against hash :encoded:. """
+        if not self.match(encoded):
+            return False
+        return self._run(_check, encoded, text)
+
+    def match(self, encoded):
+        """ Check whether :encoded: looks like a bcrypt hash. """
+        return self._crypt.match(encoded)
+
+    def get_rounds(self, encoded):
+        """ Get cost :encoded: hash was made with. """
+        match = self.ROUNDS_RE.match(encoded or '')
+        if match is not None:
+            return int(match.group(1))
+
+    def needs_update(self, encoded):
+        """ Check whether :encoded: hash was made with a cost different
+        from current one.
+        """
+        rounds = self.get_rounds(encoded)
+        return rounds is not None and rounds != self.rounds
+
+
+""" Hasher used by ramses and nefertari auth models """
+hasher = PasswordHasher()
+
+
+class RehashPasswordMixin(object):
+    """ Auth model mixin which rehashes user's password on successful
+    login if its hash was made with a cost different from current one.
+    """
+    @classmethod
+    def authenticate_by_password(cls, params):
+        success, user = super(
+            RehashPasswordMixin, cls).authenticate_by_password(params)
+        if success and hasher.needs_update(user.password):
+            log.info('Upgrading password hash of user {}'.format(
+                getattr(user, user.pk_field(), None)))
+            user.update({'password': hasher.encode(params['password'])})
+        return success, user
+
+
+def setup_password_hasher(config):
+    """ Configure `hasher` and make nefertari auth models use it.
+
+    Nefertari auth models hash and verify passwords using module-level
+    `crypt` password manager, which is replaced by `hasher`.
+
+    Supported settings:
+        :bcrypt.rounds: Bcrypt cost of new hashes. Defaults to 10.
+        :bcrypt.workers: Number of password hashing worker processes.
+            Defaults to 0, which means passwords are hashed in request
+            threads.
+        :bcrypt.queue_size: Maximum number of requests waiting for a
+            free worker. Defaults to 4 times number of workers.
+        :bcrypt.timeout: Seconds to wait for a worker before responding
+            with 503. Defaults to 10.
+
+    Pool of workers is not started here, as application may be loaded
+    before server forks worker processes. It is started on first use in
+    each process.
+
+    :param config: Pyramid Configurator instance.
+    """
+    from nefertari.utils import dictset
+    from nefertari.authentication import models
+    settings = dictset(config.registry.settings)
+    queue_size = settings.get('bcrypt.queue_size')
+    hasher.configure(
+        rounds=settings.asint('bcrypt.rounds', 10),
+        workers=settings.asint('bcrypt.workers', 0),
+        queue_size=None if queue_size is None else int(queue_size),
+        timeout=settings.asfloat('bcrypt.timeout', 10))
+    models.crypt = hasher
+    return hasher
@@ -0,0 +1,433 @@
+"""
+Rebuild Elasticsearch index of models from the database.
+
+Rows of each model are read in chunks ordered by primary key, so every
+chunk is fetched with an indexed range query no matter how far into the
+table it is. Chunks are indexed using ES bulk API by a pool of worker
+processes.
+
+With `--rebuild` option, documents are written to new versions of
+indices while application keeps using the current ones. Documents of
+rows deleted while their chunk was being copied are removed from the
+new indices. Once all models are indexed, index aliases are switched to
+the new indices.
+
+Usage:
+    ramses.reindex -c development.ini --processes 4 --chunk 1000 \
+        --checkpoint reindex.json
+"""
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import logging
+import multiprocessing
+from argparse import ArgumentParser
+
+import six
+import transaction
+from pyramid.paster import bootstrap
+from nefertari.utils import dictset, split_strip, to_dicts
+
+
+log = logging.getLogger(__name__)
+
+
+def _sqla_pks(model_cls, after, size):
+    from pyramid_sqlalchemy import Session
+    column = getattr(model_cls, model_cls.pk_field())
+    query = Session().query(column)
+    if after is not None:
+        query = query.filter(column > after)
+    return [row[0] for row in query.order_by(column).limit(size)]
+
+
+def _sqla_items(model_cls, first, last):
+    from pyramid_sqlalchemy import Session
+    column = getattr(model_cls, model_cls.pk_field())
+    query = Session().query(model_cls).filter(
+        column >= first, column <= last)
+    return query.order_by(column).all()
+
+
+def _sqla_existing(model_cls, pks):
+    from pyramid_sqlalchemy import Session
+    column = getattr(model_cls, model_cls.pk_field())
+    return set(row[0] for row in Session().query(column).filter(
+        column.in_(pks)))
+
+
+def _mongodb_pks(model_cls, after, size):
+    pk_field = model_cls.pk_field()
+    query = model_cls.objects
+    if after is not None:
+        query = query(**{pk_field + '__gt': after})
+    return list(query.order_by(pk_field).limit(size).scalar(pk_field))
+
+
+def _mongodb_items(model_cls, first, last):
+    pk_field = model_cls.pk_field()
+    query = model_cls.objects(**{
+        pk_field + '__gte': first,
+        pk_field + '__lte': last,
+    })
+    return list(query.order_by(pk_field))
+
+
+def _mongodb_existing(model_cls, pks):
+    pk_field = model_cls.pk_field()
+    query = model_cls.objects(**{pk_field + '__in': list(pks)})
+    return set(query.scalar(pk_field))
+
+
+""" Map of engine names to functions which load chunks of primary keys
+of model ordered by primary key.
+"""
+pk_loaders = {
+    'nefertari_sqla': _sqla_pks,
+    'nefertari_mongodb': _mongodb_pks,
+}
+
+""" Map of engine names to functions which load objects of model with
+primary keys in a given range.
+"""
+items_loaders = {
+    'nefertari_sqla': _sqla_items,
+    'nefertari_mongodb': _mongodb_items,
+}
+
+""" Map of engine names to functions which get which of given primary
+keys of model exist in the database.
+"""
+existing_loaders = {
+    'nefertari_sqla': _sqla_existing,
+    'nefertari_mongodb': _mongodb_existing,
+}
+
+""" Settings of application bootstrapped in current process. """
+_settings = dictset()
+
+
+def bootstrap_app(config_uri):
+    """ Bootstrap application without setting up ES mappings.
+
+    Indexing queue of application, if enabled, is closed so that
+    documents are indexed synchronously.
+
+    :param config_uri: Path to application .ini file.
+    """
+    from ramses.indexing import mappings_setup_disabled
+    with mappings_setup_disabled():
+        env = bootstrap(config_uri)
+
+    registry = env['registry']
+    queue = getattr(registry, 'indexing_queue', None)
+    if queue is not None:
+        # Closed queue executes actions synchronously
+        queue.close()
+    _settings.clear()
+    _settings.update(registry.settings)
+    return env
+
+
+def create_documents(model_name, documents, index_name):
+    """ Create :documents: in index :index_name: being rebuilt.
+
+    Documents which already exist were written by application after
+    they had been read from the database, so they are not overwritten.
+    """
+    from elasticsearch import helpers
+    from nefertari.elasticsearch import ES
+    es = ES(model_name, index_name=index_name)
+    actions = es.prep_bulk_documents('create', documents)
+    if not actions:
+        return
+    _, errors = helpers.bulk(
+        client=ES.api, actions=actions, raise_on_error=False)
+    errors = [error for error in errors
+              if error.get('create', {}).get('status') != 409]
+    if errors:
+        raise Exception('Errors happened when indexing `{}` documents: '
+                        '{}'.format(model_name, errors))
+
+
+def delete_removed_documents(model_cls, pks, index_name):
+    """ Delete documents of objects with primary keys :pks: which no
+    longer exist in the database from index :index_name: being rebuilt.
+
+    Application deletes documents from index being rebuilt too, but
+    deletes of documents which are not copied yet are lost. This is
+    called after documents are copied, so documents of rows deleted
+    after they had been read are not left in the new index.
+    """
+    from elasticsearch import helpers
+    from nefertari.elasticsearch import ES
+    from ramses.indexing import is_missing_delete
+    load_existing = existing_loaders[_settings['nefertari.engine']]
+    existing = load_existing(model_cls, pks)
+    removed = [pk for pk in pks if pk not in existing]
+    if not removed:
+        return
+    es = ES(model_cls.__name__, index_name=index_name)
+    actions = [{
+        '_op_type': 'delete',
+        '_index': index_name,
+        '_type': es.doc_type,
+        '_id': six.text_type(pk),
+    } for pk in removed]
+    _, errors = helpers.bulk(
+        client=ES.api, actions=actions, raise_on_error=False)
+    errors = [error for error in errors if not is_missing_delete(error)]
+    if errors:
+        raise Exception('Errors happened when deleting `{}` documents: '
+                        '{}'.format(model_cls.__name__, errors))
+
+
+def index_range(args):
+    """ Index objects of a model with primary keys in a range.
+
+    Called in worker processes.
+
+    :param args: Tuple of (model name, first pk, last pk, index name).
+        Index name is None when documents are indexed into current
+        index.
+    :returns: Tuple of (number of indexed objects, last pk).
+    """
+    from nefertari import engine
+    from nefertari.elasticsearch import ES
+    model_name, first, last, index_name = args
+    model_cls = engine.get_document_cls(model_name)
+    load_items = items_loaders[_settings['nefertari.engine']]
+    pks = []
+    try:
+        items = load_items(model_cls, first, last)
+        documents = to_dicts(items)
+        if index_name is None:
+            ES(model_name).index(documents)
+        else:
+            pks = [getattr(item, model_cls.pk_field()) for item in items]
+            create_documents(model_name, documents, index_name)
+    finally:
+        # Release loaded objects
+        transaction.abort()
+    if index_name is not None and pks:
+        try:
+            delete_removed_documents(model_cls, pks, index_name)
+        finally:
+            transaction.abort()
+    return len(documents), last
+
+
+def main(argv=sys.argv):
+    log = logging.getLogger()
+    log.setLevel(logging.WARNING)
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+    ch.setFormatter(formatter)
+    log.addHandler(ch)
+
+    command = ReindexCommand(argv[1:], log)
+    return command.run()
+
+
+class ReindexCommand(object):
+    """ Command which reindexes models from the database.
+
+    Progress of every model is saved to checkpoint file after each
+    indexed chunk, so that interrupted run may be resumed.
+    """
+    bootstrap = (bootstrap_app,)
+
+    def __init__(self, argv, log):
+        self.target_indices = {}
+        parser = ArgumentParser(description=__doc__)
+        parser.add_argument(
+            '-c', '--config', help='config.ini (required)',
+            required=True)
+        parser.add_argument(
+            '--models',
+            help=('Comma-separated list of model names to index. '
+                  'Defaults to all indexed models'))
+        parser.add_argument(
+            '--chunk', help='Number of objects per chunk', type=int,
+            default=1000)
+        parser.add_argument(
+            '--processes', help='Number of indexing processes', type=int,
+            default=1)
+        parser.add_argument(
+            '--rate', help='Maximum number of objects indexed per second',
+            type=float, default=0)
+        parser.add_argument(
+            '--checkpoint',
+            help=('Path to checkpoint file. If file exists, reindexing '
+                  'is resumed from the saved position'))
+        parser.add_argument(
+            '--rebuild',
+            help=('Index all models into new versions of indices and '
+                  'switch index aliases to them. Requires '
+                  '`index_aliases.enable` setting'),
+            action='store_true', default=False)
+        parser.add_argument(
+            '--delete-old', help='Delete old indices after rebuild',
+            action='store_true', default=False)
+        parser.add_argument(
+            '--quiet', help='Quiet mode', action='store_true',
+            default=False)
+        self.options = parser.parse_args(argv)
+        if self.options.rebuild and self.options.models:
+            parser.error('--models can not be used with --rebuild')
+        self.log = log
+        if not self.options.quiet:
+            self.log.setLevel(logging.INFO)
+
+    def get_model_names(self):
+        from nefertari import engine
+        if self.options.models:
+            return split_strip(self.options.models)
+        models = engine.get_document_classes()
+        return sorted(
+            name for name, model in models.items()
+            if getattr(model, '_index_enabled', False))
+
+    def load_checkpoint(self):
+        path = self.options.checkpoint
+        if not path or not os.path.exists(path):
+            return {}
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.log.info('Resuming from checkpoint {}'.format(path))
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        path = self.options.checkpoint
+        if not path:
+            return
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, default=six.text_type)
+        os.rename(tmp_path, path)
+
+    def iter_ranges(self, model_cls, after=None):
+        """ Generate primary key ranges of chunks of :model_cls: objects
+        with primary keys greater than :after:.
+
+        Generation is slowed down to not exceed `--rate` objects per
+        second.
+        """
+        load_pks = pk_loaders[_settings['nefertari.engine']]
+        rate = self.options.rate
+        started = time.time()
+        dispatched = 0
+        while True:
+            pks = load_pks(model_cls, after, self.options.chunk)
+            if not pks:
+                return
+            if rate:
+                delay = dispatched / rate - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            dispatched += len(pks)
+            after = pks[-1]
+            index_name = self.target_indices.get(model_cls.__name__)
+            yield model_cls.__name__, pks[0], after, index_name
+
+    def reindex_model(self, model_name, checkpoint, imap):
+        """ Reindex objects of model named :model_name:.
+
+        :param checkpoint: Dict of models progress.
+        :param imap: Function used to apply `index_range` to ranges.
+        """
+        from nefertari import engine
+        state = checkpoint.get(model_name, {})
+        if state.get('done'):
+            self.log.info('Model `{}` is already indexed'.format(model_name))
+            return
+
+        model_cls = engine.get_document_cls(model_name)
+        total = model_cls.get_collection(_count=True)
+        indexed = state.get('indexed', 0)
+        last_pk = state.get('last_pk')
+        self.log.info('Indexing {} `{}` documents'.format(total, model_name))
+
+        started = time.time()
+        ranges = self.iter_ranges(model_cls, after=last_pk)
+        for count, last_pk in imap(index_range, ranges):
+            indexed += count
+            checkpoint[model_name] = {
+                'last_pk': last_pk, 'indexed': indexed, 'done': False}
+            self.save_checkpoint(checkpoint)
+            elapsed = max(time.time() - started, 1e-6)
+            speed = (indexed - state.get('indexed', 0)) / elapsed
+            self.log.info('{}: {}/{} documents indexed ({:.0f} docs/s)'.format(
+                model_name, indexed, total, speed))
+
+        checkpoint[model_name] = {
+            'last_pk': last_pk, 'indexed': indexed, 'done': True}
+        self.save_checkpoint(checkpoint)
+
+    def start_rebuild(self, registry, checkpoint):
+        """ Create new versions of indices, or find the ones being
+        rebuilt, and wait until application processes start writing to
+        them.
+
+        Progress saved in :checkpoint: is dropped if it belongs to
+        other indices.
+
+        :returns: List of (IndexAlias, new index name) pairs.
+        """
+        from nefertari.elasticsearch import ES
+        from ramses.indexing import get_index_models, get_index_body
+        aliases = getattr(registry, 'index_aliases', None)
+        if not aliases:
+            raise Exception('Index aliases are not enabled')
+
+        rebuilds = []
+        self.target_indices = {}
+        for name, alias in sorted(aliases.items()):
+            models = get_index_models(name, ES.settings.index_name)
+            index_name = alias.start_rebuild(
+                models, body=get_index_body(name))
+            rebuilds.append((alias, index_name))
+            for model_cls in models:
+                self.target_indices[model_cls.__name__] = index_name
+
+        indices = sorted(index_name for _, index_name in rebuilds)
+        if checkpoint.get('_indices') != indices:
+            checkpoint.clear()
+            checkpoint['_indices'] = indices
+        self.log.info('Waiting for application to start writing to '
+                      'indices {}'.format(', '.join(indices)))
+        time.sleep(max(alias.check_interval for alias, _ in rebuilds))
+        return rebuilds
+
+    def run(self):
+        env = self.bootstrap[0](self.options.config)
+        checkpoint = self.load_checkpoint()
+        model_names = self.get_model_names()
+        rebuilds = []
+        if self.options.rebuild:
+            rebuilds = self.start_rebuild(env['registry'], checkpoint)
+
+        pool = None
+        imap = six.moves.map
+        if self.options.processes > 1:
+            pool = multiprocessing.Pool(
+                processes=self.options.processes,
+                initializer=self.bootstrap[0],
+                initargs=(self.options.config,))
+            imap = pool.imap
+        try:
+            for model_name in model_names:
+                self.reindex_model(model_name, checkpoint, imap)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        for alias, index_name in rebuilds:
+            alias.finish_rebuild(
+                index_name, delete_old=self.options.delete_old)
+        if rebuilds:
+            self.save_checkpoint({})
+        self.log.info('Reindexing finished')
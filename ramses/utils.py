@@ -321,6 +321,30 @@ def get_events_map():
     }
 
 
+def call_after_commit(request, func):
+    """ Call :func: once transaction of :request: is committed.
+
+    Transactions are managed by pyramid_tm, which is only included by
+    some engines, e.g. nefertari_sqla. If :request: is not handled in
+    a pyramid_tm transaction, :func: is called immediately. If
+    transaction is aborted, :func: is not called.
+
+    :param request: Pyramid Request instance or None.
+    :param func: Function called without arguments.
+    """
+    environ = getattr(request, 'environ', None)
+    if not (isinstance(environ, dict) and environ.get('tm.active')):
+        return func()
+
+    import transaction
+    manager = getattr(request, 'tm', None) or transaction.manager
+
+    def after_commit(success):
+        if success:
+            func()
+    manager.get().addAfterCommitHook(after_commit)
+
+
 @contextmanager
 def patch_view_model(view_cls, model_cls):
     """ Patches view_cls.Model with model_cls.
@@ -1,8 +1,16 @@
+import copy
+import json
+import hashlib
 import logging
+from datetime import datetime
+from contextlib import contextmanager
 
 import six
+from pyramid.httpexceptions import HTTPNotModified
+from webob.datetime_utils import serialize_date
 from nefertari.view import BaseView as NefertariBaseView
 from nefertari.json_httpexceptions import JHTTPNotFound
+from nefertari.utils import dictset
 
 from .utils import patch_view_model
 
@@ -37,9 +45,253 @@ class SetObjectACLMixin(object):
     def set_object_acl(self, obj):
         """ Set object ACL on creation if not already present. """
         if not obj._acl:
-            from nefertari_guards import engine as guards_engine
-            acl = self._factory(self.request).generate_item_acl(obj)
-            obj._acl = guards_engine.ACLField.stringify_acl(acl)
+            from .acl import generate_stringified_item_acl
+            obj._acl = generate_stringified_item_acl(
+                self.request, self._factory, obj)
+
+
+def _document_data(obj):
+    """ Get data of ES or DB document :obj: as a dict. """
+    if isinstance(obj, dict):
+        return obj
+    data = getattr(obj, '_data', None)
+    if isinstance(data, dict):
+        return data
+    return obj.to_dict()
+
+
+def _document_pk(obj):
+    """ Get primary key value of ES or DB document :obj:. """
+    if hasattr(obj, 'pk_field'):
+        return getattr(obj, obj.pk_field(), None)
+    return getattr(obj, '_pk', None)
+
+
+def parse_version_date(value):
+    """ Convert document version field :value: to a datetime.
+
+    Returns None if :value: is neither a datetime nor an ISO-formatted
+    date string, which is how dates are stored in Elasticsearch.
+    """
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None, microsecond=0)
+    if isinstance(value, six.string_types):
+        try:
+            return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            return None
+
+
+def parse_etags(header):
+    """ Parse value of `If-None-Match` :header: into a set of opaque
+    ETag values. Weak ETags are compared as strong ones (RFC 7232 weak
+    comparison).
+    """
+    etags = set()
+    for etag in (header or '').split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etag = etag.strip('"')
+        if etag:
+            etags.add(etag)
+    return etags
+
+
+class ConditionalResponseMixin(object):
+    """ Mixin that adds ETag and Last-Modified headers to `index` and
+    `show` responses and answers conditional requests with 304.
+
+    If model defines `_version_field`, a strong ETag is computed from
+    values of this field and Last-Modified header of items is set when
+    field contains dates. Otherwise a weak ETag is computed from a hash
+    of documents' data.
+
+    Collections only get ETag: date of the most recent item of a page
+    does not change when items are deleted or moved into the page.
+
+    Values that are the same for all users are not enough to identify
+    a representation, thus ETag also depends on request query params and
+    user's effective principals.
+    """
+    _cache_control = 'no-cache'
+
+    def index(self, **kwargs):
+        result = super(ConditionalResponseMixin, self).index(**kwargs)
+        return self.conditional_response(result, many=True)
+
+    def show(self, **kwargs):
+        result = super(ConditionalResponseMixin, self).show(**kwargs)
+        return self.conditional_response(result)
+
+    def _version_values(self, documents):
+        """ Get values of model version field for :documents:.
+
+        Returns None if model has no version field or any of documents
+        misses the value.
+        """
+        field = getattr(self.Model, '_version_field', None)
+        if not field:
+            return None
+        values = [getattr(doc, field, None) for doc in documents]
+        if any(val is None for val in values):
+            return None
+        return values
+
+    def get_etag(self, result, many=False):
+        """ Compute ETag and Last-Modified values for :result:.
+
+        :param result: Single document or a sequence of documents.
+        :param many: Boolean indicating whether :result: is a sequence.
+        :returns: Tuple of (ETag header value, datetime or None).
+            Datetime is always None for collections.
+        """
+        documents = list(result) if many else [result]
+        versions = self._version_values(documents)
+        if versions is not None:
+            material = [[_document_pk(doc), ver]
+                        for doc, ver in zip(documents, versions)]
+        else:
+            material = [_document_data(doc) for doc in documents]
+        if many:
+            meta = getattr(result, '_nefertari_meta', None) or {}
+            material.append(meta.get('total'))
+
+        principals = getattr(self.request, 'effective_principals', None)
+        key = json.dumps(
+            [self.Model.__name__, material,
+             sorted(self._query_params.items()),
+             sorted(principals or [])],
+            sort_keys=True, default=str)
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        if versions is None:
+            return 'W/"{}"'.format(digest), None
+        if many:
+            return '"{}"'.format(digest), None
+        return '"{}"'.format(digest), parse_version_date(versions[0])
+
+    def _not_modified(self, etag, last_modified):
+        """ Determine whether client has an up-to-date representation.
+
+        `If-Modified-Since` is only checked when `If-None-Match` header
+        is not present.
+        """
+        headers = self.request.headers
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            return '*' in etags or parse_etags(etag) <= etags
+
+        if_modified_since = self.request.if_modified_since
+        if last_modified is None or if_modified_since is None:
+            return False
+        if_modified_since = if_modified_since.replace(tzinfo=None)
+        return last_modified <= if_modified_since
+
+    def conditional_response(self, result, many=False):
+        """ Return 304 response if client's copy of :result: is up to
+        date. Set ETag and Last-Modified response headers otherwise.
+
+        Serialization of :result: is skipped when 304 response is returned.
+        """
+        if self.request.method.upper() not in ('GET', 'HEAD'):
+            return result
+        if result is None or isinstance(result, (six.integer_types, dict)):
+            return result
+
+        etag, last_modified = self.get_etag(result, many=many)
+        headers = [
+            ('ETag', etag),
+            ('Cache-Control', self._cache_control),
+        ]
+        if last_modified is not None:
+            headers.append(('Last-Modified', serialize_date(last_modified)))
+
+        if self._not_modified(etag, last_modified):
+            return HTTPNotModified(headers=headers)
+
+        response_headers = self.request.response.headers
+        for name, value in headers:
+            response_headers[name] = value
+        return result
+
+
+class RequestSnapshot(object):
+    """ State of a request used to load data in background thread after
+    request is finished.
+
+    Effective principals are evaluated when snapshot is created, so that
+    authentication policy is not called outside of request. Other
+    attributes are read from the original request.
+    """
+    def __init__(self, request):
+        self._request = request
+        principals = getattr(request, 'effective_principals', None)
+        self.effective_principals = list(principals or [])
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+
+@contextmanager
+def background_request(request):
+    """ Run code on behalf of :request: in a background thread.
+
+    Registry and :request: are pushed to pyramid thread locals. Code is
+    run in its own transaction, which is aborted when it finishes, and
+    database session of the thread is removed.
+
+    :param request: RequestSnapshot of a finished request.
+    """
+    import transaction
+    from pyramid.threadlocal import manager
+    registry = request.registry
+    manager.push({'registry': registry, 'request': request})
+    transaction.begin()
+    try:
+        yield
+    finally:
+        transaction.abort()
+        engine = (registry.settings or {}).get('nefertari.engine')
+        if engine == 'nefertari_sqla':
+            from pyramid_sqlalchemy import Session
+            Session.remove()
+        manager.pop()
+
+
+class CacheViewMixin(object):
+    """ Mixin that serves `index` responses from resource cache.
+
+    Cache keys are built from request path, query params and effective
+    principals of the user. Item reads are cached by generated ACLs, as
+    items are loaded when context is found. Stale collections may be
+    returned while being refreshed in background if resource cache has
+    `hard_ttl` set. Background refresh uses principals and query params
+    captured when request was handled.
+    """
+    _cache = None
+
+    def index(self, **kwargs):
+        if self._cache is None:
+            return super(CacheViewMixin, self).index(**kwargs)
+        snapshot = RequestSnapshot(self.request)
+        params = dictset(self._query_params)
+        key = self._cache.collection_key(
+            self.request.path, params, snapshot.effective_principals)
+
+        def load(request=self.request):
+            # Copy of the view is used to keep this view's state intact
+            view = copy.copy(self)
+            view.request = request
+            view._query_params = dictset(params)
+            return super(CacheViewMixin, view).index(**kwargs)
+
+        def refresh():
+            with background_request(snapshot):
+                return load(snapshot)
+
+        return self._cache.get_or_load(
+            key, load, revalidate=True, refresh_loader=refresh)
 
 
 class BaseView(object):
@@ -214,7 +466,12 @@ class ESBaseView(BaseView):
     Use `self.get_collection_es` and `self.get_item_es` to get access
     to the set of objects and individual object respectively which are
     valid at the current level.
+
+    Set `_check_items_acl` to True to check items of collection pages
+    against item ACL with `check_items_acl`.
     """
+    _check_items_acl = False
+
     def _parent_queryset_es(self):
         """ Get queryset (list of object IDs) of parent view.
 
@@ -233,6 +490,49 @@ class ESBaseView(BaseView):
             objects_ids = getattr(obj, prop, None)
             return objects_ids
 
+    def setup_default_wrappers(self):
+        super(ESBaseView, self).setup_default_wrappers()
+        if self._auth_enabled and self._check_items_acl:
+            self._after_calls['index'].insert(0, self.check_items_acl)
+
+    def check_items_acl(self, request, result):
+        """ Remove ES documents user has no permission to access from
+        collection page :result:.
+
+        Used when `_check_items_acl` is True. Documents are only checked
+        when collection could not be filtered by item ACL in ES query.
+        ACLs of all the documents of the page are generated at once, so
+        batch callable principals are called once per page.
+
+        As pages are checked after ES paginated them, `total` of page
+        meta still counts removed documents. Number of documents removed
+        from page is stored in `acl_filtered` meta key.
+        """
+        factory = getattr(self, '_factory', None)
+        if not hasattr(factory, 'items_need_check'):
+            return result
+        if not (isinstance(result, list) and result and
+                hasattr(result, '_nefertari_meta')):
+            return result
+        from nefertari.resource import PERMISSIONS
+        permission = PERMISSIONS.get(request.action, 'view')
+        acl = factory(request)
+        if not acl.items_need_check(permission):
+            return result
+
+        permitted = []
+        items_acl = acl.generate_items_acl(list(result))
+        for document, item_acl in zip(result, items_acl):
+            document.__acl__ = item_acl
+            document.__parent__ = acl
+            if request.has_permission(permission, document):
+                permitted.append(document)
+        checked = type(result)(permitted)
+        checked._nefertari_meta = dict(
+            result._nefertari_meta,
+            acl_filtered=len(result) - len(permitted))
+        return checked
+
     def get_es_object_ids(self, objects):
         """ Return IDs of :objects: if they are not IDs already. """
         id_field = self.clean_id_name
@@ -247,6 +547,9 @@ class ESBaseView(BaseView):
         queryset returned by this method will be a subset of its parent view's
         queryset, thus filtering out objects that don't belong to the parent
         object.
+
+        Collections of time-partitioned models are only searched in
+        partitions overlapping the filter of partitioning field.
         """
         objects_ids = self._parent_queryset_es()
 
@@ -256,7 +559,41 @@ class ESBaseView(BaseView):
                 return []
             self._query_params['id'] = objects_ids
 
-        return super(ESBaseView, self).get_collection_es()
+        acl_filter = self._acl_query_filter()
+        if acl_filter is False:
+            return []
+        if acl_filter:
+            query = self._query_params.get('q')
+            if query:
+                acl_filter = '({}) AND ({})'.format(query, acl_filter)
+            self._query_params['q'] = acl_filter
+
+        from .indexing import get_partitioned_index
+        partitioned = get_partitioned_index(self.Model.__name__)
+        if partitioned is None:
+            return super(ESBaseView, self).get_collection_es()
+        index_name = partitioned.search_index(self._query_params)
+        if index_name is None:
+            return []
+        if isinstance(self, IndexACLFilterViewMixin):
+            return super(ESBaseView, self).get_collection_es(
+                index_name=index_name)
+        from nefertari.elasticsearch import ES
+        es = ES(self.Model.__name__, index_name=index_name)
+        return es.get_collection(**self._query_params)
+
+    def _acl_query_filter(self):
+        """ Get ES query string that filters collection by item ACL.
+
+        See `ramses.acl.BaseACL.item_query_filter` for details.
+        """
+        factory = getattr(self, '_factory', None)
+        if not (self._auth_enabled and
+                hasattr(factory, 'item_query_filter')):
+            return None
+        from nefertari.resource import PERMISSIONS
+        permission = PERMISSIONS.get(self.request.action, 'view')
+        return factory(self.request).item_query_filter(permission)
 
     def get_item_es(self, **kwargs):
         """ Get ES collection item taking into account generated queryset
@@ -284,6 +621,21 @@ class ESBaseView(BaseView):
         return self.context
 
 
+class IndexACLFilterViewMixin(object):
+    """ View mixin that filters ES collections by ACLs stored in
+    database and may search a given index.
+
+    Used in front of `nefertari_guards.view.ACLFilterViewMixin`, which
+    always searches the default index of model, so that partitions of
+    time-partitioned models are filtered too.
+    """
+    def get_collection_es(self, index_name=None):
+        from nefertari_guards.elasticsearch import ACLFilterES
+        params = self._query_params.copy()
+        es = ACLFilterES(self.Model.__name__, index_name=index_name)
+        return es.get_collection(request=self.request, **params)
+
+
 class ESCollectionView(ESBaseView, CollectionView):
     """ View that reads data from ES.
 
@@ -445,7 +797,7 @@ class ItemSingularView(ItemSubresourceBaseView):
 
 
 def generate_rest_view(config, model_cls, attrs=None, es_based=True,
-                       attr_view=False, singular=False):
+                       attr_view=False, singular=False, cache=None):
     """ Generate REST view for a model class.
 
     :param model_cls: Generated DB model class.
@@ -461,6 +813,12 @@ def generate_rest_view(config, model_cls, attrs=None, es_based=True,
         used as a base class for generated view.
     :param singular: Boolean indicating if ItemSingularView should be
         used as a base class for generated view.
+    :param cache: Instance of ramses.cache.ResourceCache used to cache
+        `index` responses of ES-based collection views.
+
+    ConditionalResponseMixin is added to bases of collection views when
+    `etag.enable` setting is true. Pages of ES-based collections are
+    checked against item ACLs when `acl.check_items` setting is true.
     """
     valid_attrs = (list(collection_methods.values()) +
                    list(item_methods.values()))
@@ -475,12 +833,25 @@ def generate_rest_view(config, model_cls, attrs=None, es_based=True,
     else:
         bases = [CollectionView]
 
+    settings = dictset(config.registry.settings)
+    if settings.asbool('etag.enable') and not (singular or attr_view):
+        bases = [ConditionalResponseMixin] + bases
+
+    attrs_dict = {'Model': model_cls}
+    if es_based:
+        attrs_dict['_check_items_acl'] = settings.asbool('acl.check_items')
+    if cache is not None and es_based and not (singular or attr_view):
+        idx = bases.index(ESCollectionView)
+        bases.insert(idx, CacheViewMixin)
+        attrs_dict['_cache'] = cache
+
     if config.registry.database_acls:
         from nefertari_guards.view import ACLFilterViewMixin
-        bases = [SetObjectACLMixin] + bases + [ACLFilterViewMixin]
+        bases = ([SetObjectACLMixin] + bases +
+                 [IndexACLFilterViewMixin, ACLFilterViewMixin])
     bases.append(NefertariBaseView)
 
-    RESTView = type('RESTView', tuple(bases), {'Model': model_cls})
+    RESTView = type('RESTView', tuple(bases), attrs_dict)
 
     def _attr_error(*args, **kwargs):
         raise AttributeError
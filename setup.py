@@ -40,6 +40,9 @@ setup(name='ramses',
       tests_require=requires,
       test_suite="ramses",
       entry_points="""\
+        [console_scripts]
+        ramses.reindex = ramses.scripts.reindex:main
+
         [pyramid.scaffold]
         ramses_starter = ramses.scaffolds:RamsesStarterTemplate
       """)
@@ -54,4 +54,5 @@ def config_mock():
     from mock import Mock
     config = Mock()
     config.registry.database_acls = False
+    config.registry.settings = {}
     return config
@@ -7,7 +7,7 @@ from pyramid.security import (
 
 from ramses import acl
 
-from .fixtures import config_mock
+from .fixtures import config_mock, guards_engine_mock, engine_mock
 
 
 class TestACLHelpers(object):
@@ -159,6 +159,204 @@ class TestGenerateACL(object):
         acl_cls = acl.generate_acl(config, **kwargs)
         assert issubclass(acl_cls, acl.DatabaseACLMixin)
 
+    def test_compiled_acls(self, mock_parse):
+        mock_parse.return_value = [(Allow, Everyone, 'view')]
+        raml_resource = Mock(security_schemes=[
+            Mock(type='x-ACL', settings={'collection': 4, 'item': 7})
+        ])
+        config = config_mock()
+        config.registry.database_acls = False
+        acl_cls = acl.generate_acl(
+            config, model_cls='Foo', raml_resource=raml_resource)
+        instance = acl_cls(request=None)
+        assert instance._compiled_acl.acl == ((Allow, Everyone, 'view'),)
+        assert instance._compiled_item_acl.acl == (
+            (Allow, Everyone, 'view'),)
+
+        mock_parse.return_value = [(Allow, Mock(), 'view')]
+        acl_cls = acl.generate_acl(
+            config, model_cls='Foo', raml_resource=raml_resource)
+        assert acl_cls(request=None)._compiled_acl is None
+
+        mock_parse.return_value = [(Allow, Everyone, 'view')]
+        config.registry.database_acls = True
+        acl_cls = acl.generate_acl(
+            config, model_cls='Foo', raml_resource=raml_resource)
+        assert acl_cls._compiled_item_acl is None
+
+
+class TestCompiledACL(object):
+
+    def test_compile_acl(self):
+        assert acl.compile_acl([(Allow, lambda **kw: None, 'view')]) is None
+        compiled = acl.compile_acl([(Allow, Everyone, 'view')])
+        assert compiled.acl == ((Allow, Everyone, 'view'),)
+
+    def test_match(self):
+        aces = [
+            (Deny, 'u:bob', 'delete'),
+            (Allow, 'g:admin', ALL_PERMISSIONS),
+            (Allow, Authenticated, ['view', 'update']),
+            (Deny, 'u:bob', 'update'),
+        ]
+        compiled = acl.CompiledACL(aces)
+        assert compiled.match(['u:bob'], 'view') is None
+        assert compiled.match(['u:bob', 'g:admin'], 'delete') == aces[0]
+        assert compiled.match(['g:admin', 'u:bob'], 'delete') == aces[0]
+        assert compiled.match(['u:bob', Authenticated], 'update') == aces[2]
+        assert compiled.match(['u:bob'], 'update') == aces[3]
+        assert compiled.match(['g:admin'], 'anything') == aces[1]
+
+
+class TestCachingACLAuthorizationPolicy(object):
+
+    def _context(self, collection_acl, item_acl=None):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        parent = Mock(__parent__=None, __acl__=tuple(collection_acl))
+        parent._compiled_acl = acl.compile_acl(collection_acl)
+        if item_acl is None:
+            return parent
+        item = Mock(__parent__=parent, __acl__=tuple(item_acl))
+        item._compiled_acl = acl.compile_acl(item_acl)
+        return item
+
+    def _check_same(self, context, principals, permission):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        policy = acl.CachingACLAuthorizationPolicy()
+        expected = ACLAuthorizationPolicy().permits(
+            context, principals, permission)
+        for i in range(2):
+            result = policy.permits(context, principals, permission)
+            assert bool(result) == bool(expected)
+            assert result.ace == expected.ace
+            assert result.context is expected.context
+        return policy
+
+    def test_same_decisions(self):
+        collection_acl = [(Allow, 'g:admin', ALL_PERMISSIONS)]
+        item_acl = [
+            (Deny, 'u:bob', 'delete'),
+            (Allow, Authenticated, ['view', 'update'])]
+        context = self._context(collection_acl, item_acl)
+        self._check_same(context, ['u:bob', Authenticated], 'view')
+        self._check_same(context, ['u:bob', Authenticated], 'delete')
+        self._check_same(context, ['g:admin'], 'delete')
+        self._check_same(context, [Everyone], 'view')
+        self._check_same(self._context(collection_acl), ['g:admin'], 'view')
+
+    def test_decisions_cached(self):
+        context = self._context([(Allow, Everyone, 'view')])
+        policy = acl.CachingACLAuthorizationPolicy()
+        assert policy.permits(context, [Everyone], 'view')
+        assert policy.permits(context, [Everyone], 'view')
+        assert policy.cache.stats()['hits'] == 1
+        assert not policy.permits(context, [Everyone], 'delete')
+        assert len(policy.cache) == 2
+
+    def test_dynamic_acl_not_cached(self):
+        context = self._context([(Allow, Everyone, 'view')])
+        context._compiled_acl = None
+        policy = acl.CachingACLAuthorizationPolicy()
+        assert policy.permits(context, [Everyone], 'view')
+        assert len(policy.cache) == 0
+
+
+@pytest.mark.usefixtures('guards_engine_mock')
+class TestGenerateStringifiedItemACL(object):
+
+    def _factory(self, depends_on_object):
+        factory = Mock()
+        factory().item_acl_depends_on_object.return_value = depends_on_object
+        factory.reset_mock()
+        return factory
+
+    def test_static_acl_memoized(self, guards_engine_mock):
+        stringify = guards_engine_mock.ACLField.stringify_acl
+        stringify.return_value = [{'action': 'allow'}]
+        request = Mock(_item_acls_memo=None)
+        factory = self._factory(False)
+        acl1 = acl.generate_stringified_item_acl(request, factory, 1)
+        acl2 = acl.generate_stringified_item_acl(request, factory, 2)
+        assert acl1 == acl2 == [{'action': 'allow'}]
+        assert acl1 is not acl2
+        factory.assert_called_once_with(request)
+        factory().generate_item_acl.assert_called_once_with(1)
+        assert stringify.call_count == 1
+
+    def test_dynamic_acl(self, guards_engine_mock):
+        stringify = guards_engine_mock.ACLField.stringify_acl
+        request = Mock(_item_acls_memo=None)
+        factory = self._factory(True)
+        acl.generate_stringified_item_acl(request, factory, 1)
+        result = acl.generate_stringified_item_acl(request, factory, 2)
+        assert result == stringify()
+        factory.assert_called_once_with(request)
+        assert factory().generate_item_acl.call_count == 2
+
+    def test_memo_per_request(self):
+        factory = self._factory(False)
+        acl.generate_stringified_item_acl(
+            Mock(_item_acls_memo=None), factory, 1)
+        acl.generate_stringified_item_acl(
+            Mock(_item_acls_memo=None), factory, 1)
+        assert factory.call_count == 2
+
+
+@pytest.mark.usefixtures('guards_engine_mock')
+class TestDatabaseACLMixin(object):
+
+    class acl_cls(acl.DatabaseACLMixin, acl.BaseACL):
+        _es_acls_cache = acl.LRUCache(max_size=10)
+
+    def _item(self, *aces):
+        from nefertari.utils import dict2obj
+        return dict2obj({'_acl': [
+            {'action': a, 'principal': p, 'permission': perm}
+            for a, p, perm in aces]})
+
+    def test_items_need_check(self):
+        obj = self.acl_cls('req')
+        obj._item_acl = [(Allow, lambda **kw: None, 'view')]
+        assert not obj.items_need_check('view')
+
+    def test_item_acl_db(self):
+        obj = self.acl_cls('req')
+        obj.es_based = False
+        item = Mock()
+        assert obj.item_acl(item) == item.get_acl()
+
+    @patch('nefertari_guards.elasticsearch.get_es_item_acl')
+    def test_item_acl_es_cached(self, mock_get_acl):
+        mock_get_acl.side_effect = lambda item: [
+            [ace.action, ace.principal, ace.permission]
+            for ace in item._acl]
+        obj = self.acl_cls('req')
+        obj.es_based = True
+        obj._es_acls_cache.clear()
+        acl1 = obj.item_acl(self._item(('allow', 'g:admin', 'all')))
+        acl2 = obj.item_acl(self._item(('allow', 'g:admin', 'all')))
+        assert acl1 == (('allow', 'g:admin', 'all'),)
+        assert acl1 is acl2
+        assert mock_get_acl.call_count == 1
+        acl3 = obj.item_acl(self._item(('deny', 'g:admin', 'all')))
+        assert acl3 == (('deny', 'g:admin', 'all'),)
+        assert mock_get_acl.call_count == 2
+
+    @patch('nefertari_guards.elasticsearch.get_es_item_acl')
+    def test_item_acl_es_many_permissions(self, mock_get_acl):
+        mock_get_acl.return_value = [('allow', 'g:user', ('view', 'edit'))]
+        obj = self.acl_cls('req')
+        obj.es_based = True
+        obj._es_acls_cache.clear()
+        item = self._item(('allow', 'g:user', ['view', 'edit']))
+        acl1 = obj.item_acl(item)
+        assert obj.item_acl(item) is acl1
+        assert acl1 == (('allow', 'g:user', ('view', 'edit')),)
+        assert mock_get_acl.call_count == 1
+
+    def test_item_query_filter(self):
+        assert self.acl_cls('req').item_query_filter('view') is None
+
 
 class TestBaseACL(object):
 
@@ -229,6 +427,154 @@ class TestBaseACL(object):
         )
         assert new_acl == ((Allow, Everyone, ['view']),)
 
+    def test_apply_callables_memoized(self):
+        principal = Mock(return_value=(7, 8, 'view'), _request_only=False)
+        request = Mock(_acl_principals_memo=None)
+        obj = acl.BaseACL(request)
+        item1, item2 = object(), object()
+        ace_list = [('foo', principal, 'view')]
+        obj._apply_callables(acl=ace_list, obj=item1)
+        obj._apply_callables(acl=ace_list, obj=item1)
+        assert principal.call_count == 1
+        new_acl = obj._apply_callables(acl=ace_list, obj=item2)
+        assert principal.call_count == 2
+        assert new_acl == ((7, 8, ['view']),)
+        other = acl.BaseACL(request)
+        other._apply_callables(acl=ace_list, obj=item2)
+        assert principal.call_count == 2
+        assert len(request._acl_principals_memo) == 2
+
+    def test_apply_callables_request_principal(self):
+        principal = acl.request_principal(Mock(return_value=(7, 8, 'view')))
+        assert principal._request_only is True
+        obj = acl.BaseACL(Mock(_acl_principals_memo=None))
+        ace_list = [('foo', principal, 'view')]
+        for item in range(5):
+            obj._apply_callables(acl=ace_list, obj=item)
+        principal.assert_called_once_with(
+            ace=ace_list[0], request=obj.request, obj=0)
+
+    def test_apply_callables_memo_per_request(self):
+        principal = Mock(return_value=(7, 8, 'view'), _request_only=False)
+        ace_list = [('foo', principal, 'view')]
+        acl.BaseACL(Mock(_acl_principals_memo=None))._apply_callables(
+            acl=ace_list, obj=1)
+        acl.BaseACL(Mock(_acl_principals_memo=None))._apply_callables(
+            acl=ace_list, obj=1)
+        assert principal.call_count == 2
+
+    def test_generate_items_acl_batch_principal(self):
+        def principal(ace, request, objs):
+            return [(Allow, 'u:{}'.format(obj), 'view') if obj else None
+                    for obj in objs]
+        principal = acl.batch_principal(Mock(side_effect=principal))
+        obj = acl.BaseACL(Mock(_acl_principals_memo=None))
+        obj._item_acl = [(Deny, 'foo', 'delete'), (Allow, principal, 'view')]
+        acls = obj.generate_items_acl([1, 0, 2])
+        assert acls == [
+            ((Deny, 'foo', 'delete'), (Allow, 'u:1', ['view'])),
+            ((Deny, 'foo', 'delete'),),
+            ((Deny, 'foo', 'delete'), (Allow, 'u:2', ['view'])),
+        ]
+        principal.assert_called_once_with(
+            ace=obj._item_acl[1], request=obj.request, objs=[1, 0, 2])
+
+    def test_generate_item_acl_batch_principal(self):
+        principal = acl.batch_principal(
+            Mock(return_value=[(Allow, 'foo', 'view')]))
+        obj = acl.BaseACL(Mock(_acl_principals_memo=None))
+        obj._item_acl = [(Allow, principal, 'view')]
+        assert obj.generate_item_acl(1) == ((Allow, 'foo', ['view']),)
+        principal.assert_called_once_with(
+            ace=obj._item_acl[0], request=obj.request, objs=[1])
+
+    def test_generate_items_acl_memoized(self):
+        principal = Mock(return_value=(Allow, 'foo', 'view'),
+                         _request_only=False, _batch=False)
+        obj = acl.BaseACL(Mock(_acl_principals_memo=None))
+        obj._item_acl = [(Allow, principal, 'view')]
+        obj.generate_item_acl(1)
+        acls = obj.generate_items_acl([1, 2, 2])
+        assert len(acls) == 3
+        assert principal.call_count == 2
+
+    def _query_filter_acl(self, item_acl, principals=('u:bob',)):
+        obj = acl.BaseACL(Mock(effective_principals=list(principals)))
+        obj._item_acl = item_acl
+        return obj
+
+    def _principal(self, clause):
+        principal = Mock()
+        acl.principal_query_filter(principal)(
+            Mock(return_value=clause))
+        return principal
+
+    def test_item_query_filter(self):
+        owner = self._principal('owner:bob')
+        shared = self._principal('shared:bob')
+        obj = self._query_filter_acl([
+            (Allow, 'g:admin', ALL_PERMISSIONS),
+            (Allow, owner, ALL_PERMISSIONS),
+            (Allow, shared, ['view']),
+        ])
+        assert obj.item_query_filter('view') == (
+            '(owner:bob) OR (shared:bob)')
+        assert obj.item_query_filter('delete') == '(owner:bob)'
+        owner._query_filter.assert_called_with(
+            ace=obj._item_acl[1], request=obj.request)
+
+    def test_item_query_filter_static_allow(self):
+        owner = self._principal('owner:bob')
+        obj = self._query_filter_acl([
+            (Allow, owner, 'view'),
+            (Allow, 'g:admin', 'view'),
+        ], principals=['u:bob', 'g:admin'])
+        assert obj.item_query_filter('view') is None
+
+    def test_item_query_filter_static_deny(self):
+        owner = self._principal('owner:bob')
+        other = self._principal('other:bob')
+        obj = self._query_filter_acl([
+            (Allow, owner, 'view'),
+            (Deny, 'u:bob', 'view'),
+            (Allow, other, 'view'),
+        ])
+        assert obj.item_query_filter('view') == '(owner:bob)'
+
+    def test_item_query_filter_nothing_permitted(self):
+        obj = self._query_filter_acl([(Allow, self._principal(None), 'view')])
+        assert obj.item_query_filter('view') is False
+
+    def test_item_query_filter_not_filterable(self):
+        no_filter = Mock(_query_filter=None)
+        obj = self._query_filter_acl([
+            (Allow, self._principal('owner:bob'), 'view'),
+            (Allow, no_filter, 'view'),
+        ])
+        assert obj.item_query_filter('view') is None
+        obj._item_acl = [(Deny, self._principal('owner:bob'), 'view')]
+        assert obj.item_query_filter('view') is None
+        obj._item_acl = [(Allow, 'u:alice', 'view')]
+        assert obj.item_query_filter('view') is None
+
+    def test_item_acl_depends_on_object(self):
+        obj = acl.BaseACL('req')
+        obj._item_acl = [(Allow, Everyone, 'view')]
+        assert not obj.item_acl_depends_on_object()
+        obj._item_acl.append(
+            (Allow, acl.request_principal(lambda **kw: None), 'view'))
+        assert not obj.item_acl_depends_on_object()
+        obj._item_acl.append((Allow, lambda **kw: None, 'view'))
+        assert obj.item_acl_depends_on_object()
+
+    def test_items_need_check(self):
+        obj = self._query_filter_acl([(Allow, lambda **kw: None, 'view')])
+        assert obj.items_need_check('view')
+        obj._item_acl = [(Allow, self._principal('owner:bob'), 'view')]
+        assert not obj.items_need_check('view')
+        obj._item_acl = [(Allow, 'u:alice', 'view')]
+        assert not obj.items_need_check('view')
+
     def test_magic_acl(self):
         obj = acl.BaseACL('req')
         obj._collection_acl = [(1, 2, 3)]
@@ -255,9 +601,11 @@ class TestBaseACL(object):
         obj.item_db_id = Mock(return_value=42)
         obj.getitem_es = Mock()
         obj.es_based = True
+        obj._compiled_item_acl = 'foo'
         obj.__getitem__(1)
         obj.item_db_id.assert_called_once_with(1)
         obj.getitem_es.assert_called_once_with(42)
+        assert obj.getitem_es()._compiled_acl == 'foo'
 
     def test_magic_getitem_db_based(self):
         obj = acl.BaseACL('req')
@@ -268,6 +616,26 @@ class TestBaseACL(object):
         obj.__getitem__(1)
         obj.item_db_id.assert_called_once_with(1)
 
+    @pytest.mark.usefixtures('engine_mock')
+    def test_item_db_id_token_user(self):
+        from ramses.auth import LazyUser
+
+        class User(object):
+            get_item = Mock()
+
+            @classmethod
+            def pk_field(cls):
+                return 'id'
+
+        request = Mock()
+        request.user = LazyUser(request, User, 3, [])
+        obj = acl.BaseACL(request)
+        obj.item_model = User
+        assert obj.item_db_id('self') == 3
+        obj.item_model = type('Story', (object,), {})
+        assert obj.item_db_id('self') == 'self'
+        assert not User.get_item.called
+
     @patch('ramses.acl.ES')
     def test_getitem_es(self, mock_es):
         found_obj = Mock()
@@ -279,9 +647,44 @@ class TestBaseACL(object):
         obj.item_model.pk_field.return_value = 'myname'
         obj.item_acl = Mock()
         value = obj.getitem_es(key='varvar')
-        mock_es.assert_called_with('Foo')
+        mock_es.assert_called_with('Foo', index_name=None)
         es_obj.get_item.assert_called_once_with(id='varvar')
         obj.item_acl.assert_called_once_with(found_obj)
         assert value.__acl__ == obj.item_acl()
         assert value.__parent__ is obj
         assert value.__name__ == 'varvar'
+
+    @patch('ramses.indexing.get_partitioned_index')
+    def test_get_es_item_index(self, mock_get):
+        obj = acl.BaseACL('req')
+        obj.item_model = Mock(__name__='Event')
+        mock_get.return_value = None
+        assert obj.get_es_item_index(1) is None
+        partitioned = mock_get.return_value = Mock()
+        partitioned.find_indices.return_value = {'1': 'foo-2015.01'}
+        assert obj.get_es_item_index(1) == 'foo-2015.01'
+        mock_get.assert_called_with('Event')
+        partitioned.find_indices.assert_called_with(['1'])
+
+    @patch('ramses.indexing.get_partitioned_index')
+    def test_get_es_item_index_not_found(self, mock_get):
+        from nefertari.json_httpexceptions import JHTTPNotFound
+        obj = acl.BaseACL('req')
+        obj.item_model = Mock(__name__='Event')
+        mock_get.return_value.find_indices.return_value = {}
+        with pytest.raises(JHTTPNotFound):
+            obj.get_es_item_index(1)
+
+    def test_getitem_es_cached(self):
+        from nefertari.utils import dict2obj
+        from ramses.cache import ResourceCache, LRUCache
+        obj = acl.BaseACL(Mock(effective_principals=['a']))
+        obj._cache = ResourceCache('Foo', backend=LRUCache())
+        obj.get_es_item = Mock(return_value=dict2obj({'id': 1}))
+        obj.item_acl = Mock(return_value=[])
+        value1 = obj.getitem_es(key='1')
+        value2 = obj.getitem_es(key='1')
+        obj.get_es_item.assert_called_once_with('1')
+        assert value1.id == value2.id == 1
+        assert value1 is not value2
+        assert value2.__parent__ is obj
@@ -1,5 +1,5 @@
 import pytest
-from mock import Mock, patch
+from mock import Mock, patch, ANY
 
 from nefertari.utils import dictset
 from pyramid.security import Allow, ALL_PERMISSIONS
@@ -57,6 +57,251 @@ class TestACLAssignRegisterMixin(object):
             {'_acl': guards_engine_mock.ACLField.stringify_acl()})
 
 
+@pytest.mark.usefixtures('engine_mock')
+class TestAuthUserCache(object):
+    def _cache(self, **kwargs):
+        from ramses import auth
+        auth_model = Mock()
+        auth_model.pk_field.return_value = 'username'
+        auth_model.get_item.return_value = Mock(
+            username='user1', groups=['admin'])
+        return auth.AuthUserCache(auth_model, **kwargs)
+
+    def test_get_groups_by_userid(self):
+        cache = self._cache()
+        request = Mock()
+        assert cache.get_groups_by_userid('user1', request) == ['g:admin']
+        assert cache.get_groups_by_userid('user1', request) == ['g:admin']
+        cache.auth_model.get_item.assert_called_once_with(username='user1')
+
+    def test_get_groups_by_userid_not_found(self):
+        cache = self._cache()
+        cache.auth_model.get_item.return_value = None
+        assert cache.get_groups_by_userid('user1', Mock()) is None
+        assert cache.get_groups_by_userid('user1', Mock()) is None
+        assert cache.auth_model.get_item.call_count == 2
+
+    @patch('ramses.auth.forget')
+    def test_get_groups_by_userid_error(self, mock_forget):
+        cache = self._cache()
+        cache.auth_model.get_item.side_effect = ValueError
+        request = Mock()
+        assert cache.get_groups_by_userid('user1', request) is None
+        mock_forget.assert_called_once_with(request)
+
+    def test_get_authuser_by_userid(self):
+        from ramses import auth
+        cache = self._cache()
+        request = Mock(authenticated_userid='user1')
+        user = cache.get_authuser_by_userid(request)
+        assert user is cache.auth_model.get_item.return_value
+        assert request._user is user
+        assert cache.get_groups_by_userid('user1', request) == ['g:admin']
+        cached = cache.get_authuser_by_userid(request)
+        assert isinstance(cached, auth.LazyUser)
+        assert cached.username == 'user1'
+        assert cached.groups == ['admin']
+        assert cache.auth_model.get_item.call_count == 1
+
+    def test_get_authuser_by_userid_not_authenticated(self):
+        cache = self._cache()
+        request = Mock(authenticated_userid=None)
+        assert cache.get_authuser_by_userid(request) is None
+        assert not cache.auth_model.get_item.called
+
+    def test_get_authuser_by_name(self):
+        cache = self._cache()
+        cache.auth_model.pk_field.return_value = 'id'
+        cache.auth_model.get_item.return_value = Mock(
+            id=1, username='user1', groups=['admin'])
+        request = Mock(authenticated_userid='user1', _user=None)
+        cache.get_authuser_by_name(request)
+        request._user = None
+        user = cache.get_authuser_by_name(request)
+        assert (user.id, user.username) == (1, 'user1')
+        cache.auth_model.get_item.assert_called_once_with(username='user1')
+        assert user.email is cache.auth_model.get_item.return_value.email
+        calls = cache.auth_model.get_item.call_args_list
+        assert [kw for args, kw in calls] == [{'username': 'user1'}, {'id': 1}]
+
+    def test_only_plain_values_cached(self):
+        cache = self._cache()
+        cache.get_authuser_by_name(Mock(authenticated_userid='user1'))
+        assert list(cache.cache._data.values())[0][0] == (
+            'user1', ['g:admin'])
+
+    @patch('ramses.cache.time')
+    def test_ttl(self, mock_time):
+        cache = self._cache(ttl=10)
+        mock_time.time.return_value = 100
+        cache.get_groups_by_userid('user1', Mock())
+        mock_time.time.return_value = 109
+        cache.get_groups_by_userid('user1', Mock())
+        assert cache.auth_model.get_item.call_count == 1
+        mock_time.time.return_value = 110
+        cache.get_groups_by_userid('user1', Mock())
+        assert cache.auth_model.get_item.call_count == 2
+
+    def test_invalidate(self):
+        from nefertari import events
+        cache = self._cache()
+        request = Mock(authenticated_userid='user1')
+        cache.get_groups_by_userid('user1', request)
+        cache.get_authuser_by_name(request)
+        event = events.AfterUpdate(
+            model=None, view=None, instance=Mock(username='user1'))
+        cache.invalidate(event)
+        assert len(cache.cache) == 0
+
+    def test_invalidate_many(self):
+        from nefertari import events
+        cache = self._cache()
+        cache.get_groups_by_userid('user1', Mock())
+        cache.get_groups_by_userid('user2', Mock())
+        cache.invalidate(events.AfterDeleteMany(
+            model=None, view=None, instance=Mock()))
+        assert len(cache.cache) == 0
+
+    def test_setup_user_cache_disabled(self):
+        from ramses import auth
+        config = Mock()
+        config.registry.settings = {}
+        assert auth.setup_user_cache(config) is None
+        assert not config.subscribe_to_events.called
+
+    def test_setup_user_cache(self):
+        from ramses import auth
+        config = Mock()
+        config.registry.settings = {
+            'auth_cache.enable': 'true',
+            'auth_cache.ttl': '10',
+            'auth_cache.max_size': '5',
+        }
+        cache = auth.setup_user_cache(config)
+        assert cache.auth_model is config.registry.auth_model
+        assert cache.cache.ttl == 10
+        assert cache.cache.max_size == 5
+        config.subscribe_to_events.assert_called_once_with(
+            cache.invalidate, ANY, model=config.registry.auth_model)
+
+
+@pytest.mark.usefixtures('engine_mock')
+class TestApiKeyTokenCache(object):
+    def _cache(self, **kwargs):
+        from ramses import auth
+        auth_model = Mock()
+        auth_model.get_groups_by_token.return_value = ['g:admin']
+        return auth.ApiKeyTokenCache(auth_model, **kwargs)
+
+    def test_get_groups_by_token(self):
+        cache = self._cache()
+        request = Mock()
+        assert cache.get_groups_by_token('user1', 'tok', request) == [
+            'g:admin']
+        assert cache.get_groups_by_token('user1', 'tok', request) == [
+            'g:admin']
+        cache.auth_model.get_groups_by_token.assert_called_once_with(
+            'user1', 'tok', request)
+
+    def test_token_not_stored(self):
+        cache = self._cache()
+        cache.get_groups_by_token('user1', 'secrettoken', Mock())
+        key = list(cache.cache._data.keys())[0]
+        assert 'secrettoken' not in key
+
+    @patch('ramses.cache.time')
+    def test_ttl(self, mock_time):
+        cache = self._cache(ttl=10)
+        mock_time.time.return_value = 100
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        mock_time.time.return_value = 109
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        assert cache.auth_model.get_groups_by_token.call_count == 1
+        mock_time.time.return_value = 110
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        assert cache.auth_model.get_groups_by_token.call_count == 2
+
+    def test_different_tokens(self):
+        cache = self._cache()
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        cache.get_groups_by_token('user1', 'tok2', Mock())
+        assert cache.auth_model.get_groups_by_token.call_count == 2
+
+    def test_failed_check_not_cached(self):
+        cache = self._cache()
+        cache.auth_model.get_groups_by_token.return_value = None
+        assert cache.get_groups_by_token('user1', 'tok', Mock()) is None
+        assert cache.get_groups_by_token('user1', 'tok', Mock()) is None
+        assert cache.auth_model.get_groups_by_token.call_count == 2
+
+    def test_invalidate_user(self):
+        cache = self._cache()
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        cache.get_groups_by_token('user2', 'tok', Mock())
+        cache.invalidate_user('user1')
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        cache.get_groups_by_token('user2', 'tok', Mock())
+        assert cache.auth_model.get_groups_by_token.call_count == 3
+
+    def test_invalidate(self):
+        from nefertari import events
+        cache = self._cache()
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        cache.invalidate(events.AfterUpdate(
+            model=None, view=None, instance=Mock(username='user1')))
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        assert cache.auth_model.get_groups_by_token.call_count == 2
+
+    def test_invalidate_username_changed(self):
+        from nefertari import events
+        from nefertari.utils import FieldData
+        cache = self._cache()
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        cache.get_groups_by_token('user2', 'tok', Mock())
+        user = Mock(username='user1')
+        view = Mock(spec=[])
+        fields = FieldData.from_dict({'username': 'user2'}, None)
+        cache.remember_username(events.BeforeUpdate(
+            model=None, view=view, instance=user, fields=fields))
+        user.username = 'user2'
+        cache.invalidate(events.AfterUpdate(
+            model=None, view=view, instance=user, fields=fields))
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        cache.get_groups_by_token('user2', 'tok', Mock())
+        assert cache.auth_model.get_groups_by_token.call_count == 4
+
+    def test_invalidate_many(self):
+        from nefertari import events
+        cache = self._cache()
+        cache.get_groups_by_token('user1', 'tok', Mock())
+        cache.invalidate(events.AfterUpdateMany(
+            model=None, view=None, instance=None))
+        assert len(cache.cache) == 0
+
+    def test_setup_token_cache_disabled(self):
+        from ramses import auth
+        config = Mock()
+        params = {'token_cache_max_size': '10'}
+        assert auth.setup_token_cache(config, params) is None
+        assert params == {}
+        assert not config.subscribe_to_events.called
+
+    def test_setup_token_cache(self):
+        from ramses import auth
+        config = Mock()
+        params = {'token_cache_ttl': '30', 'token_cache_max_size': '10',
+                  'foo': 'bar'}
+        cache = auth.setup_token_cache(config, params)
+        assert params == {'foo': 'bar'}
+        assert cache.auth_model is config.registry.auth_model
+        assert cache.cache.ttl == 30
+        assert cache.cache.max_size == 10
+        config.subscribe_to_events.assert_any_call(
+            cache.remember_username, ANY, model=config.registry.auth_model)
+        config.subscribe_to_events.assert_any_call(
+            cache.invalidate, ANY, model=config.registry.auth_model)
+
+
 @pytest.mark.usefixtures('engine_mock')
 class TestSetupTicketPolicy(object):
 
@@ -103,6 +348,21 @@ class TestSetupTicketPolicy(object):
             'user', reify=True)
         assert policy == mock_policy()
 
+    @patch('ramses.auth.setup_user_cache')
+    @patch('ramses.auth.AuthTktAuthenticationPolicy')
+    def test_user_cache_used(self, mock_policy, mock_cache):
+        from ramses import auth
+        config = Mock()
+        config.registry.settings = {'my_secret': 12345}
+        auth._setup_ticket_policy(
+            config=config, params={'secret': 'my_secret'})
+        mock_cache.assert_called_once_with(config)
+        mock_policy.assert_called_once_with(
+            secret=12345,
+            callback=mock_cache().get_groups_by_userid)
+        config.add_request_method.assert_called_once_with(
+            mock_cache().get_authuser_by_userid, 'user', reify=True)
+
     @patch('ramses.auth.AuthTktAuthenticationPolicy')
     def test_routes_views_added(self, mock_policy):
         from ramses import auth
@@ -142,6 +402,7 @@ class TestSetupApiKeyPolicy(object):
         from ramses import auth
         auth_model = Mock()
         config = Mock()
+        config.registry.settings = {}
         config.registry.auth_model = auth_model
         policy = auth._setup_apikey_policy(config, {'foo': 'bar'})
         mock_policy.assert_called_once_with(
@@ -151,11 +412,45 @@ class TestSetupApiKeyPolicy(object):
         )
         assert policy == mock_policy()
 
+    @patch('ramses.auth.setup_token_cache')
+    @patch('ramses.auth.ApiKeyAuthenticationPolicy')
+    def test_token_cache_used(self, mock_policy, mock_cache):
+        from ramses import auth
+        config = Mock()
+        config.registry.settings = {}
+        root = Mock()
+        config.get_root_resource.return_value = root
+        params = {'token_cache_ttl': 10}
+        auth._setup_apikey_policy(config, params)
+        mock_cache.assert_called_once_with(config, params)
+        assert mock_policy.call_args[1]['check'] == (
+            mock_cache().get_groups_by_token)
+
+        reset_view = root.add.call_args_list[2][1]['view']
+        view = reset_view.__new__(reset_view)
+        view.user = Mock(username='user1')
+        with patch('nefertari.authentication.views.'
+                   'TokenAuthResetView.reset_token') as mock_reset:
+            assert view.reset_token(foo=1) == mock_reset.return_value
+        mock_reset.assert_called_once_with(foo=1)
+        mock_cache().invalidate_user.assert_called_once_with('user1')
+
+    @patch('ramses.auth.setup_user_cache')
+    @patch('ramses.auth.ApiKeyAuthenticationPolicy')
+    def test_user_cache_used(self, mock_policy, mock_cache):
+        from ramses import auth
+        config = Mock()
+        auth._setup_apikey_policy(config, {})
+        mock_cache.assert_called_once_with(config)
+        config.add_request_method.assert_called_once_with(
+            mock_cache().get_authuser_by_name, 'user', reify=True)
+
     @patch('ramses.auth.ApiKeyAuthenticationPolicy')
     def test_routes_views_added(self, mock_policy):
         from ramses import auth
         auth_model = Mock()
         config = Mock()
+        config.registry.settings = {}
         config.registry.auth_model = auth_model
         root = Mock()
         config.get_root_resource.return_value = root
@@ -181,6 +476,196 @@ class TestSetupApiKeyPolicy(object):
         assert register_kwargs['factory'] == 'nefertari.acl.AuthenticationACL'
 
 
+@pytest.mark.usefixtures('engine_mock')
+class TestSignedTokenAuthenticationPolicy(object):
+    def _policy(self, **kwargs):
+        from ramses import auth
+        kwargs.setdefault('secret', 'secret')
+        kwargs.setdefault('user_model', Mock())
+        return auth.SignedTokenAuthenticationPolicy(**kwargs)
+
+    def _request(self, token=None, authorization=None):
+        if token is not None:
+            authorization = 'SignedToken ' + token
+        headers = {}
+        if authorization is not None:
+            headers['Authorization'] = authorization
+        return Mock(headers=headers)
+
+    def test_encode_decode_token(self):
+        policy = self._policy()
+        token = policy.encode_token('user1', ['g:admin'])
+        data = policy.decode_token(token)
+        assert data['userid'] == 'user1'
+        assert data['groups'] == ['g:admin']
+
+    def test_decode_token_expired(self):
+        policy = self._policy(expires=-1)
+        token = policy.encode_token('user1', ['g:admin'])
+        assert policy.decode_token(token) is None
+
+    def test_decode_token_wrong_secret(self):
+        token = self._policy().encode_token('user1', ['g:admin'])
+        assert self._policy(secret='foo').decode_token(token) is None
+
+    def test_decode_token_tampered(self):
+        import base64
+        import json
+        policy = self._policy()
+        payload, signature = policy.encode_token(
+            'user1', ['g:user']).split('.')
+        data = json.loads(policy._b64decode(
+            payload.encode('ascii')).decode('utf-8'))
+        data['groups'] = ['g:admin']
+        payload = base64.urlsafe_b64encode(
+            json.dumps(data).encode('utf-8')).decode('ascii')
+        assert policy.decode_token(payload + '.' + signature) is None
+
+    def test_decode_token_malformed(self):
+        policy = self._policy()
+        assert policy.decode_token('foo') is None
+        assert policy.decode_token('foo.bar.baz') is None
+        assert policy.decode_token('!!!.???') is None
+        assert policy.decode_token(u'\u0444.\u0444') is None
+
+    def test_unauthenticated_userid(self):
+        policy = self._policy()
+        token = policy.encode_token('user1', ['g:admin'])
+        assert policy.unauthenticated_userid(
+            self._request(token)) == 'user1'
+        assert policy.unauthenticated_userid(self._request()) is None
+        assert policy.unauthenticated_userid(
+            self._request(authorization='ApiKey user1:' + token)) is None
+        assert policy.unauthenticated_userid(
+            self._request(authorization='SignedToken')) is None
+
+    def test_effective_principals(self):
+        from pyramid.security import Everyone, Authenticated
+        policy = self._policy()
+        request = self._request(policy.encode_token('user1', ['g:admin']))
+        assert policy.effective_principals(request) == [
+            Everyone, Authenticated, 'user1', 'g:admin']
+        assert not policy.user_model.get_item.called
+
+    def test_effective_principals_invalid_token(self):
+        from pyramid.security import Everyone
+        policy = self._policy()
+        request = self._request('foo.bar')
+        assert policy.effective_principals(request) == [Everyone]
+
+    def test_hashalg(self):
+        import hashlib
+        policy = self._policy(hashalg='sha512')
+        assert policy.digestmod is hashlib.sha512
+        for hashalg in ('md5', 'sha1', 'new'):
+            with pytest.raises(ValueError):
+                self._policy(hashalg=hashalg)
+
+    def test_get_user(self):
+        from ramses import auth
+        policy = self._policy()
+        policy.user_model.pk_field.return_value = 'id'
+        token = policy.encode_token(1, ['g:admin', 'g:user'])
+        user = policy.get_user(self._request(token))
+        assert isinstance(user, auth.LazyUser)
+        assert user.id == user.userid == 1
+        assert user.groups == ['admin', 'user']
+        assert auth.LazyUser.is_admin(user)
+        assert not policy.user_model.get_item.called
+        assert policy.get_user(self._request('foo.bar')) is None
+
+    def test_token_user_loads_instance(self):
+        from ramses import auth
+        model = Mock()
+        model.pk_field.return_value = 'id'
+        model.get_item.return_value = Mock(id=1, email='a@b.c')
+        request = Mock(_user=None)
+        user = auth.LazyUser(request, model, 1, ['user'])
+        assert not auth.LazyUser.is_admin(user)
+        assert user.email == 'a@b.c'
+        assert user.get_instance() is request._user
+        model.get_item.assert_called_once_with(id=1)
+
+    def test_token_user_no_instance(self):
+        from ramses import auth
+        model = Mock()
+        model.pk_field.return_value = 'id'
+        model.get_item.return_value = None
+        user = auth.LazyUser(Mock(_user=None), model, 1, [])
+        with pytest.raises(AttributeError):
+            user.email
+
+    def test_remember(self):
+        policy = self._policy()
+        user = Mock(username='user1', groups=['admin'])
+        policy.user_model.pk_field.return_value = 'username'
+        policy.user_model.get_item.return_value = user
+        request = Mock(_user=None)
+        headers = policy.remember(request, 'user1')
+        policy.user_model.get_item.assert_called_once_with(
+            username='user1')
+        assert len(headers) == 1
+        name, value = headers[0]
+        assert name == 'WWW-Authenticate'
+        scheme, token = value.split(' ')
+        assert scheme == 'SignedToken'
+        assert policy.decode_token(token)['groups'] == ['g:admin']
+
+    def test_remember_no_user(self):
+        policy = self._policy()
+        policy.user_model.pk_field.return_value = 'username'
+        policy.user_model.get_item.return_value = None
+        assert policy.remember(Mock(_user=None), 'user1') == []
+
+    def test_forget(self):
+        assert self._policy().forget(Mock()) == []
+
+
+@pytest.mark.usefixtures('engine_mock')
+class TestSetupSignedTokenPolicy(object):
+
+    def test_no_secret(self):
+        from ramses import auth
+        with pytest.raises(ValueError) as ex:
+            auth._setup_signed_token_policy(config='', params={})
+        expected = 'Missing required security scheme settings: secret'
+        assert expected == str(ex.value)
+
+    @patch('ramses.auth.SignedTokenAuthenticationPolicy')
+    def test_policy_params(self, mock_policy):
+        from ramses import auth
+        config = Mock()
+        config.registry.settings = {'my_secret': 12345}
+        policy = auth._setup_signed_token_policy(
+            config, {'secret': 'my_secret', 'expires': '60'})
+        mock_policy.assert_called_once_with(
+            secret=12345, expires='60',
+            user_model=config.registry.auth_model)
+        assert policy == mock_policy()
+        config.add_request_method.assert_called_once_with(
+            mock_policy().get_user, 'user', reify=True)
+
+    @patch('ramses.auth.SignedTokenAuthenticationPolicy')
+    def test_routes_views_added(self, mock_policy):
+        from ramses import auth
+        config = Mock()
+        config.registry.settings = {'my_secret': 12345}
+        root = Mock()
+        config.get_root_resource.return_value = root
+        auth._setup_signed_token_policy(config, {'secret': 'my_secret'})
+        names = [call[0][0] for call in root.add.call_args_list]
+        assert names == ['register', 'login', 'logout']
+        for call in root.add.call_args_list:
+            assert call[1]['prefix'] == 'auth'
+            assert call[1]['factory'] == 'nefertari.acl.AuthenticationACL'
+            assert call[1]['view'].Model is config.registry.auth_model
+
+    def test_scheme_registered(self):
+        from ramses import auth
+        assert auth.AUTHENTICATION_POLICIES['x-SignedToken'] is (
+            auth._setup_signed_token_policy)
+
+
 @pytest.mark.usefixtures('engine_mock')
 class TestSetupAuthPolicies(object):
 
@@ -219,6 +704,7 @@ class TestSetupAuthPolicies(object):
         scheme.name = 'foo'
         raml_data = Mock(secured_by=['foo'], security_schemes=[scheme])
         config = Mock()
+        config.registry.settings = {}
         mock_setup = Mock()
         with patch.dict(auth.AUTHENTICATION_POLICIES, {'mytype': mock_setup}):
             auth.setup_auth_policies(config, raml_data)
@@ -229,6 +715,21 @@ class TestSetupAuthPolicies(object):
         config.set_authorization_policy.assert_called_once_with(
             mock_acl())
 
+    @patch('ramses.acl.CachingACLAuthorizationPolicy')
+    def test_acl_cache_policy(self, mock_acl):
+        from ramses import auth
+        scheme = Mock(type='mytype', settings={})
+        scheme.name = 'foo'
+        raml_data = Mock(secured_by=['foo'], security_schemes=[scheme])
+        config = Mock()
+        config.registry.settings = {
+            'acl_cache.enable': 'true', 'acl_cache.max_size': '50'}
+        with patch.dict(auth.AUTHENTICATION_POLICIES, {'mytype': Mock()}):
+            auth.setup_auth_policies(config, raml_data)
+        mock_acl.assert_called_once_with(max_size=50)
+        config.set_authorization_policy.assert_called_once_with(
+            mock_acl())
+
 
 @pytest.mark.usefixtures('engine_mock')
 class TestHelperFunctions(object):
@@ -241,10 +742,9 @@ class TestHelperFunctions(object):
         assert not config.registry.auth_model.get_or_create.called
 
     @patch('ramses.auth.transaction')
-    @patch('ramses.auth.cryptacular')
-    def test_create_system_user_exists(self, mock_crypt, mock_trans):
+    @patch('ramses.auth.hasher')
+    def test_create_system_user_exists(self, encoder, mock_trans):
         from ramses import auth
-        encoder = mock_crypt.bcrypt.BCRYPTPasswordManager()
         encoder.encode.return_value = '654321'
         config = Mock()
         config.registry.settings = {
@@ -267,10 +767,9 @@ class TestHelperFunctions(object):
         )
 
     @patch('ramses.auth.transaction')
-    @patch('ramses.auth.cryptacular')
-    def test_create_system_user_created(self, mock_crypt, mock_trans):
+    @patch('ramses.auth.hasher')
+    def test_create_system_user_created(self, encoder, mock_trans):
         from ramses import auth
-        encoder = mock_crypt.bcrypt.BCRYPTPasswordManager()
         encoder.encode.return_value = '654321'
         config = Mock()
         config.registry.settings = {
@@ -0,0 +1,584 @@
+import time
+
+import pytest
+from mock import Mock, patch, ANY
+from nefertari import events
+from nefertari.elasticsearch import _ESDocs
+from nefertari.utils import dict2obj
+
+from ramses import cache
+
+from .fixtures import config_mock
+
+
+def wait_for_waiters(flight, key, count, timeout=5):
+    """ Wait until :count: threads wait for call with :key: which is
+    in flight.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        call = flight._calls.get(key)
+        if call is not None and call.waiters >= count:
+            return
+        time.sleep(0.001)
+    raise AssertionError('Threads did not wait for call in flight')
+
+
+class TestLRUCache(object):
+
+    def test_set_get(self):
+        lru = cache.LRUCache(max_size=2)
+        lru.set('a', 1)
+        assert lru.get('a') == 1
+        assert lru.get('b', 'default') == 'default'
+        assert lru.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+    def test_lru_eviction(self):
+        lru = cache.LRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        assert lru.get('a') == 1
+        assert lru.get('b') is None
+        assert lru.get('c') == 3
+
+    @patch('ramses.cache.time')
+    def test_ttl(self, mock_time):
+        mock_time.time.return_value = 100
+        lru = cache.LRUCache(ttl=10)
+        lru.set('a', 1)
+        lru.set('b', 2, ttl=20)
+        mock_time.time.return_value = 105
+        assert lru.lookup('a') == (1, 5)
+        mock_time.time.return_value = 115
+        assert lru.lookup('a') == (None, None)
+        assert lru.lookup('b') == (2, 15)
+
+    def test_delete_clear(self):
+        lru = cache.LRUCache()
+        lru.set('a', 1)
+        lru.set('b', 1)
+        lru.incr('x')
+        lru.delete('a')
+        assert lru.get('a') is None
+        lru.clear()
+        assert len(lru) == 0
+        assert lru.counter('x') == 0
+
+    def test_counters(self):
+        lru = cache.LRUCache(max_size=1)
+        assert lru.counter('x') == 0
+        assert lru.incr('x') == 1
+        lru.set('a', 1)
+        lru.set('b', 1)
+        assert lru.counter('x') == 1
+
+    def test_counters_overflow_clears_cache(self):
+        lru = cache.LRUCache(max_counters=2)
+        lru.incr('x')
+        lru.incr('y')
+        lru.set('a', 1)
+        assert lru.incr('x') == 2
+        assert lru.incr('z') == 1
+        assert lru.counter('x') == 0
+        assert lru.get('a') is None
+
+
+class TestSharedMemoryCache(object):
+
+    def _cache(self, tmpdir, **kwargs):
+        path = str(tmpdir.join('cache'))
+        params = dict(slots=8, slot_size=256)
+        params.update(kwargs)
+        return cache.SharedMemoryCache(path, **params)
+
+    def test_set_get(self, tmpdir):
+        shared = self._cache(tmpdir)
+        shared.set('a', {'foo': [1, 2]})
+        assert shared.get('a') == {'foo': [1, 2]}
+        assert shared.get('b', 'default') == 'default'
+        assert shared.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+    def test_shared_between_instances(self, tmpdir):
+        shared1 = self._cache(tmpdir)
+        shared2 = self._cache(tmpdir)
+        shared1.set('a', 1)
+        assert shared2.get('a') == 1
+        shared2.incr('x')
+        assert shared1.counter('x') == 1
+
+    def test_shared_between_processes(self, tmpdir):
+        import os
+        shared = self._cache(tmpdir)
+        shared.set('a', 1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                shared.set('b', shared.get('a') + 1)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert shared.get('b') == 2
+
+    @patch('ramses.cache.time')
+    def test_ttl(self, mock_time, tmpdir):
+        mock_time.time.return_value = 100
+        shared = self._cache(tmpdir, ttl=10)
+        shared.set('a', 1)
+        shared.set('b', 2, ttl=20)
+        mock_time.time.return_value = 105
+        assert shared.lookup('a') == (1, 5)
+        mock_time.time.return_value = 115
+        assert shared.lookup('a') == (None, None)
+        assert shared.lookup('b') == (2, 15)
+
+    def test_too_big_value_not_cached(self, tmpdir):
+        shared = self._cache(tmpdir)
+        shared.set('a', 'x' * 1000)
+        assert shared.get('a') is None
+
+    def test_eviction(self, tmpdir):
+        shared = self._cache(tmpdir, slots=4)
+        for key in 'abcde':
+            shared.set(key, key)
+        assert len(shared) == 4
+        assert shared.get('a') is None
+        assert shared.get('e') == 'e'
+
+    def test_delete_clear(self, tmpdir):
+        shared = self._cache(tmpdir)
+        shared.set('a', 1)
+        shared.set('b', 1)
+        shared.incr('x')
+        shared.delete('a')
+        assert shared.get('a') is None
+        assert shared.get('b') == 1
+        shared.clear()
+        assert len(shared) == 0
+        assert shared.counter('x') == 0
+
+    def test_counters_overflow_clears_cache(self, tmpdir):
+        shared = self._cache(tmpdir, counter_slots=2)
+        shared.incr('x')
+        shared.incr('y')
+        shared.set('a', 1)
+        assert shared.incr('x') == 2
+        assert shared.incr('z') == 1
+        assert shared.counter('x') == 0
+        assert shared.get('a') is None
+
+    def test_layout_change_reinitializes_file(self, tmpdir):
+        self._cache(tmpdir).set('a', 1)
+        shared = self._cache(tmpdir, slot_size=512)
+        assert shared.get('a') is None
+        shared.set('a', 2)
+        assert shared.get('a') == 2
+
+    def test_not_json_value_not_cached(self, tmpdir):
+        shared = self._cache(tmpdir)
+        shared.set('a', object())
+        assert shared.get('a') is None
+
+    def test_namespaces(self, tmpdir):
+        shared1 = self._cache(tmpdir, namespace='app1')
+        shared2 = self._cache(tmpdir, namespace='app2')
+        shared1.set('a', 1)
+        shared1.incr('x')
+        assert shared2.get('a') is None
+        assert shared2.counter('x') == 0
+
+    def test_public_directory_refused(self, tmpdir):
+        tmpdir.chmod(0o777)
+        with pytest.raises(ValueError):
+            self._cache(tmpdir).get('a')
+
+    def test_symlink_refused(self, tmpdir):
+        tmpdir.join('other').write('')
+        tmpdir.join('cache').mksymlinkto(tmpdir.join('other'))
+        with pytest.raises(OSError):
+            self._cache(tmpdir).get('a')
+
+    def test_file_of_other_user_refused(self, tmpdir):
+        import os
+        import stat
+        shared = self._cache(tmpdir)
+        tmpdir.join('cache').write('')
+        file_stat = Mock(st_uid=os.getuid() + 1,
+                         st_mode=stat.S_IFREG | 0o666)
+        with patch.object(os, 'fstat', return_value=file_stat):
+            with pytest.raises(ValueError):
+                shared.get('a')
+
+    def test_file_made_private(self, tmpdir):
+        import stat
+        tmpdir.join('cache').write('')
+        tmpdir.join('cache').chmod(0o666)
+        self._cache(tmpdir).set('a', 1)
+        mode = tmpdir.join('cache').stat().mode
+        assert stat.S_IMODE(mode) == 0o600
+
+    def test_get_shared_backend(self, tmpdir):
+        config = config_mock()
+        config.registry._ramses_shared_cache = None
+        config.registry.settings = {
+            'cache.shared.path': str(tmpdir.join('cache')),
+            'cache.shared.namespace': 'myapp',
+            'cache.shared.slots': '16',
+        }
+        backend = cache.get_shared_backend(config)
+        assert backend.slots == 16
+        assert backend.slot_size == 16384
+        assert backend.namespace == 'myapp'
+        assert cache.get_shared_backend(config) is backend
+
+    def test_get_shared_backend_path_required(self):
+        config = config_mock()
+        config.registry._ramses_shared_cache = None
+        config.registry.settings = {}
+        with pytest.raises(ValueError):
+            cache.get_shared_backend(config)
+
+
+class TestSingleFlight(object):
+
+    def _run_concurrently(self, flight, func, count=5):
+        import threading
+        results = []
+
+        def target():
+            try:
+                results.append(flight.do('key', func))
+            except Exception as ex:
+                results.append(ex)
+
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_single_call(self):
+        flight = cache.SingleFlight()
+        assert flight.do('key', lambda: 1) == (1, False)
+        assert flight.do('key', lambda: 2) == (2, False)
+
+    def test_concurrent_calls_coalesced(self):
+        import threading
+        flight = cache.SingleFlight()
+        release = threading.Event()
+        func = Mock(side_effect=lambda: release.wait() and 42)
+        threads, results = self._run_concurrently(flight, func)
+        wait_for_waiters(flight, 'key', 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+        func.assert_called_once_with()
+        assert sorted(results) == [(42, False)] + [(42, True)] * 4
+        assert flight._calls == {}
+
+    def test_error_shared(self):
+        import threading
+        flight = cache.SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait()
+            raise ValueError('foo')
+
+        threads, results = self._run_concurrently(flight, func, count=3)
+        wait_for_waiters(flight, 'key', 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 3
+        assert all(isinstance(res, ValueError) for res in results)
+        assert flight._calls == {}
+
+
+class TestFreezeThaw(object):
+
+    def test_document(self):
+        doc = dict2obj({'id': 1, 'tags': ['a']})
+        data = cache.freeze(doc)
+        doc.tags.append('b')
+        copy1 = cache.thaw(data)
+        copy2 = cache.thaw(data)
+        assert copy1.tags == ['a']
+        copy1.tags.append('c')
+        assert copy2.tags == ['a']
+
+    def test_documents(self):
+        docs = _ESDocs([dict2obj({'id': 1}), dict2obj({'id': 2})])
+        docs._nefertari_meta = {'total': 2, 'start': 0}
+        result = cache.thaw(cache.freeze(docs))
+        assert isinstance(result, _ESDocs)
+        assert [doc.id for doc in result] == [1, 2]
+        assert result._nefertari_meta == {'total': 2, 'start': 0}
+
+    def test_value(self):
+        assert cache.thaw(cache.freeze(3)) == 3
+        assert cache.thaw(cache.freeze([])) == []
+
+
+class TestResourceCache(object):
+
+    def _cache(self):
+        return cache.ResourceCache('Story', backend=cache.LRUCache(), ttl=5)
+
+    def test_get_or_load(self):
+        res_cache = self._cache()
+        loader = Mock(return_value=dict2obj({'id': 1}))
+        key = res_cache.item_key(1, ['system.Everyone'])
+        assert res_cache.get_or_load(key, loader).id == 1
+        assert res_cache.get_or_load(key, loader).id == 1
+        loader.assert_called_once_with()
+        assert res_cache.stats()['hits'] == 1
+
+    @patch('ramses.cache.time')
+    def test_soft_ttl_expired(self, mock_time):
+        mock_time.time.return_value = 100
+        res_cache = self._cache()
+        res_cache.hard_ttl = 20
+        loader = Mock(side_effect=[[1], [2]])
+        assert res_cache.get_or_load('foo', loader) == [1]
+        mock_time.time.return_value = 110
+        assert res_cache.get_or_load('foo', loader) == [2]
+        assert loader.call_count == 2
+
+    @patch('ramses.cache.threading.Thread')
+    @patch('ramses.cache.time')
+    def test_stale_while_revalidate(self, mock_time, mock_thread):
+        mock_time.time.return_value = 100
+        res_cache = self._cache()
+        res_cache.hard_ttl = 20
+        loader = Mock(side_effect=[[1], [2]])
+        res_cache.get_or_load('foo', loader, revalidate=True)
+        mock_time.time.return_value = 110
+        assert res_cache.get_or_load('foo', loader, revalidate=True) == [1]
+        assert res_cache.get_or_load('foo', loader, revalidate=True) == [1]
+        mock_thread.assert_called_once_with(target=ANY)
+        assert res_cache.stats()['stale'] == 2
+
+        refresh = mock_thread.call_args[1]['target']
+        refresh()
+        assert loader.call_count == 2
+        assert res_cache._refreshing == set()
+        assert res_cache.get_or_load('foo', loader, revalidate=True) == [2]
+
+    @patch('ramses.cache.threading.Thread')
+    @patch('ramses.cache.time')
+    def test_stale_hard_ttl_expired(self, mock_time, mock_thread):
+        mock_time.time.return_value = 100
+        res_cache = self._cache()
+        res_cache.hard_ttl = 20
+        loader = Mock(side_effect=[[1], [2]])
+        res_cache.get_or_load('foo', loader, revalidate=True)
+        mock_time.time.return_value = 125
+        assert res_cache.get_or_load('foo', loader, revalidate=True) == [2]
+        assert not mock_thread.called
+
+    @patch('ramses.cache.log')
+    @patch('ramses.cache.threading.Thread')
+    @patch('ramses.cache.time')
+    def test_refresh_error(self, mock_time, mock_thread, mock_log):
+        mock_time.time.return_value = 100
+        res_cache = self._cache()
+        res_cache.hard_ttl = 20
+        loader = Mock(side_effect=[[1], ValueError])
+        res_cache.get_or_load('foo', loader, revalidate=True)
+        mock_time.time.return_value = 110
+        res_cache.get_or_load('foo', loader, revalidate=True)
+        mock_thread.call_args[1]['target']()
+        assert mock_log.error.called
+        assert res_cache._refreshing == set()
+        assert res_cache.get_or_load('foo', loader, revalidate=True) == [1]
+
+    def test_zero_ttl_not_stored(self):
+        res_cache = self._cache()
+        res_cache.ttl = 0
+        loader = Mock(return_value=dict2obj({'id': 1}))
+        res_cache.get_or_load('foo', loader)
+        res_cache.get_or_load('foo', loader)
+        assert loader.call_count == 2
+        assert len(res_cache.backend) == 0
+
+    def test_concurrent_misses_coalesced(self):
+        import threading
+        res_cache = self._cache()
+        release = threading.Event()
+        loader = Mock(side_effect=lambda: release.wait() and [1])
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                res_cache.get_or_load('foo', loader)))
+            for i in range(3)]
+        for thread in threads:
+            thread.start()
+        wait_for_waiters(res_cache._flight, 'foo', 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        loader.assert_called_once_with()
+        assert results == [[1], [1], [1]]
+        assert res_cache.stats()['coalesced'] == 2
+
+    def test_loader_error_not_cached(self):
+        res_cache = self._cache()
+        loader = Mock(side_effect=ValueError)
+        with pytest.raises(ValueError):
+            res_cache.get_or_load('foo', loader)
+        assert len(res_cache.backend) == 0
+
+    def test_keys_depend_on_principals(self):
+        res_cache = self._cache()
+        assert (res_cache.item_key(1, ['a']) !=
+                res_cache.item_key(1, ['a', 'b']))
+        assert (res_cache.collection_key('/s', {'q': 1}, ['b', 'a']) ==
+                res_cache.collection_key('/s', {'q': 1}, ['a', 'b']))
+        assert (res_cache.collection_key('/s', {'q': 1}, ['a']) !=
+                res_cache.collection_key('/s', {'q': 2}, ['a']))
+
+    def test_invalidate_create(self):
+        res_cache = self._cache()
+        coll_key = res_cache.collection_key('/s', {}, [])
+        item_key = res_cache.item_key(1, [])
+        event = events.AfterCreate(
+            model=None, view=None, instance=dict2obj({'_pk': 2}))
+        res_cache.invalidate(event)
+        assert res_cache.collection_key('/s', {}, []) != coll_key
+        assert res_cache.item_key(1, []) == item_key
+
+    def test_invalidate_update(self):
+        res_cache = self._cache()
+        coll_key = res_cache.collection_key('/s', {}, [])
+        item_key = res_cache.item_key(1, [])
+        other_key = res_cache.item_key(2, [])
+        event = events.AfterUpdate(
+            model=None, view=None, instance=dict2obj({'_pk': 1}))
+        res_cache.invalidate(event)
+        assert res_cache.collection_key('/s', {}, []) != coll_key
+        assert res_cache.item_key(1, []) != item_key
+        assert res_cache.item_key(2, []) == other_key
+
+    def test_invalidate_db_instance(self):
+        res_cache = self._cache()
+        item_key = res_cache.item_key(1, [])
+        instance = Mock(id=1)
+        instance.pk_field.return_value = 'id'
+        event = events.AfterDelete(model=None, view=None, instance=instance)
+        res_cache.invalidate(event)
+        assert res_cache.item_key(1, []) != item_key
+
+    def test_invalidate_many(self):
+        res_cache = self._cache()
+        item_key = res_cache.item_key(1, [])
+        event = events.AfterUpdateMany(model=None, view=None)
+        res_cache.invalidate(event)
+        assert res_cache.item_key(1, []) != item_key
+
+    def test_invalidate_after_commit(self):
+        res_cache = self._cache()
+        request = Mock(environ={'tm.active': True})
+        request.registry.indexing_queue = None
+        event = events.AfterUpdate(
+            model=None, view=Mock(request=request),
+            instance=dict2obj({'_pk': 1}))
+        res_cache.invalidate(event)
+        coll_key = res_cache.collection_key('/s', {}, [])
+        item_key = res_cache.item_key(1, [])
+        hook = request.tm.get().addAfterCommitHook.call_args[0][0]
+        hook(True)
+        assert res_cache.collection_key('/s', {}, []) != coll_key
+        assert res_cache.item_key(1, []) != item_key
+
+    def test_invalidate_after_indexing(self):
+        res_cache = self._cache()
+        request = Mock(environ={})
+        event = events.AfterCreate(
+            model=None, view=Mock(request=request), instance=None)
+        res_cache.invalidate(event)
+        coll_key = res_cache.collection_key('/s', {}, [])
+        queue = request.registry.indexing_queue
+        callback = queue.call_after_flush.call_args[0][0]
+        callback()
+        assert res_cache.collection_key('/s', {}, []) != coll_key
+
+
+class TestSetupResourceCache(object):
+
+    def test_get_cache_settings(self):
+        resource = Mock(security_schemes=[
+            Mock(type='x-ACL'), Mock(type='x-Cache', settings={'ttl': 3})])
+        assert cache.get_cache_settings(resource) == {'ttl': 3}
+        resource = Mock(security_schemes=None)
+        assert cache.get_cache_settings(resource) is None
+
+    def test_no_scheme(self):
+        config = config_mock()
+        resource = Mock(security_schemes=[])
+        assert cache.setup_resource_cache(config, Mock(), resource) is None
+        assert not config.subscribe_to_events.called
+
+    @patch('nefertari.engine', create=True)
+    def test_setup(self, mock_engine):
+        config = config_mock()
+        config.registry._ramses_caches = None
+        resource = Mock(
+            path='/stories',
+            security_schemes=[Mock(
+                type='x-Cache', settings={'ttl': '3', 'max_size': 10})])
+        model_cls = Mock(__name__='Story', _nested_relationships=['owner'])
+        parent_model = Mock()
+        res_cache = cache.setup_resource_cache(
+            config, model_cls, resource, parent_model=parent_model)
+        assert res_cache.model_name == 'Story'
+        assert res_cache.ttl == 3
+        assert res_cache.backend.max_size == 10
+        mock_engine.get_relationship_cls.assert_called_once_with(
+            'owner', model_cls)
+        assert config.subscribe_to_events.call_count == 3
+        call = config.subscribe_to_events.call_args_list[0]
+        assert call[0][0] == res_cache.invalidate
+        assert events.AfterUpdate in call[0][1]
+        assert call[1] == {'model': model_cls}
+        call = config.subscribe_to_events.call_args_list[2]
+        assert call[0][0] == res_cache.invalidate_related
+        assert call[1] == {'model': parent_model}
+        assert cache.get_stats(config.registry) == {
+            '/stories': {
+                'hits': 0, 'misses': 0, 'coalesced': 0, 'stale': 0,
+                'size': 0}}
+
+    @patch('ramses.cache.get_shared_backend')
+    def test_setup_shared(self, mock_shared):
+        config = config_mock()
+        config.registry._ramses_caches = None
+        resource = Mock(
+            path='/stories',
+            security_schemes=[Mock(
+                type='x-Cache', settings={'backend': 'shared'})])
+        model_cls = Mock(__name__='Story', _nested_relationships=[])
+        res_cache = cache.setup_resource_cache(config, model_cls, resource)
+        mock_shared.assert_called_once_with(config)
+        assert res_cache.backend == mock_shared()
+
+    def test_setup_hard_ttl(self):
+        config = config_mock()
+        config.registry._ramses_caches = None
+        resource = Mock(security_schemes=[Mock(
+            type='x-Cache', settings={'ttl': 5, 'hard_ttl': '60'})])
+        model_cls = Mock(__name__='Story', _nested_relationships=[])
+        res_cache = cache.setup_resource_cache(config, model_cls, resource)
+        assert res_cache.ttl == 5
+        assert res_cache.hard_ttl == 60
+
+        resource.security_schemes[0].settings['hard_ttl'] = 3
+        with pytest.raises(ValueError):
+            cache.setup_resource_cache(config, model_cls, resource)
+
+    def test_setup_unknown_backend(self):
+        config = config_mock()
+        resource = Mock(security_schemes=[Mock(
+            type='x-Cache', settings={'backend': 'foo'})])
+        with pytest.raises(ValueError):
+            cache.setup_resource_cache(config, Mock(), resource)
@@ -0,0 +1,330 @@
+import pytest
+from mock import Mock, patch, call
+
+from ramses import counters
+
+from .fixtures import config_mock
+
+
+def _model(name):
+    model = Mock(__name__=name)
+    model.pk_field.return_value = 'id'
+    return model
+
+
+def _counter(engine_name='nefertari_mongodb'):
+    return counters.CounterCache(
+        _model('User'), 'stories', _model('Story'), 'owner',
+        'stories_count', engine_name=engine_name)
+
+
+def _event(**kwargs):
+    kwargs.setdefault('view', Mock(spec=['request']))
+    kwargs.setdefault('fields', {})
+    kwargs.setdefault('instance', None)
+    kwargs.setdefault('response', None)
+    return Mock(**kwargs)
+
+
+class TestEngineFunctions(object):
+
+    def test_mongodb_increment(self):
+        model = _model('User')
+        counters._mongodb_increment(model, [1, 2], 'stories_count', -1)
+        model.objects.assert_called_once_with(id__in=[1, 2])
+        model.objects().update.assert_called_once_with(
+            inc__stories_count=-1)
+
+    def test_engines(self):
+        counter = _counter('nefertari_sqla')
+        assert counter.increment is counters._sqla_increment
+        assert counter.reload is counters._sqla_reload
+        with pytest.raises(KeyError):
+            _counter('foo')
+
+
+class TestCounterCache(object):
+
+    def test_get_parent_ids(self):
+        counter = _counter()
+        assert counter.get_parent_ids(None) == []
+        assert counter.get_parent_ids(Mock(owner=None)) == []
+        assert counter.get_parent_ids(Mock(owner=Mock(id=1))) == [1]
+        assert counter.get_parent_ids(Mock(owner={'id': 2})) == [2]
+        assert counter.get_parent_ids(Mock(owner='3')) == ['3']
+        assert counter.get_parent_ids(
+            Mock(owner=[Mock(id=1), Mock(id=2)])) == [1, 2]
+
+    def test_get_child(self):
+        counter = _counter()
+        counter.reload = Mock()
+        child = counter.get_child(Mock(id=1))
+        assert child is counter.child_model.get_item.return_value
+        counter.child_model.get_item.assert_called_once_with(
+            _raise_on_empty=False, id=1)
+        assert not counter.reload.called
+        counter.get_child(1, reload=True)
+        counter.reload.assert_called_once_with(child)
+
+    def test_apply(self):
+        counter = _counter()
+        counter.increment = Mock()
+        parents = {1: Mock(stories_count=5), 3: Mock(stories_count=1)}
+        counter.parent_model.get_item.side_effect = (
+            lambda _raise_on_empty, id: parents[id])
+        counter.apply([1, 2], [2, 3], request='req')
+        counter.increment.assert_has_calls([
+            call(counter.parent_model, [1], 'stories_count', -1),
+            call(counter.parent_model, [3], 'stories_count', 1),
+        ])
+        parents[1]._es_update_fields.assert_called_once_with(
+            ['stories_count'], request='req')
+        parents[3]._es_update_fields.assert_called_once_with(
+            ['stories_count'], request='req')
+
+    def test_apply_nothing_changed(self):
+        counter = _counter()
+        counter.increment = Mock()
+        counter.apply([1], [1])
+        assert not counter.increment.called
+        assert not counter.parent_model.get_item.called
+
+    def test_apply_not_indexed_parent(self):
+        counter = _counter()
+        counter.increment = Mock()
+        counter.parent_model.get_item.return_value = Mock(spec=[])
+        counter.apply([], [1])
+        counter.increment.assert_called_once_with(
+            counter.parent_model, [1], 'stories_count', 1)
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_apply_parent_reindexed(self, mock_es):
+        counter = _counter()
+        counter.increment = Mock()
+
+        class User(object):
+            _index_enabled = True
+            stories_count = 1
+
+            def to_dict(self):
+                return {'_pk': 1, 'stories_count': 1}
+
+        counter.parent_model.get_item.return_value = User()
+        counter.apply([], [1], request='req')
+        mock_es.assert_called_once_with('User')
+        mock_es().index.assert_called_once_with(
+            {'_pk': 1, 'stories_count': 1}, request='req')
+
+    def test_reset(self):
+        counter = _counter()
+        parent = Mock(stories=[1, 2], stories_count=1)
+        counted = Mock(stories=[], stories_count=0)
+        counter.get_parent = Mock(side_effect=[parent, counted, None])
+        counter.reset([1, 2, 3], request='req')
+        parent.update.assert_called_once_with({'stories_count': 2}, 'req')
+        assert not counted.update.called
+
+    def test_child_create(self):
+        counter = _counter()
+        counter.apply = Mock()
+        event = _event(response=Mock(owner=Mock(id=1)))
+        counter.after_child_create(event)
+        counter.apply.assert_called_once_with(
+            [], [1], request=event.view.request)
+
+    def test_child_update(self):
+        counter = _counter()
+        counter.apply = Mock()
+        counter.get_child = Mock(side_effect=[
+            Mock(owner=Mock(id=1)), Mock(owner=Mock(id=2))])
+        instance = Mock(id=5)
+        event = _event(instance=instance)
+        counter.before_child_change(event)
+        counter.after_child_update(event)
+        counter.get_child.assert_has_calls([
+            call(instance), call(instance, reload=True)])
+        counter.apply.assert_called_once_with(
+            [1], [2], request=event.view.request)
+
+    def test_child_delete(self):
+        counter = _counter()
+        counter.apply = Mock()
+        counter.get_child = Mock(return_value=Mock(owner=Mock(id=1)))
+        event = _event(instance=Mock(id=5))
+        counter.before_child_change(event)
+        counter.after_child_delete(event)
+        counter.apply.assert_called_once_with(
+            [1], [], request=event.view.request)
+
+    def test_children_update(self):
+        counter = _counter()
+        counter.apply = Mock()
+        counter.get_child = Mock(side_effect=[
+            Mock(owner=Mock(id=3)), None])
+        view = Mock(spec=['request', 'get_collection'])
+        view.get_collection.return_value = [
+            Mock(id=5, owner=Mock(id=1)), Mock(id=6, owner=Mock(id=2))]
+        event = _event(view=view)
+        counter.before_children_change(event)
+        counter.after_children_update(event)
+        view.get_collection.assert_called_once_with()
+        counter.get_child.assert_has_calls([
+            call(5, reload=True), call(6, reload=True)])
+        counter.apply.assert_called_once_with(
+            [1, 2], [3], request=view.request)
+
+    def test_children_delete_es_view(self):
+        counter = _counter()
+        counter.apply = Mock()
+        view = Mock(spec=['request', 'get_dbcollection_with_es'])
+        view.get_dbcollection_with_es.return_value = [
+            Mock(id=5, owner=Mock(id=1)), Mock(id=6, owner=Mock(id=1)),
+            Mock(id=7, owner=None)]
+        event = _event(view=view)
+        counter.before_children_change(event)
+        counter.after_children_delete(event)
+        view.get_dbcollection_with_es.assert_called_once_with()
+        counter.apply.assert_called_once_with(
+            [1, 1], [], request=view.request)
+
+    def test_protect_counter_field(self):
+        counter = _counter()
+        view = Mock(_json_params={'name': 'a', 'stories_count': 10})
+        event = _event(
+            view=view, fields={'name': Mock(), 'stories_count': Mock()})
+        counter.protect_counter_field(event)
+        assert view._json_params == {'name': 'a'}
+        assert list(event.fields) == ['name']
+
+    def test_parent_change(self):
+        counter = _counter()
+        counter.reset = Mock()
+        counter.get_child = Mock(side_effect=[
+            Mock(owner=Mock(id=2)), Mock(owner=None)])
+        event = _event(
+            fields={'stories': Mock(new_value=[7, 8])},
+            instance=Mock(id=1))
+        counter.before_parent_change(event)
+        counter.after_parent_change(event)
+        counter.get_child.assert_has_calls([call(7), call(8)])
+        counter.reset.assert_called_once_with(
+            [1, 2], request=event.view.request)
+
+    def test_parent_created(self):
+        counter = _counter()
+        counter.reset = Mock()
+        counter.get_child = Mock(return_value=None)
+        event = _event(fields={'stories': Mock(new_value=7)})
+        counter.before_parent_change(event)
+        event.response = Mock(id=1)
+        counter.after_parent_change(event)
+        counter.reset.assert_called_once_with(
+            [1], request=event.view.request)
+
+    def test_parent_field_not_changed(self):
+        counter = _counter()
+        counter.reset = Mock()
+        counter.get_child = Mock()
+        event = _event(fields={'name': Mock()}, instance=Mock(id=1))
+        counter.before_parent_change(event)
+        counter.after_parent_change(event)
+        assert not counter.get_child.called
+        assert not counter.reset.called
+
+
+@patch.dict(counters.counter_caches, clear=True)
+@patch('ramses.counters.engine')
+class TestSetupCounterCache(object):
+
+    def _schema(self, counter_cache='stories_count', counter_type='integer'):
+        return {'properties': {
+            'stories': {
+                '_db_settings': {
+                    'type': 'relationship',
+                    'document': 'Story',
+                    'backref_name': 'owner',
+                },
+                '_counter_cache': counter_cache,
+            },
+            'stories_count': {'_db_settings': {'type': counter_type}},
+            'name': {'_db_settings': {'type': 'string'}},
+        }}
+
+    def _config(self):
+        config = config_mock()
+        config.registry.settings = {'nefertari.engine': 'nefertari_mongodb'}
+        return config
+
+    def test_not_set(self, mock_eng):
+        config = self._config()
+        assert counters.setup_counter_cache(
+            config, 'User', 'name', self._schema()) is None
+        assert not config.subscribe_to_events.called
+
+    @patch('ramses.counters.get_events_map')
+    def test_setup(self, mock_map, mock_eng):
+        from nefertari import events
+        mock_map.return_value = {
+            'before': events.BEFORE_EVENTS, 'after': events.AFTER_EVENTS}
+        config = self._config()
+        user = _model('User')
+        story = mock_eng.get_document_cls.return_value
+        counter = counters.setup_counter_cache(
+            config, user, 'stories', self._schema())
+        mock_eng.get_document_cls.assert_called_once_with('Story')
+        assert counters.counter_caches == {('User', 'stories'): counter}
+        assert counter.parent_model is user
+        assert counter.child_model is story
+        assert counter.backref_name == 'owner'
+        assert counter.counter_field == 'stories_count'
+        config.subscribe_to_events.assert_has_calls([
+            call(counter.before_child_change,
+                 [events.BeforeUpdate, events.BeforeReplace,
+                  events.BeforeDelete], model=story),
+            call(counter.after_child_create, [events.AfterCreate],
+                 model=story),
+            call(counter.after_child_update,
+                 [events.AfterUpdate, events.AfterReplace], model=story),
+            call(counter.after_child_delete, [events.AfterDelete],
+                 model=story),
+            call(counter.before_children_change,
+                 [events.BeforeUpdateMany, events.BeforeDeleteMany],
+                 model=story),
+            call(counter.after_children_update, [events.AfterUpdateMany],
+                 model=story),
+            call(counter.after_children_delete, [events.AfterDeleteMany],
+                 model=story),
+            call(counter.protect_counter_field,
+                 [events.BeforeCreate, events.BeforeUpdate,
+                  events.BeforeReplace, events.BeforeUpdateMany],
+                 model=user),
+            call(counter.before_parent_change,
+                 [events.BeforeCreate, events.BeforeUpdate,
+                  events.BeforeReplace], model=user),
+            call(counter.after_parent_change,
+                 [events.AfterCreate, events.AfterUpdate,
+                  events.AfterReplace], model=user),
+        ])
+
+    def test_default_counter_field(self, mock_eng):
+        schema = self._schema(counter_cache=True)
+        counter = counters.setup_counter_cache(
+            self._config(), _model('User'), 'stories', schema)
+        assert counter.counter_field == 'stories_count'
+
+    def test_not_relationship(self, mock_eng):
+        schema = self._schema()
+        schema['properties']['stories']['_db_settings']['type'] = 'list'
+        with pytest.raises(ValueError):
+            counters.setup_counter_cache(
+                self._config(), 'User', 'stories', schema)
+
+    def test_invalid_counter_field(self, mock_eng):
+        with pytest.raises(ValueError):
+            counters.setup_counter_cache(
+                self._config(), 'User', 'stories',
+                self._schema(counter_cache='foo'))
+        with pytest.raises(ValueError):
+            counters.setup_counter_cache(
+                self._config(), 'User', 'stories',
+                self._schema(counter_type='string'))
@@ -143,6 +143,7 @@ class TestGenerateResource(object):
             config, raml_resource, parent_resource)
         assert new_resource is None
 
+    @patch('ramses.generators.setup_resource_cache')
     @patch('ramses.generators.dynamic_part_name')
     @patch('ramses.generators.singular_subresource')
     @patch('ramses.generators.attr_subresource')
@@ -152,7 +153,7 @@ class TestGenerateResource(object):
     @patch('ramses.generators.generate_rest_view')
     def test_full_run(
             self, generate_view, view_attrs, generate_acl, get_model,
-            attr_res, singular_res, mock_dyn):
+            attr_res, singular_res, mock_dyn, mock_cache):
         mock_dyn.return_value = 'fooid'
         model_cls = Mock()
         model_cls.pk_field.return_value = 'my_id'
@@ -166,8 +167,12 @@ class TestGenerateResource(object):
         res = generators.generate_resource(
             config, raml_resource, parent_resource)
         get_model.assert_called_once_with('Story')
+        mock_cache.assert_called_once_with(
+            config, model_cls=model_cls, raml_resource=raml_resource,
+            parent_model=parent_resource.view.Model)
         generate_acl.assert_called_once_with(
-            config, model_cls=model_cls, raml_resource=raml_resource)
+            config, model_cls=model_cls, raml_resource=raml_resource,
+            cache=mock_cache())
         mock_dyn.assert_called_once_with(
             raml_resource=raml_resource,
             clean_uri='stories', pk_field='my_id')
@@ -177,7 +182,8 @@ class TestGenerateResource(object):
             model_cls=model_cls,
             attrs=view_attrs(),
             attr_view=False,
-            singular=False
+            singular=False,
+            cache=mock_cache(),
         )
         parent_resource.add.assert_called_once_with(
             'story', 'stories',
@@ -187,6 +193,7 @@ class TestGenerateResource(object):
         )
         assert res == parent_resource.add()
 
+    @patch('ramses.generators.setup_resource_cache')
     @patch('ramses.generators.dynamic_part_name')
     @patch('ramses.generators.singular_subresource')
     @patch('ramses.generators.attr_subresource')
@@ -196,7 +203,7 @@ class TestGenerateResource(object):
     @patch('ramses.generators.generate_rest_view')
     def test_full_run_singular(
             self, generate_view, view_attrs, generate_acl, get_model,
-            attr_res, singular_res, mock_dyn):
+            attr_res, singular_res, mock_dyn, mock_cache):
         mock_dyn.return_value = 'fooid'
         model_cls = Mock()
         model_cls.pk_field.return_value = 'my_id'
@@ -211,9 +218,10 @@ class TestGenerateResource(object):
         res = generators.generate_resource(
             config, raml_resource, parent_resource)
         get_model.assert_called_once_with('Story')
+        assert not mock_cache.called
         generate_acl.assert_called_once_with(
             config, model_cls=parent_resource.view.Model,
-            raml_resource=raml_resource)
+            raml_resource=raml_resource, cache=None)
         assert not mock_dyn.called
         view_attrs.assert_called_once_with(raml_resource, True)
         generate_view.assert_called_once_with(
@@ -221,7 +229,8 @@ class TestGenerateResource(object):
             model_cls=parent_resource.view.Model,
             attrs=view_attrs(),
             attr_view=False,
-            singular=True
+            singular=True,
+            cache=None,
         )
         parent_resource.add.assert_called_once_with(
             'story',
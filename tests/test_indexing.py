@@ -0,0 +1,960 @@
+import pytest
+from mock import Mock, patch, call
+
+from ramses import indexing
+
+
+def _action(id_, op='index', **data):
+    action = {'_op_type': op, '_index': 'foo', '_type': 'story', '_id': id_}
+    action.update(data)
+    return action
+
+
+class TestMergeActions(object):
+
+    def test_no_pending(self):
+        new = _action('1', 'update', doc={'a': 1})
+        assert indexing.merge_actions(None, new) is new
+
+    def test_index_replaces(self):
+        new = _action('1', _source={'a': 1})
+        assert indexing.merge_actions(_action('1', 'delete'), new) is new
+        old = _action('1', 'update', doc={'b': 1})
+        assert indexing.merge_actions(old, new) is new
+
+    def test_delete_replaces(self):
+        new = _action('1', 'delete')
+        old = _action('1', _source={'a': 1})
+        assert indexing.merge_actions(old, new) is new
+
+    def test_update_merged_into_index(self):
+        old = _action('1', _source={'a': 1, 'b': 1})
+        new = _action('1', 'update', doc={'b': 2})
+        merged = indexing.merge_actions(old, new)
+        assert merged == _action('1', _source={'a': 1, 'b': 2})
+        assert old['_source'] == {'a': 1, 'b': 1}
+
+    def test_update_merged_into_update(self):
+        old = _action('1', 'update', doc={'a': 1})
+        new = _action('1', 'update', doc={'b': 2})
+        assert indexing.merge_actions(old, new) == _action(
+            '1', 'update', doc={'a': 1, 'b': 2})
+
+    def test_update_upsert_replaced(self):
+        old = _action('1', 'update', doc={'a': 1}, upsert={'a': 1})
+        new = _action('1', 'update', doc={'b': 2}, upsert={'a': 1, 'b': 2})
+        assert indexing.merge_actions(old, new) == _action(
+            '1', 'update', doc={'a': 1, 'b': 2}, upsert={'a': 1, 'b': 2})
+        merged = indexing.merge_actions(_action('1', _source={'a': 1}), new)
+        assert merged == _action('1', _source={'a': 1, 'b': 2})
+
+    def test_update_after_delete(self):
+        new = _action('1', 'update', doc={'b': 2})
+        assert indexing.merge_actions(_action('1', 'delete'), new) is new
+
+
+@patch('ramses.indexing.IndexingQueue._ensure_worker')
+class TestIndexingQueue(object):
+
+    def test_put_coalesces(self, mock_worker):
+        queue = indexing.IndexingQueue()
+        assert queue.put([_action('1', _source={'a': 1}), _action('2')])
+        assert queue.put([_action('1', 'update', doc={'a': 2})])
+        assert len(queue) == 2
+        assert list(queue._actions.values()) == [
+            _action('2'), _action('1', _source={'a': 2})]
+        assert mock_worker.call_count == 2
+
+    def test_put_closed(self, mock_worker):
+        queue = indexing.IndexingQueue()
+        queue._closed = True
+        assert not queue.put([_action('1')])
+        assert len(queue) == 0
+
+    def test_put_full_timeout(self, mock_worker):
+        queue = indexing.IndexingQueue(max_size=2, timeout=0.01)
+        assert queue.put([_action('1'), _action('2')])
+        assert not queue.put([_action('3')])
+        assert queue.put([_action('2', 'delete')])
+        assert len(queue) == 2
+
+    def test_put_bigger_than_queue(self, mock_worker):
+        queue = indexing.IndexingQueue(max_size=1, timeout=0)
+        assert queue.put([_action('1'), _action('2')])
+        assert len(queue) == 2
+
+    def test_next_batch(self, mock_worker):
+        queue = indexing.IndexingQueue(batch_size=2, flush_interval=0.01)
+        queue.put([_action('1'), _action('2'), _action('3')])
+        assert queue._next_batch() == [_action('1'), _action('2')]
+        assert queue._in_flight == 2
+        assert queue._next_batch() == [_action('3')]
+        queue._closed = True
+        assert queue._next_batch() is None
+
+    def test_bulk_body_no_request(self, mock_worker):
+        queue = indexing.IndexingQueue(sync_bulk=Mock())
+        queue.bulk_body([_action('1')], request=None)
+        assert len(queue) == 1
+        assert not queue.sync_bulk.called
+
+    def test_bulk_body_after_commit(self, mock_worker):
+        queue = indexing.IndexingQueue(sync_bulk=Mock())
+        request = Mock(params={}, environ={'tm.active': True})
+        queue.bulk_body([_action('1')], request=request)
+        assert len(queue) == 0
+        hook = request.tm.get().addAfterCommitHook.call_args[0][0]
+        hook(False)
+        assert len(queue) == 0
+        hook(True)
+        assert len(queue) == 1
+        assert not queue.sync_bulk.called
+
+    def test_bulk_body_no_transaction(self, mock_worker):
+        queue = indexing.IndexingQueue(sync_bulk=Mock())
+        request = Mock(params={}, environ={})
+        queue.bulk_body([_action('1')], request=request)
+        assert len(queue) == 1
+        assert not queue.sync_bulk.called
+
+    def test_bulk_body_refresh(self, mock_worker):
+        queue = indexing.IndexingQueue(sync_bulk=Mock())
+        request = Mock(params={'_refresh_index': 'true'})
+        queue.bulk_body([_action('1')], request=request)
+        queue.sync_bulk.assert_called_once_with([_action('1')], request)
+        assert len(queue) == 0
+
+    def test_bulk_body_queue_closed(self, mock_worker):
+        queue = indexing.IndexingQueue(sync_bulk=Mock())
+        queue._closed = True
+        queue.bulk_body([_action('1')])
+        queue.sync_bulk.assert_called_once_with([_action('1')], None)
+
+
+class TestIndexingQueueWorker(object):
+
+    @patch('ramses.indexing.IndexingQueue._send')
+    def test_flush_and_close(self, mock_send):
+        queue = indexing.IndexingQueue(batch_size=2, flush_interval=0.01)
+        queue.put([_action('1'), _action('2'), _action('3')])
+        assert queue.flush(timeout=5)
+        assert mock_send.call_count == 2
+        mock_send.assert_any_call([_action('1'), _action('2')])
+        mock_send.assert_any_call([_action('3')])
+        assert queue.close(timeout=5)
+        queue._thread.join(5)
+        assert not queue._thread.is_alive()
+
+    @patch('ramses.indexing.IndexingQueue._send')
+    def test_close_drains_queue(self, mock_send):
+        queue = indexing.IndexingQueue(batch_size=10, flush_interval=10)
+        queue.put([_action('1')])
+        assert queue.close(timeout=5)
+        mock_send.assert_called_once_with([_action('1')])
+
+    def test_call_after_flush(self):
+        import threading
+        sending = threading.Event()
+        release = threading.Event()
+        done = threading.Event()
+
+        def send(batch):
+            sending.set()
+            release.wait(5)
+
+        queue = indexing.IndexingQueue(batch_size=1, flush_interval=0.01)
+        callback = Mock()
+        queue.call_after_flush(callback)
+        callback.assert_called_once_with()
+
+        with patch.object(queue, '_send', side_effect=send):
+            queue.put([_action('1')])
+            assert sending.wait(5)
+            queue.call_after_flush(done.set)
+            assert not done.is_set()
+            release.set()
+            assert done.wait(5)
+            assert queue.close(timeout=5)
+
+    def test_close_runs_callbacks(self):
+        queue = indexing.IndexingQueue()
+        callback = Mock()
+        queue._callbacks = [(1, callback)]
+        queue._closed = True
+        queue.close(timeout=0)
+        callback.assert_called_once_with()
+        assert queue._callbacks == []
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_worker_survives_errors(self, mock_es, mock_bulk):
+        mock_bulk.side_effect = [Exception, (1, [])]
+        queue = indexing.IndexingQueue(flush_interval=0.01)
+        queue.put([_action('1')])
+        queue.flush(timeout=5)
+        queue.put([_action('2')])
+        assert queue.close(timeout=5)
+        assert mock_bulk.call_count == 2
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_send(self, mock_es, mock_bulk):
+        mock_bulk.return_value = (1, [])
+        queue = indexing.IndexingQueue()
+        queue._send([_action('1')])
+        mock_bulk.assert_called_once_with(
+            client=mock_es.api, actions=[_action('1')],
+            raise_on_error=False)
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_send_routed(self, mock_es, mock_bulk):
+        mock_bulk.return_value = (1, [])
+        queue = indexing.IndexingQueue()
+        queue.routers.append(lambda actions: actions[1:])
+        queue._send([_action('1'), _action('2')])
+        mock_bulk.assert_called_once_with(
+            client=mock_es.api, actions=[_action('2')],
+            raise_on_error=False)
+        mock_bulk.reset_mock()
+        queue._send([_action('1')])
+        assert not mock_bulk.called
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_send_error(self, mock_es, mock_bulk):
+        mock_bulk.side_effect = Exception
+        queue = indexing.IndexingQueue()
+        queue._send([_action('1')])
+
+    @patch('ramses.indexing.log')
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_send_missing_delete(self, mock_es, mock_bulk, mock_log):
+        mock_bulk.return_value = (0, [{'delete': {'status': 404}}])
+        queue = indexing.IndexingQueue()
+        queue._send([_action('1', 'delete')])
+        assert not mock_log.error.called
+        mock_bulk.return_value = (0, [{'index': {'status': 400}}])
+        queue._send([_action('1')])
+        assert mock_log.error.called
+
+
+class TestSetupIndexingQueue(object):
+
+    def test_disabled(self):
+        config = Mock()
+        config.registry.settings = {}
+        assert indexing.setup_indexing_queue(config) is None
+
+    @patch('ramses.indexing.atexit')
+    def test_enabled(self, mock_atexit):
+        from nefertari import elasticsearch
+        bulk_body = elasticsearch._bulk_body
+        config = Mock()
+        config.registry.settings = {
+            'indexing_queue.enable': 'true',
+            'indexing_queue.max_size': '100',
+            'indexing_queue.batch_size': '10',
+            'indexing_queue.flush_interval': '0.5',
+        }
+        try:
+            queue = indexing.setup_indexing_queue(config)
+            assert queue.max_size == 100
+            assert queue.batch_size == 10
+            assert queue.flush_interval == 0.5
+            assert queue.timeout == 10
+            assert queue.sync_bulk is bulk_body
+            assert elasticsearch._bulk_body == queue.bulk_body
+            assert config.registry.indexing_queue is queue
+            mock_atexit.register.assert_called_once_with(queue.close)
+        finally:
+            elasticsearch._bulk_body = bulk_body
+
+
+@patch('nefertari.elasticsearch.ES')
+class TestIndexAlias(object):
+
+    def test_version_name(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        assert alias.version_name(3) == 'foo_v3'
+        assert alias.get_version('foo_v12') == 12
+        assert alias.get_version('foo') == 0
+        assert alias.get_version(None) == 0
+
+    def test_current_index(self, mock_es):
+        mock_es.api.indices.get_alias.return_value = {'foo_v2': {}}
+        alias = indexing.IndexAlias('foo')
+        assert alias.current_index() == 'foo_v2'
+        mock_es.api.indices.get_alias.assert_called_once_with(name='foo')
+
+    def test_current_index_missing(self, mock_es):
+        from nefertari.json_httpexceptions import JHTTPNotFound
+        mock_es.api.indices.get_alias.side_effect = JHTTPNotFound
+        alias = indexing.IndexAlias('foo')
+        assert alias.current_index() is None
+        assert alias.building_index() is None
+
+    def test_create(self, mock_es):
+        from nefertari.elasticsearch import IndexNotFoundException
+        mock_es.api.indices.get_alias.return_value = {}
+        mock_es.api.indices.exists.side_effect = IndexNotFoundException
+        alias = indexing.IndexAlias('foo')
+        assert alias.create()
+        mock_es.api.indices.create.assert_called_once_with(
+            index='foo_v1', body=None)
+        mock_es.api.indices.put_alias.assert_called_once_with(
+            index='foo_v1', name='foo')
+
+    def test_create_alias_exists(self, mock_es):
+        mock_es.api.indices.get_alias.return_value = {'foo_v1': {}}
+        assert indexing.IndexAlias('foo').create()
+        assert not mock_es.api.indices.create.called
+
+    def test_create_index_exists(self, mock_es):
+        mock_es.api.indices.get_alias.return_value = {}
+        mock_es.api.indices.exists.return_value = True
+        assert not indexing.IndexAlias('foo').create()
+        assert not mock_es.api.indices.create.called
+
+    def test_start_rebuild(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        alias.building_index = Mock(return_value=None)
+        alias.current_index = Mock(return_value='foo_v2')
+        model = Mock(__name__='Story')
+        model.get_es_source_mapping.return_value = None
+        assert alias.start_rebuild([model], body={'settings': {}}) == (
+            'foo_v3')
+        mock_es.api.indices.create.assert_called_once_with(
+            index='foo_v3', body={'settings': {}})
+        mock_es.assert_called_once_with('Story', index_name='foo_v3')
+        mock_es().put_mapping.assert_called_once_with(
+            body=model.get_es_mapping())
+        mock_es.api.indices.put_alias.assert_called_once_with(
+            index='foo_v3', name='foo_building')
+
+    def test_start_rebuild_resumed(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        alias.building_index = Mock(return_value='foo_v3')
+        assert alias.start_rebuild([Mock()]) == 'foo_v3'
+        assert not mock_es.api.indices.create.called
+
+    def test_finish_rebuild(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        alias.current_index = Mock(return_value='foo_v2')
+        alias.finish_rebuild('foo_v3', delete_old=True)
+        mock_es.api.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': 'foo_v2', 'alias': 'foo'}},
+                {'remove': {'index': 'foo_v3', 'alias': 'foo_building'}},
+                {'add': {'index': 'foo_v3', 'alias': 'foo'}},
+            ]})
+        mock_es.api.indices.delete.assert_called_once_with(index='foo_v2')
+
+    def test_finish_rebuild_keep_old(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        alias.current_index = Mock(return_value='foo_v2')
+        alias.finish_rebuild('foo_v3')
+        assert not mock_es.api.indices.delete.called
+
+    def test_finish_rebuild_from_plain_index(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        alias.current_index = Mock(return_value=None)
+        alias._index_exists = Mock(return_value=True)
+        alias.finish_rebuild('foo_v1', delete_old=True)
+        mock_es.api.indices.delete.assert_called_once_with(index='foo')
+        mock_es.api.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': 'foo_v1', 'alias': 'foo_building'}},
+                {'add': {'index': 'foo_v1', 'alias': 'foo'}},
+            ]})
+
+    @patch('ramses.indexing.time')
+    def test_rebuilding_index_cached(self, mock_time, mock_es):
+        alias = indexing.IndexAlias('foo', check_interval=5)
+        alias.building_index = Mock(return_value='foo_v2')
+        mock_time.time.return_value = 100
+        assert alias.rebuilding_index() == 'foo_v2'
+        mock_time.time.return_value = 104
+        assert alias.rebuilding_index() == 'foo_v2'
+        assert alias.building_index.call_count == 1
+        mock_time.time.return_value = 105
+        alias.rebuilding_index()
+        assert alias.building_index.call_count == 2
+
+    def test_bulk_body(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        alias.sync_bulk = Mock()
+        alias.rebuilding_index = Mock(return_value=None)
+        actions = [{'_index': 'foo', '_id': '1'}]
+        alias.bulk_body(actions, 'request')
+        alias.sync_bulk.assert_called_once_with(actions, 'request')
+
+    def test_bulk_body_dual_write(self, mock_es):
+        alias = indexing.IndexAlias('foo')
+        alias.sync_bulk = Mock()
+        alias.rebuilding_index = Mock(return_value='foo_v2')
+        actions = [
+            {'_index': 'foo', '_id': '1'}, {'_index': 'bar', '_id': '2'}]
+        alias.bulk_body(actions, 'request')
+        alias.sync_bulk.assert_called_once_with([
+            {'_index': 'foo', '_id': '1'},
+            {'_index': 'bar', '_id': '2'},
+            {'_index': 'foo_v2', '_id': '1'},
+        ], 'request')
+
+    def test_bulk_body_delete_during_rebuild(self, mock_es):
+        from elasticsearch.helpers import BulkIndexError
+        alias = indexing.IndexAlias('foo')
+        error = {'delete': {'_index': 'foo_v2', '_id': '1', 'status': 404}}
+        alias.sync_bulk = Mock(side_effect=[
+            None, BulkIndexError('1 document(s) failed', [error])])
+        alias.rebuilding_index = Mock(return_value='foo_v2')
+        deleted = {'_op_type': 'delete', '_index': 'foo', '_id': '1'}
+        alias.bulk_body([deleted], 'request')
+        assert alias.sync_bulk.call_args_list == [
+            call([deleted], 'request'),
+            call([dict(deleted, _index='foo_v2')], 'request'),
+        ]
+
+    def test_bulk_body_delete_error(self, mock_es):
+        from elasticsearch.helpers import BulkIndexError
+        alias = indexing.IndexAlias('foo')
+        error = {'delete': {'_index': 'foo_v2', '_id': '1', 'status': 500}}
+        alias.sync_bulk = Mock(side_effect=[
+            None, BulkIndexError('1 document(s) failed', [error])])
+        alias.rebuilding_index = Mock(return_value='foo_v2')
+        with pytest.raises(BulkIndexError):
+            alias.bulk_body(
+                [{'_op_type': 'delete', '_index': 'foo', '_id': '1'}])
+
+
+class TestSetupIndexAliases(object):
+
+    def test_disabled(self):
+        config = Mock()
+        config.registry.settings = {}
+        assert indexing.setup_index_aliases(config) is None
+        assert indexing.rebuilding_index() is None
+
+    @patch.dict(indexing.index_settings, {'foo_event': {'a': 1}})
+    @patch('nefertari.elasticsearch.ES')
+    @patch('ramses.indexing.IndexAlias')
+    def test_enabled(self, mock_alias, mock_es):
+        from nefertari import elasticsearch
+        bulk_body = elasticsearch._bulk_body
+        config = Mock()
+        config.registry.settings = {
+            'index_aliases.enable': 'true',
+            'index_aliases.check_interval': '2',
+        }
+        mock_es.settings.index_name = 'foo'
+        alias, event_alias = Mock(), Mock()
+        mock_alias.side_effect = [alias, event_alias]
+        try:
+            aliases = indexing.setup_index_aliases(config)
+            assert aliases == {'foo': alias, 'foo_event': event_alias}
+            mock_alias.assert_any_call('foo', check_interval=2)
+            mock_alias.assert_any_call('foo_event', check_interval=2)
+            alias.create.assert_called_once_with(body=None)
+            event_alias.create.assert_called_once_with(
+                body={'settings': {'a': 1}})
+            assert alias.sync_bulk is bulk_body
+            assert event_alias.sync_bulk is alias.bulk_body
+            assert elasticsearch._bulk_body is event_alias.bulk_body
+            assert config.registry.index_aliases is aliases
+            alias.rebuilding_index.return_value = None
+            assert indexing.rebuilding_index() is (
+                event_alias.rebuilding_index.return_value)
+        finally:
+            elasticsearch._bulk_body = bulk_body
+            indexing._index_aliases.clear()
+
+
+@patch.dict(indexing.index_settings, clear=True)
+@patch.dict(indexing.model_indices, clear=True)
+class TestModelIndices(object):
+
+    def test_register_model_index(self):
+        indexing.register_model_index('Event', 'foo_event', {'a': 1})
+        indexing.register_model_index('Log', 'foo_event')
+        assert indexing.model_indices == {
+            'Event': 'foo_event', 'Log': 'foo_event'}
+        assert indexing.index_settings == {'foo_event': {'a': 1}}
+
+    def test_get_index_name(self):
+        indexing.register_model_index('Event', 'foo_event')
+        indexing.register_model_index('Log', 'foo_event')
+        assert indexing.get_index_name('Story', 'foo') == 'foo'
+        assert indexing.get_index_name('Event', 'foo') == 'foo_event'
+        assert indexing.get_index_name(
+            'Event,Story,Log', 'foo') == 'foo_event,foo'
+        assert indexing.get_index_name('', 'foo') == 'foo'
+        assert indexing.get_index_name(None, 'foo') == 'foo'
+
+    def test_get_index_body(self):
+        indexing.register_model_index('Event', 'foo_event', {'a': 1})
+        indexing.register_model_index('Log', 'foo_log')
+        assert indexing.get_index_body('foo_event') == {
+            'settings': {'a': 1}}
+        assert indexing.get_index_body('foo_log') is None
+        assert indexing.get_index_body('foo') is None
+
+    @patch('nefertari.engine', create=True)
+    def test_get_index_models(self, mock_engine):
+        story = Mock(_index_enabled=True)
+        event = Mock(_index_enabled=True)
+        log = Mock(_index_enabled=False)
+        mock_engine.get_document_classes.return_value = {
+            'Story': story, 'Event': event, 'Log': log}
+        indexing.register_model_index('Event', 'foo_event')
+        indexing.register_model_index('Log', 'foo_event')
+        assert indexing.get_index_models('foo', 'foo') == [story]
+        assert indexing.get_index_models('foo_event', 'foo') == [event]
+
+    def test_route_es_wrapper(self):
+        from nefertari.elasticsearch import ES
+        init, settings = ES.__init__, ES.settings
+        indexing.register_model_index('Event', 'foo_event')
+        try:
+            ES.settings = Mock(index_name='foo', chunk_size=10)
+            indexing._route_es_wrapper()
+            indexing._route_es_wrapper()
+            assert indexing._es_init is init
+            assert ES('Event').index_name == 'foo_event'
+            assert ES('Story').index_name == 'foo'
+            assert ES('Event', index_name='bar').index_name == 'bar'
+        finally:
+            ES.__init__ = init
+            indexing._es_init = None
+            ES.settings = settings
+
+    def test_get_type_mapping(self):
+        model = Mock(__name__='Story')
+        model.get_es_mapping.return_value = {'Story': {'properties': {}}}
+        model.get_es_source_mapping.return_value = {'excludes': ['body']}
+        assert indexing.get_type_mapping(model) == {'Story': {
+            'properties': {}, '_source': {'excludes': ['body']}}}
+        model.get_es_source_mapping.return_value = None
+        assert indexing.get_type_mapping(model) == {
+            'Story': {'properties': {}}}
+        del model.get_es_source_mapping
+        assert indexing.get_type_mapping(model) == {
+            'Story': {'properties': {}}}
+
+    @patch('nefertari.engine', create=True)
+    def test_source_mapping_wrapper(self, mock_engine):
+        from nefertari.elasticsearch import ES
+        put_mapping = ES.put_mapping
+        mock_put = Mock()
+        ES.put_mapping = mock_put
+        model = mock_engine.get_document_cls()
+        model.__name__ = 'Story'
+        model.get_es_source_mapping.return_value = {'excludes': ['body']}
+        try:
+            indexing.setup_type_mappings(Mock())
+            indexing._source_mapping_wrapper()
+            assert indexing._es_put_mapping is mock_put
+            es = Mock(doc_type='Story')
+            ES.put_mapping(es, body={'Story': {'properties': {}}})
+            mock_put.assert_called_once_with(es, body={'Story': {
+                'properties': {}, '_source': {'excludes': ['body']}}})
+            mock_put.reset_mock()
+            mock_engine.get_document_cls.side_effect = ValueError
+            ES.put_mapping(es, body={'Story': {'properties': {}}})
+            mock_put.assert_called_once_with(
+                es, body={'Story': {'properties': {}}})
+        finally:
+            ES.put_mapping = put_mapping
+            indexing._es_put_mapping = None
+
+    def test_skip_indexing(self):
+        from nefertari.elasticsearch import ES
+        index = ES.index
+        index_relations = ES.__dict__['index_relations']
+        mock_index = Mock()
+        mock_relations = Mock()
+        ES.index = mock_index
+        ES.index_relations = classmethod(mock_relations)
+
+        class Story(object):
+            id = 1
+
+            def pk_field(self):
+                return 'id'
+
+        story = Story()
+        es = Mock(doc_type='Story')
+        try:
+            with indexing.skip_indexing('Story', 1) as skipped:
+                assert indexing._es_index[0] is mock_index
+                ES.index(es, [{'_pk': 1, 'a': 1}, {'_pk': 2}], request='r')
+                mock_index.assert_called_once_with(
+                    es, [{'_pk': 2}], request='r')
+                ES.index_relations(story, request='r')
+                assert not mock_relations.called
+            assert skipped == {'document': {'_pk': 1, 'a': 1}}
+            mock_index.reset_mock()
+            ES.index(es, {'_pk': 1}, request='r')
+            mock_index.assert_called_once_with(es, {'_pk': 1}, request='r')
+            ES.index_relations(story, request='r')
+            mock_relations.assert_called_once_with(ES, story, request='r')
+        finally:
+            ES.index = index
+            ES.index_relations = index_relations
+            indexing._es_index = None
+
+    @patch('ramses.indexing._route_es_wrapper')
+    def test_setup_model_indices_none(self, mock_route):
+        assert indexing.setup_model_indices(Mock()) is None
+        assert not mock_route.called
+
+    @patch('ramses.indexing._index_exists')
+    @patch('nefertari.elasticsearch.ES')
+    @patch('ramses.indexing._route_es_wrapper')
+    def test_setup_model_indices(self, mock_route, mock_es, mock_exists):
+        mock_exists.side_effect = lambda name: name != 'foo_event'
+        indexing.register_model_index('Event', 'foo_event', {
+            'number_of_shards': 1, 'number_of_replicas': 0})
+        indexing.register_model_index('Log', 'foo_log', {
+            'number_of_shards': 1, 'refresh_interval': '30s'})
+        indexing.register_model_index('Tag', 'foo_tag', {
+            'number_of_shards': 1})
+        indexing.setup_model_indices(Mock())
+        mock_route.assert_called_once_with()
+        mock_es.api.indices.create.assert_called_once_with(
+            index='foo_event', body={'settings': {
+                'number_of_shards': 1, 'number_of_replicas': 0}})
+        mock_es.api.indices.put_settings.assert_called_once_with(
+            index='foo_log', body={'refresh_interval': '30s'})
+
+
+class TestParseRange(object):
+
+    def test_parse_date(self):
+        from datetime import datetime
+        assert indexing._parse_date('2015-01-31T10:00:00Z') == datetime(
+            2015, 1, 31)
+        assert indexing._parse_date('"2015-01"') == datetime(2015, 1, 1)
+        assert indexing._parse_date('2015') == datetime(2015, 1, 1)
+        assert indexing._parse_date(
+            '2015-01-31 10:00:00.123+02:00') == datetime(2015, 1, 31)
+        assert indexing._parse_date('now-1d') is None
+
+    def test_parse_date_malformed(self):
+        assert indexing._parse_date('2024-13') is None
+        assert indexing._parse_date('2024-02-30') is None
+        assert indexing._parse_date('2024-1') is None
+        assert indexing._parse_date('2015-01-31foo') is None
+        assert indexing._parse_date('20150131') is None
+
+    def test_range(self):
+        from datetime import datetime
+        assert indexing._parse_range('[2015-01-01 TO 2015-02-10]') == (
+            datetime(2015, 1, 1), datetime(2015, 2, 10))
+        assert indexing._parse_range('{* TO 2015-02-10}') == (
+            None, datetime(2015, 2, 10))
+        assert indexing._parse_range('[2015-01-01 TO now]') == (
+            datetime(2015, 1, 1), None)
+
+    def test_comparison(self):
+        from datetime import datetime
+        assert indexing._parse_range('>=2015-01-01') == (
+            datetime(2015, 1, 1), None)
+        assert indexing._parse_range('<2015-01-01') == (
+            None, datetime(2015, 1, 1))
+
+    def test_value(self):
+        from datetime import datetime
+        assert indexing._parse_range('2015-01-01') == (
+            datetime(2015, 1, 1), datetime(2015, 1, 1))
+        assert indexing._parse_range('foo') == (None, None)
+        assert indexing._parse_range(['2015-03-01', '2015-01-01']) == (
+            datetime(2015, 1, 1), datetime(2015, 3, 1))
+        assert indexing._parse_range(['2015-03-01', 'foo']) == (None, None)
+
+
+@patch('nefertari.elasticsearch.ES')
+class TestPartitionedIndex(object):
+
+    def _index(self, mock_es, **kwargs):
+        mock_es.src2type.side_effect = lambda source: source
+        kwargs.setdefault('interval', 'daily')
+        return indexing.PartitionedIndex(
+            'foo_event', 'Event', 'created_at', **kwargs)
+
+    def test_invalid_options(self, mock_es):
+        with pytest.raises(ValueError):
+            self._index(mock_es, interval='hourly')
+        with pytest.raises(ValueError):
+            self._index(mock_es, retention_action='archive')
+
+    def test_partition_name(self, mock_es):
+        from datetime import datetime
+        value = datetime(2015, 1, 31, 10)
+        index = self._index(mock_es)
+        assert index.partition_name(value) == 'foo_event-2015.01.31'
+        assert index.period_start(value) == datetime(2015, 1, 31)
+        index = self._index(mock_es, interval='monthly')
+        assert index.partition_name(value) == 'foo_event-2015.01'
+        assert index.period_start(value) == datetime(2015, 1, 1)
+
+    def test_get_partitions(self, mock_es):
+        from datetime import datetime
+        mock_es.api.indices.get_settings.return_value = {
+            'foo_event-2015.01.31': {}, 'foo_event-old': {}}
+        partitions = self._index(mock_es).get_partitions('all')
+        assert partitions == {'foo_event-2015.01.31': datetime(2015, 1, 31)}
+        mock_es.api.indices.get_settings.assert_called_once_with(
+            index='foo_event-*', expand_wildcards='all')
+
+    def test_get_partitions_not_found(self, mock_es):
+        from nefertari.json_httpexceptions import JHTTPNotFound
+        mock_es.api.indices.get_settings.side_effect = JHTTPNotFound()
+        assert self._index(mock_es).get_partitions() == {}
+
+    def test_get_document_date(self, mock_es):
+        from datetime import date, datetime
+        index = self._index(mock_es)
+        assert index.get_document_date(
+            {'created_at': date(2015, 1, 31)}) == date(2015, 1, 31)
+        assert index.get_document_date(
+            {'created_at': '2015-01-31T10:00:00'}) == datetime(2015, 1, 31)
+        assert isinstance(index.get_document_date({}), datetime)
+
+    def test_search_index(self, mock_es):
+        mock_es.api.indices.get_settings.return_value = {
+            'foo_event-2015.01.30': {},
+            'foo_event-2015.01.31': {},
+            'foo_event-2015.02.01': {},
+        }
+        index = self._index(mock_es)
+        assert index.search_index({}) == 'foo_event'
+        assert index.search_index({'created_at': 'foo'}) == 'foo_event'
+        assert index.search_index({
+            'created_at': '[2015-01-31T10:00:00 TO 2015-02-01]'}) == (
+            'foo_event-2015.01.31,foo_event-2015.02.01')
+        assert index.search_index({'created_at': '<2015-01-30'}) == (
+            'foo_event-2015.01.30')
+        assert index.search_index({'created_at': '>2015-01-01'}) == (
+            'foo_event')
+        assert index.search_index({'created_at': '2015-03-01'}) is None
+
+    def test_find_indices(self, mock_es):
+        mock_es.api.search.return_value = {'hits': {'hits': [
+            {'_id': '1', '_index': 'foo_event-2015.01.31'}]}}
+        indices = self._index(mock_es).find_indices(['1', '2'])
+        assert indices == {'1': 'foo_event-2015.01.31'}
+        mock_es.api.search.assert_called_once_with(
+            index='foo_event', doc_type='Event',
+            body={'query': {'ids': {'values': ['1', '2']}}},
+            size=2, _source=False)
+
+    def test_route_actions(self, mock_es):
+        index = self._index(mock_es)
+        index.find_indices = Mock(return_value={'2': 'foo_event-2015.01.30'})
+        other = _action('1')
+        story = dict(_action('1'), _index='foo_event', _type='Story')
+        new = dict(_action('1', _source={'created_at': '2015-01-31'}),
+                   _index='foo_event', _type='Event')
+        updated = dict(_action(2, 'update', doc={'a': 1}),
+                       _index='foo_event', _type='Event')
+        deleted = dict(_action(3, 'delete'), _index='foo_event',
+                       _type='Event')
+        actions = index.route_actions([other, story, new, updated, deleted])
+        assert actions == [
+            other, story,
+            dict(new, _index='foo_event-2015.01.31'),
+            dict(updated, _index='foo_event-2015.01.30'),
+        ]
+        index.find_indices.assert_has_calls([call(['2', '3']), call(['3'])])
+        mock_es.api.indices.refresh.assert_called_once_with(
+            index='foo_event')
+
+    def test_route_actions_found_after_refresh(self, mock_es):
+        index = self._index(mock_es)
+        index.find_indices = Mock(side_effect=[
+            {}, {'2': 'foo_event-2015.01.30'}])
+        deleted = dict(_action(2, 'delete'), _index='foo_event',
+                       _type='Event')
+        assert index.route_actions([deleted]) == [
+            dict(deleted, _index='foo_event-2015.01.30')]
+
+    def test_route_actions_all_found(self, mock_es):
+        index = self._index(mock_es)
+        index.find_indices = Mock(return_value={'2': 'foo_event-2015.01.30'})
+        deleted = dict(_action(2, 'delete'), _index='foo_event',
+                       _type='Event')
+        index.route_actions([deleted])
+        index.find_indices.assert_called_once_with(['2'])
+        assert not mock_es.api.indices.refresh.called
+
+    def test_route_actions_upsert(self, mock_es):
+        index = self._index(mock_es)
+        index.find_indices = Mock(return_value={})
+        updated = dict(
+            _action(2, 'update', doc={'a': 1},
+                    upsert={'a': 1, 'created_at': '2015-01-31'}),
+            _index='foo_event', _type='Event')
+        assert index.route_actions([updated]) == [
+            dict(updated, _index='foo_event-2015.01.31')]
+
+    def test_bulk_body(self, mock_es):
+        index = self._index(mock_es)
+        index.sync_bulk = Mock()
+        index.expire = Mock()
+        new = dict(_action('1', _source={'created_at': '2015-01-31'}),
+                   _index='foo_event', _type='Event')
+        index.bulk_body([new], request='req')
+        index.bulk_body([new], request='req')
+        index.expire.assert_called_once_with()
+        index.sync_bulk.assert_called_with(
+            [dict(new, _index='foo_event-2015.01.31')], 'req')
+
+    def test_bulk_body_nothing_routed(self, mock_es):
+        index = self._index(mock_es)
+        index.sync_bulk = Mock()
+        index.find_indices = Mock(return_value={})
+        index.bulk_body(
+            [dict(_action('1', 'delete'), _index='foo_event', _type='Event')])
+        assert not index.sync_bulk.called
+
+    def test_setup(self, mock_es):
+        index = self._index(mock_es, settings={'number_of_shards': 1})
+        index.expire = Mock()
+        index.setup(mapping={'Event': {'properties': {}}})
+        mock_es.api.indices.put_template.assert_called_once_with(
+            name='foo_event', body={
+                'template': 'foo_event-*',
+                'aliases': {'foo_event': {}},
+                'settings': {'number_of_shards': 1},
+                'mappings': {'Event': {'properties': {}}},
+            })
+        current = mock_es.api.indices.create.call_args[1]['index']
+        assert index.partition_date(current) is not None
+        assert current in index._partitions
+        index.expire.assert_called_once_with()
+
+    def test_expire_no_retention(self, mock_es):
+        assert self._index(mock_es).expire() == []
+        assert not mock_es.api.indices.get_settings.called
+
+    def test_expire_close(self, mock_es):
+        from datetime import datetime
+        mock_es.api.indices.get_settings.return_value = {
+            'foo_event-2015.01.29': {},
+            'foo_event-2015.01.30': {},
+            'foo_event-2015.01.31': {},
+        }
+        index = self._index(mock_es, retention=2)
+        expired = index.expire(now=datetime(2015, 1, 31, 10))
+        assert expired == ['foo_event-2015.01.29']
+        mock_es.api.indices.get_settings.assert_called_once_with(
+            index='foo_event-*', expand_wildcards='open')
+        mock_es.api.indices.update_aliases.assert_called_once_with(body={
+            'actions': [{'remove': {
+                'index': 'foo_event-2015.01.29', 'alias': 'foo_event'}}]})
+        mock_es.api.indices.close.assert_called_once_with(
+            index='foo_event-2015.01.29')
+        assert not mock_es.api.indices.delete.called
+
+    def test_expire_delete_monthly(self, mock_es):
+        from datetime import datetime
+        mock_es.api.indices.get_settings.return_value = {
+            'foo_event-2014.10': {},
+            'foo_event-2014.11': {},
+            'foo_event-2014.12': {},
+            'foo_event-2015.01': {},
+        }
+        index = self._index(
+            mock_es, interval='monthly', retention=3,
+            retention_action='delete')
+        expired = index.expire(now=datetime(2015, 1, 31))
+        assert expired == ['foo_event-2014.10']
+        mock_es.api.indices.delete.assert_called_once_with(
+            index='foo_event-2014.10')
+        assert mock_es.api.indices.get_settings.call_args[1][
+            'expand_wildcards'] == 'all'
+
+    def test_expire_error(self, mock_es):
+        from datetime import datetime
+        mock_es.api.indices.get_settings.return_value = {
+            'foo_event-2014.01.01': {}}
+        mock_es.api.indices.close.side_effect = Exception()
+        index = self._index(mock_es, retention=2)
+        assert index.expire(now=datetime(2015, 1, 31)) == []
+
+
+@patch.dict(indexing.partitioned_indices, clear=True)
+@patch.dict(indexing.model_indices, clear=True)
+class TestSetupPartitionedIndices(object):
+
+    def test_register(self):
+        partitioned = Mock(model_name='Event')
+        partitioned.name = 'foo_event'
+        indexing.register_partitioned_index(partitioned)
+        assert indexing.get_partitioned_index('Event') is partitioned
+        assert indexing.get_partitioned_index('Story') is None
+        assert indexing.model_indices == {'Event': 'foo_event'}
+        assert indexing.get_index_name('Event', 'foo') == 'foo_event'
+
+    @patch('nefertari.engine', create=True)
+    def test_setup(self, mock_engine):
+        from nefertari import elasticsearch
+        bulk_body = elasticsearch._bulk_body
+        partitioned = Mock(model_name='Event')
+        partitioned.name = 'foo_event'
+        indexing.register_partitioned_index(partitioned)
+        try:
+            model_cls = mock_engine.get_document_cls()
+            model_cls.get_es_source_mapping.return_value = None
+            mock_engine.get_document_cls.reset_mock()
+            config = Mock()
+            config.registry.indexing_queue = None
+            indexing.setup_partitioned_indices(config)
+            mock_engine.get_document_cls.assert_called_once_with('Event')
+            partitioned.setup.assert_called_once_with(
+                mapping=model_cls.get_es_mapping())
+            assert partitioned.sync_bulk is bulk_body
+            assert elasticsearch._bulk_body is partitioned.bulk_body
+        finally:
+            elasticsearch._bulk_body = bulk_body
+
+    @patch('nefertari.engine', create=True)
+    def test_setup_indexing_queue(self, mock_engine):
+        from nefertari import elasticsearch
+        bulk_body = elasticsearch._bulk_body
+        partitioned = Mock(model_name='Event')
+        partitioned.name = 'foo_event'
+        indexing.register_partitioned_index(partitioned)
+        mock_engine.get_document_cls().get_es_source_mapping.return_value = (
+            None)
+        queue = indexing.IndexingQueue(sync_bulk='sync')
+        config = Mock()
+        config.registry.indexing_queue = queue
+        indexing.setup_partitioned_indices(config)
+        assert queue.routers == [partitioned.route]
+        assert partitioned.sync_bulk == 'sync'
+        assert queue.sync_bulk is partitioned.bulk_body
+        assert elasticsearch._bulk_body is bulk_body
+
+
+class TestSetupMappings(object):
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_setup(self, mock_es):
+        indexing.setup_mappings()
+        mock_es.setup_mappings.assert_called_once_with()
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_disabled(self, mock_es):
+        with indexing.mappings_setup_disabled():
+            indexing.setup_mappings()
+        assert not mock_es.setup_mappings.called
+        assert indexing._mappings_enabled
+
+    def test_disabled_error(self):
+        with pytest.raises(KeyError):
+            with indexing.mappings_setup_disabled():
+                raise KeyError
+        assert indexing._mappings_enabled
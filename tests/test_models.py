@@ -159,7 +159,8 @@ class TestGenerateModelCls(object):
             '_auth_fields': ['auth_field1'],
             '_hidden_fields': ['hidden_field1'],
             '_nested_relationships': ['nested_field1'],
-            '_nesting_depth': 3
+            '_nesting_depth': 3,
+            '_version_field': 'updated_at',
         }
 
     @patch('ramses.models.resolve_to_callable')
@@ -187,6 +188,7 @@ class TestGenerateModelCls(object):
         assert model_cls.__tablename__ == 'story'
         assert model_cls._public_fields == ['public_field1']
         assert model_cls._nesting_depth == 3
+        assert model_cls._version_field == 'updated_at'
         assert model_cls._auth_fields == ['auth_field1']
         assert model_cls._hidden_fields == ['hidden_field1']
         assert model_cls._nested_relationships == ['nested_field1']
@@ -224,6 +226,7 @@ class TestGenerateModelCls(object):
 
     def test_auth_model(self, mock_reg, mock_subscribers, mock_proc):
         from nefertari.authentication.models import AuthModelMethodsMixin
+        from ramses.passwords import RehashPasswordMixin
         from ramses import models
         config = config_mock()
         schema = self._test_schema()
@@ -236,6 +239,7 @@ class TestGenerateModelCls(object):
             raml_resource=None)
         assert auth_model
         assert issubclass(model_cls, AuthModelMethodsMixin)
+        assert issubclass(model_cls, RehashPasswordMixin)
 
     def test_database_acls_option(
             self, mock_reg, mock_subscribers, mock_proc,
@@ -370,6 +374,538 @@ class TestGenerateModelCls(object):
         assert not models.engine.IntervalField.called
 
 
+    def test_es_settings(self, mock_reg, mock_subscribers, mock_proc):
+        from ramses import models
+        config = config_mock()
+        schema = self._test_schema()
+        schema['properties']['body'] = {
+            '_db_settings': {'type': 'text'},
+            '_es_settings': {'index': 'no', '_source': False},
+        }
+        schema['properties']['name'] = {'_db_settings': {}}
+        mock_reg.mget.return_value = {}
+        model_cls, auth_model = models.generate_model_cls(
+            config, schema=schema, model_name='Story',
+            raml_resource=None)
+        assert issubclass(model_cls, models.ESSettingsMixin)
+        assert not issubclass(model_cls, models.PartialIndexMixin)
+        assert model_cls._es_settings == {
+            'body': {'index': 'no', '_source': False}}
+
+    def test_es_partial_updates(self, mock_reg, mock_subscribers, mock_proc):
+        from ramses import models
+        config = config_mock()
+        schema = self._test_schema()
+        schema['_es_partial_updates'] = True
+        schema['properties']['name'] = {'_db_settings': {}}
+        mock_reg.mget.return_value = {}
+        model_cls, auth_model = models.generate_model_cls(
+            config, schema=schema, model_name='Story',
+            raml_resource=None)
+        assert issubclass(model_cls, models.PartialIndexMixin)
+        assert not issubclass(model_cls, models.ESSettingsMixin)
+        model_cls, auth_model = models.generate_model_cls(
+            config, schema=schema, model_name='Story',
+            raml_resource=None, es_based=False)
+        assert not issubclass(model_cls, models.PartialIndexMixin)
+
+    def test_es_settings_not_es_based(
+            self, mock_reg, mock_subscribers, mock_proc):
+        from ramses import models
+        config = config_mock()
+        schema = self._test_schema()
+        schema['properties']['body'] = {
+            '_db_settings': {'type': 'text'},
+            '_es_settings': {'index': 'no'},
+        }
+        mock_reg.mget.return_value = {}
+        model_cls, auth_model = models.generate_model_cls(
+            config, schema=schema, model_name='Story',
+            raml_resource=None, es_based=False)
+        assert not issubclass(model_cls, models.ESSettingsMixin)
+        assert not issubclass(model_cls, models.PartialIndexMixin)
+
+    def test_indexes(self, mock_reg, mock_subscribers, mock_proc):
+        from ramses import models
+        config = config_mock()
+        config.registry.settings = {'nefertari.engine': 'nefertari_mongodb'}
+        schema = self._test_schema()
+        schema['properties']['name'] = {'_db_settings': {}}
+        schema['_indexes'] = ['name']
+        mock_reg.mget.return_value = {}
+        model_cls, auth_model = models.generate_model_cls(
+            config, schema=schema, model_name='Story',
+            raml_resource=None)
+        assert model_cls.meta == {'indexes': [{
+            'fields': ['name'], 'name': 'ix_story_name', 'unique': False}]}
+
+    @patch('ramses.models.setup_es_index')
+    def test_es_index(self, mock_index, mock_reg, mock_subscribers,
+                      mock_proc):
+        from ramses import models
+        config = config_mock()
+        schema = self._test_schema()
+        schema['_es_index'] = {'number_of_shards': 1}
+        mock_reg.mget.return_value = {}
+        models.generate_model_cls(
+            config, schema=schema, model_name='Story',
+            raml_resource=None)
+        mock_index.assert_called_once_with(config, schema, 'Story')
+        mock_index.reset_mock()
+        models.generate_model_cls(
+            config, schema=schema, model_name='Story',
+            raml_resource=None, es_based=False)
+        assert not mock_index.called
+
+
+class TestESSettingsMixin(object):
+
+    def _model(self, es_settings):
+        from ramses import models
+
+        class Base(object):
+            @classmethod
+            def get_es_mapping(cls, _depth=None):
+                return {'Story': {'properties': {
+                    'name': {'type': 'string'},
+                    'body': {'type': 'string'},
+                    'data': {'type': 'object'},
+                }}}
+
+        class Story(models.ESSettingsMixin, Base):
+            _es_settings = es_settings
+
+        return Story
+
+    def test_settings_merged(self):
+        model = self._model({
+            'name': {'index': 'not_analyzed'},
+            'body': {'index': 'no', 'doc_values': False},
+            'data': {'enabled': False},
+        })
+        assert model.get_es_mapping() == {'Story': {'properties': {
+            'name': {'type': 'string', 'index': 'not_analyzed'},
+            'body': {'type': 'string', 'index': 'no',
+                     'doc_values': False},
+            'data': {'type': 'object', 'enabled': False},
+        }}}
+
+    def test_source_excludes(self):
+        settings = {
+            'body': {'_source': False},
+            'data': {'_source': False, 'enabled': False},
+        }
+        model = self._model(settings)
+        mapping = model.get_es_mapping(_depth=1)['Story']
+        assert '_source' not in mapping
+        assert mapping['properties']['body'] == {'type': 'string'}
+        assert mapping['properties']['data'] == {
+            'type': 'object', 'enabled': False}
+        assert model.get_es_source_mapping() == {
+            'excludes': ['body', 'data']}
+        assert settings['body'] == {'_source': False}
+
+    def test_source_excludes_none(self):
+        model = self._model({'name': {'index': 'not_analyzed'}})
+        assert model.get_es_source_mapping() is None
+
+    def test_source_excludes_nested(self):
+        from ramses import models
+        from ramses.indexing import get_type_mapping
+        story = self._model({'body': {'_source': False}})
+
+        class Base(object):
+            @classmethod
+            def get_es_mapping(cls, _depth=None):
+                # Nested mapping is generated as by nefertari engines
+                nested = {'type': 'nested'}
+                nested.update(list(story.get_es_mapping(
+                    _depth=0).values())[0])
+                return {'Author': {'properties': {'stories': nested}}}
+
+        class Author(models.ESSettingsMixin, Base):
+            _es_settings = {'name': {'_source': False}}
+
+        mapping = get_type_mapping(Author)['Author']
+        assert mapping['_source'] == {'excludes': ['name']}
+        assert '_source' not in mapping['properties']['stories']
+        assert get_type_mapping(story)['Story']['_source'] == {
+            'excludes': ['body']}
+
+
+@patch('ramses.models.engine')
+class TestPartialIndexMixin(object):
+
+    def _model(self, es_settings=None):
+        from ramses import models
+
+        class Base(object):
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+            @classmethod
+            def native_fields(cls):
+                return ['id', 'name', 'body', 'data', 'author']
+
+            @classmethod
+            def pk_field(cls):
+                return 'id'
+
+            def to_dict(self, **kwargs):
+                return {'_pk': self.id, '_type': 'Story', 'id': self.id}
+
+            def update(self, params, request=None):
+                self.__dict__.update(params)
+                return self
+
+        class Story(models.PartialIndexMixin, Base):
+            _es_settings = es_settings or {}
+
+        return Story
+
+    def _obj(self, mock_eng, **kwargs):
+        mock_eng.is_relationship_field.side_effect = (
+            lambda field, model: field == 'author')
+        values = dict(id=1, name='foo', body='bar', data={'a': 1})
+        values.update(kwargs)
+        return self._model(kwargs.pop('es_settings', None))(**values)
+
+    def test_es_excluded_fields(self, mock_eng):
+        model = self._model({
+            'name': {'index': 'no'},
+            'body': {'index': 'no', '_source': False},
+            'data': {'enabled': False, '_source': False},
+            'author': {'_source': False},
+        })
+        assert model._es_excluded_fields() == {'body', 'data'}
+
+    def test_es_partial_updates_safe(self, mock_eng):
+        assert self._model()._es_partial_updates_safe()
+        assert self._model({
+            'body': {'index': 'no', '_source': False},
+        })._es_partial_updates_safe()
+        assert not self._model({
+            'body': {'index': 'no', '_source': False},
+            'name': {'_source': False},
+        })._es_partial_updates_safe()
+
+    @patch('ramses.indexing.skip_indexing')
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_update_partial(self, mock_upd, mock_skip, mock_eng):
+        mock_skip.return_value.__enter__.return_value = {
+            'document': {'_pk': 1}}
+        obj = self._obj(mock_eng)
+        request = Mock()
+        assert obj.update({'name': 'foo2', 'body': 'bar'}, request) is obj
+        mock_skip.assert_called_once_with('Story', 1)
+        mock_upd.assert_called_once_with(
+            {'name': 'foo2'}, request, upsert={'_pk': 1})
+
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_update_mutated_value(self, mock_upd, mock_eng):
+        obj = self._obj(mock_eng)
+        data = obj.data
+
+        def update(params, request=None):
+            data['b'] = 2
+            return obj
+        with patch.object(obj.__class__.__bases__[1], 'update') as upd:
+            upd.side_effect = update
+            obj.update({'data': {'b': 2}})
+        mock_upd.assert_called_once_with(
+            {'data': {'a': 1, 'b': 2}}, None, upsert=None)
+
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_update_excluded_fields(self, mock_upd, mock_eng):
+        obj = self._obj(mock_eng, es_settings={
+            'body': {'index': 'no', '_source': False}})
+        obj.update({'body': 'bar2'})
+        mock_upd.assert_called_once_with({}, None, upsert=None)
+
+    @patch('ramses.indexing.skip_indexing')
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_update_source_excludes(self, mock_upd, mock_skip, mock_eng):
+        obj = self._obj(mock_eng, es_settings={'name': {'_source': False}})
+        obj.update({'name': 'foo2'})
+        assert obj.name == 'foo2'
+        assert not mock_skip.called
+        assert not mock_upd.called
+
+    @patch('ramses.indexing.skip_indexing')
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_update_relationship(self, mock_upd, mock_skip, mock_eng):
+        obj = self._obj(mock_eng)
+        obj.update({'name': 'foo2', 'author': 'user1'})
+        assert not mock_skip.called
+        assert not mock_upd.called
+
+    @patch('ramses.indexing.rebuilding_index')
+    @patch('ramses.indexing.skip_indexing')
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_update_index_rebuilding(
+            self, mock_upd, mock_skip, mock_rebuild, mock_eng):
+        mock_rebuild.return_value = 'foo_v2'
+        obj = self._obj(mock_eng)
+        obj.update({'name': 'foo2'})
+        assert not mock_skip.called
+        assert not mock_upd.called
+
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_update_error(self, mock_upd, mock_eng):
+        from ramses import indexing
+        obj = self._obj(mock_eng)
+        with patch.object(obj.__class__.__bases__[1], 'update') as upd:
+            upd.side_effect = KeyError
+            with pytest.raises(KeyError):
+                obj.update({'name': 'foo2'})
+        assert not indexing._skipped_documents()
+        assert not mock_upd.called
+
+    @patch('nefertari.elasticsearch._bulk_body')
+    @patch('nefertari.elasticsearch.ES')
+    def test_es_partial_update(self, mock_es, mock_bulk, mock_eng):
+        obj = self._obj(mock_eng)
+        request = Mock()
+        mock_es.return_value.index_name = 'foo'
+        mock_es.return_value.doc_type = 'story'
+        obj._es_partial_update({'name': 'foo2'}, request)
+        mock_es.assert_called_once_with('Story')
+        mock_bulk.assert_called_once_with([{
+            '_op_type': 'update',
+            '_index': 'foo',
+            '_type': 'story',
+            '_id': '1',
+            'doc': {'name': 'foo2'},
+            'upsert': {'_pk': 1, 'id': 1},
+        }], request=request)
+        mock_es().index_relations.assert_called_once_with(
+            obj, request=request, nested_only=True)
+
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_es_update_fields(self, mock_upd, mock_eng):
+        obj = self._obj(mock_eng)
+        obj._es_update_fields(['name'], request='req')
+        mock_upd.assert_called_once_with({'name': 'foo'}, 'req')
+
+    @patch('ramses.indexing.rebuilding_index')
+    @patch('nefertari.elasticsearch.ES')
+    @patch('ramses.models.PartialIndexMixin._es_partial_update')
+    def test_es_update_fields_index_rebuilding(
+            self, mock_upd, mock_es, mock_rebuild, mock_eng):
+        mock_rebuild.return_value = 'foo_v2'
+        obj = self._obj(mock_eng)
+        obj._es_update_fields(['name'], request='req')
+        assert not mock_upd.called
+        mock_es.assert_called_once_with('Story')
+        mock_es().index.assert_called_once_with(
+            obj.to_dict(), request='req')
+        mock_es().index_relations.assert_called_once_with(
+            obj, request='req', nested_only=True)
+
+    @patch('nefertari.elasticsearch._bulk_body')
+    @patch('nefertari.elasticsearch.ES')
+    def test_es_partial_update_upsert(self, mock_es, mock_bulk, mock_eng):
+        obj = self._obj(mock_eng)
+        obj._es_partial_update(
+            {'name': 'foo2'}, upsert={'_pk': 1, '_type': 'Story', 'a': 1})
+        action = mock_bulk.call_args[0][0][0]
+        assert action['upsert'] == {'_pk': 1, 'a': 1}
+
+    @patch('nefertari.elasticsearch._bulk_body')
+    @patch('nefertari.elasticsearch.ES')
+    def test_es_partial_update_nothing_changed(
+            self, mock_es, mock_bulk, mock_eng):
+        obj = self._obj(mock_eng)
+        obj._es_partial_update({})
+        assert not mock_es.called
+        assert not mock_bulk.called
+
+
+@patch('ramses.indexing.register_model_index')
+class TestSetupESIndex(object):
+
+    def _config(self):
+        config = config_mock()
+        config.registry.settings = {'elasticsearch.index_name': 'foo'}
+        return config
+
+    def test_not_set(self, mock_register):
+        from ramses import models
+        assert models.setup_es_index(self._config(), {}, 'Story') is None
+        assert not mock_register.called
+
+    def test_default_name(self, mock_register):
+        from ramses import models
+        schema = {'_es_index': True}
+        index_name = models.setup_es_index(self._config(), schema, 'Event')
+        assert index_name == 'foo_event'
+        mock_register.assert_called_once_with('Event', 'foo_event', {})
+
+    def test_settings(self, mock_register):
+        from ramses import models
+        schema = {'_es_index': {
+            'name': 'events', 'number_of_shards': 1,
+            'refresh_interval': '30s'}}
+        index_name = models.setup_es_index(self._config(), schema, 'Event')
+        assert index_name == 'events'
+        mock_register.assert_called_once_with('Event', 'events', {
+            'number_of_shards': 1, 'refresh_interval': '30s'})
+        assert schema['_es_index']['name'] == 'events'
+
+    def _partitioned_schema(self, **partitions):
+        partitions.setdefault('field', 'created_at')
+        return {
+            'properties': {
+                'created_at': {'_db_settings': {'type': 'datetime'}},
+                'name': {'_db_settings': {'type': 'string'}},
+            },
+            '_es_index': {'number_of_shards': 2},
+            '_es_partitions': partitions,
+        }
+
+    @patch('ramses.indexing.register_partitioned_index')
+    def test_partitions(self, mock_partitioned, mock_register):
+        from ramses import models
+        schema = self._partitioned_schema(
+            interval='monthly', retention=12, retention_action='delete')
+        index_name = models.setup_es_index(self._config(), schema, 'Event')
+        assert index_name == 'foo_event'
+        assert not mock_register.called
+        partitioned = mock_partitioned.call_args[0][0]
+        assert partitioned.name == 'foo_event'
+        assert partitioned.model_name == 'Event'
+        assert partitioned.field == 'created_at'
+        assert partitioned.interval == 'monthly'
+        assert partitioned.retention == 12
+        assert partitioned.retention_action == 'delete'
+        assert partitioned.settings == {'number_of_shards': 2}
+
+    @patch('ramses.indexing.register_partitioned_index')
+    def test_partitions_invalid(self, mock_partitioned, mock_register):
+        from ramses import models
+        config = self._config()
+        schemas = [
+            self._partitioned_schema(field='foo'),
+            self._partitioned_schema(field='name'),
+            self._partitioned_schema(interval='hourly'),
+            self._partitioned_schema(retention_action='archive'),
+            self._partitioned_schema(expire=True),
+        ]
+        for schema in schemas:
+            with pytest.raises(ValueError):
+                models.setup_es_index(config, schema, 'Event')
+        assert not mock_partitioned.called
+
+
+@pytest.mark.usefixtures('engine_mock')
+class TestGenerateIndexes(object):
+
+    def _config(self, engine_name):
+        config = config_mock()
+        config.registry.settings = {'nefertari.engine': engine_name}
+        return config
+
+    def _schema(self, indexes):
+        return {
+            'properties': {'name': {}, 'status': {}, 'created_at': {}},
+            '_indexes': indexes,
+        }
+
+    def test_no_indexes(self):
+        from ramses import models
+        config = self._config(None)
+        assert models.generate_indexes(config, {}, 'story') == {}
+        assert models.generate_indexes(
+            config, {'_indexes': []}, 'story') == {}
+
+    def test_unsupported_engine(self):
+        from ramses import models
+        with pytest.raises(ValueError) as ex:
+            models.generate_indexes(
+                self._config('foo'), self._schema(['name']), 'story')
+        assert str(ex.value) == 'Indexes are not supported by engine: foo'
+
+    def test_unknown_field(self):
+        from ramses import models
+        with pytest.raises(ValueError) as ex:
+            models.generate_indexes(
+                self._config('nefertari_mongodb'),
+                self._schema([['name', '-foo']]), 'story')
+        assert str(ex.value) == 'Unknown index field: -foo'
+
+    def test_no_fields(self):
+        from ramses import models
+        with pytest.raises(ValueError) as ex:
+            models.generate_indexes(
+                self._config('nefertari_mongodb'),
+                self._schema([{'unique': True}]), 'story')
+        assert 'Index fields are not specified' in str(ex.value)
+
+    def test_mongodb_indexes(self):
+        from ramses import models
+        schema = self._schema([
+            'name',
+            ['status', '-created_at'],
+            {'fields': ['name'], 'unique': True},
+            {'fields': 'status', 'name': 'active_status',
+             'where': {'status': 'active'}},
+        ])
+        attrs = models.generate_indexes(
+            self._config('nefertari_mongodb'), schema, 'story')
+        assert attrs == {'meta': {'indexes': [
+            {'fields': ['name'], 'name': 'ix_story_name',
+             'unique': False},
+            {'fields': ['status', '-created_at'],
+             'name': 'ix_story_status_created_at', 'unique': False},
+            {'fields': ['name'], 'name': 'uq_story_name', 'unique': True},
+            {'fields': ['status'], 'name': 'active_status',
+             'unique': False,
+             'partialFilterExpression': {'status': 'active'}},
+        ]}}
+
+    def test_mongodb_invalid_where(self):
+        from ramses import models
+        schema = self._schema([{'fields': ['name'], 'where': 'a = 1'}])
+        with pytest.raises(ValueError):
+            models.generate_indexes(
+                self._config('nefertari_mongodb'), schema, 'story')
+
+    def test_sqla_indexes(self):
+        sa = pytest.importorskip('sqlalchemy')
+        from sqlalchemy.dialects import postgresql
+        from sqlalchemy.schema import CreateIndex
+        from ramses import models
+        schema = self._schema([
+            ['status', '-created_at'],
+            {'fields': ['name'], 'unique': True,
+             'where': "status = 'active'"},
+        ])
+        attrs = models.generate_indexes(
+            self._config('nefertari_sqla'), schema, 'story')
+        table = sa.Table(
+            'story', sa.MetaData(),
+            sa.Column('name', sa.String),
+            sa.Column('status', sa.String),
+            sa.Column('created_at', sa.DateTime),
+            *attrs['__table_args__'])
+        ddl = sorted(
+            str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+            for index in table.indexes)
+        assert ddl == [
+            'CREATE INDEX ix_story_status_created_at ON story '
+            '(status, created_at DESC)',
+            "CREATE UNIQUE INDEX uq_story_name ON story (name) "
+            "WHERE status = 'active'",
+        ]
+
+    def test_sqla_invalid_where(self):
+        from ramses import models
+        schema = self._schema([{'fields': ['name'], 'where': {'a': 1}}])
+        with pytest.raises(ValueError):
+            models.generate_indexes(
+                self._config('nefertari_sqla'), schema, 'story')
+
+
 class TestSubscribersSetup(object):
 
     @patch('ramses.models.resolve_to_callable')
@@ -393,6 +929,22 @@ class TestSubscribersSetup(object):
             call(mock_resolve(), ['eventcls'], model='mymodel'),
         ])
 
+    @patch('ramses.counters.setup_counter_cache')
+    @patch('ramses.models.get_events_map')
+    def test_setup_model_event_subscribers_counters(
+            self, mock_get, mock_setup):
+        from ramses import models
+        config = Mock()
+        schema = {'properties': {
+            'stories': {'_counter_cache': 'stories_count'},
+            'stories_count': {},
+            'name': None,
+        }}
+        models.setup_model_event_subscribers(config, 'mymodel', schema)
+        mock_setup.assert_called_once_with(
+            config, 'mymodel', 'stories', schema)
+        assert not config.subscribe_to_events.called
+
     @patch('ramses.models.resolve_to_callable')
     @patch('ramses.models.engine')
     def test_setup_fields_processors(self, mock_eng, mock_resolve):
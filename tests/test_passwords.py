@@ -0,0 +1,208 @@
+import pytest
+from mock import Mock, patch
+
+from ramses import passwords
+from .fixtures import engine_mock
+
+
+class TestPasswordHasher(object):
+
+    def test_encode_check(self):
+        hasher = passwords.PasswordHasher(rounds=4)
+        encoded = hasher.encode('secret')
+        assert hasher.match(encoded)
+        assert hasher.get_rounds(encoded) == 4
+        assert hasher.check(encoded, 'secret')
+        assert not hasher.check(encoded, 'secret2')
+
+    def test_encode_rounds(self):
+        hasher = passwords.PasswordHasher(rounds=4)
+        encoded = hasher.encode('secret', rounds=5)
+        assert hasher.get_rounds(encoded) == 5
+
+    def test_check_not_hash(self):
+        hasher = passwords.PasswordHasher(rounds=4)
+        assert not hasher.check('secret', 'secret')
+
+    def test_get_rounds_not_hash(self):
+        hasher = passwords.PasswordHasher()
+        assert hasher.get_rounds('secret') is None
+        assert hasher.get_rounds(None) is None
+
+    def test_needs_update(self):
+        hasher = passwords.PasswordHasher(rounds=4)
+        encoded = hasher.encode('secret')
+        assert not hasher.needs_update(encoded)
+        hasher.configure(rounds=5)
+        assert hasher.needs_update(encoded)
+        assert not hasher.needs_update('secret')
+
+    @patch('ramses.passwords.multiprocessing')
+    def test_pool_used(self, mock_mp):
+        hasher = passwords.PasswordHasher(rounds=4, workers=2)
+        pool = mock_mp.Pool()
+        pool.apply_async().get.return_value = 'hash'
+        assert hasher.encode('secret') == 'hash'
+        pool.apply_async.assert_called_with(
+            passwords._encode, ('secret', 4))
+        pool.apply_async().get.assert_called_once_with(10)
+        mock_mp.Pool.assert_called_with(processes=2)
+
+    @patch('ramses.passwords.multiprocessing')
+    def test_queue_full(self, mock_mp):
+        from nefertari.json_httpexceptions import JHTTPServiceUnavailable
+        hasher = passwords.PasswordHasher(
+            rounds=4, workers=1, queue_size=1)
+        hasher._slots.acquire()
+        hasher._slots.acquire()
+        with pytest.raises(JHTTPServiceUnavailable):
+            hasher.encode('secret')
+        assert not mock_mp.Pool().apply_async.called
+        hasher._slots.release()
+        hasher.encode('secret')
+        assert mock_mp.Pool().apply_async.called
+
+    def test_timeout(self):
+        import multiprocessing
+        from nefertari.json_httpexceptions import JHTTPServiceUnavailable
+        hasher = passwords.PasswordHasher(rounds=4, workers=1, timeout=1)
+        pool = Mock()
+        pool.apply_async().get.side_effect = multiprocessing.TimeoutError
+        hasher._get_pool = lambda: pool
+        with pytest.raises(JHTTPServiceUnavailable):
+            hasher.encode('secret')
+        pool.apply_async().get.assert_called_once_with(1)
+        assert hasher._slots.acquire(False)
+
+    @patch('ramses.passwords.multiprocessing')
+    def test_start(self, mock_mp):
+        hasher = passwords.PasswordHasher(rounds=4)
+        hasher.start()
+        assert not mock_mp.Pool.called
+        hasher.configure(workers=2)
+        hasher.start()
+        mock_mp.Pool.assert_called_once_with(processes=2)
+
+    @patch('ramses.passwords.multiprocessing')
+    def test_after_fork(self, mock_mp):
+        hasher = passwords.PasswordHasher(rounds=4, workers=1)
+        hasher.start()
+        hasher._slots.acquire()
+        passwords._after_fork()
+        assert hasher._pool is None
+        hasher.start()
+        assert mock_mp.Pool.call_count == 2
+        assert not mock_mp.Pool().terminate.called
+
+    @patch('ramses.passwords.multiprocessing')
+    def test_pool_reused(self, mock_mp):
+        hasher = passwords.PasswordHasher(rounds=4, workers=2)
+        mock_mp.Pool.reset_mock()
+        hasher.encode('secret')
+        hasher.encode('secret')
+        assert mock_mp.Pool.call_count == 1
+
+    @patch('ramses.passwords.os')
+    @patch('ramses.passwords.multiprocessing')
+    def test_pool_recreated_after_fork(self, mock_mp, mock_os):
+        hasher = passwords.PasswordHasher(rounds=4, workers=2)
+        mock_os.getpid.return_value = 1
+        hasher.encode('secret')
+        mock_os.getpid.return_value = 2
+        hasher.encode('secret')
+        assert mock_mp.Pool.call_count == 2
+
+    @patch('ramses.passwords.multiprocessing')
+    def test_configure_closes_pool(self, mock_mp):
+        hasher = passwords.PasswordHasher(rounds=4, workers=2)
+        hasher.encode('secret')
+        hasher.configure(workers=3)
+        mock_mp.Pool().terminate.assert_called_once_with()
+        assert hasher.workers == 3
+        assert hasher.rounds == 4
+
+    def test_process_pool(self):
+        hasher = passwords.PasswordHasher(rounds=4, workers=1)
+        try:
+            encoded = hasher.encode('secret')
+            assert hasher.check(encoded, 'secret')
+            assert not hasher.check(encoded, 'foo')
+        finally:
+            hasher.close()
+
+
+class TestRehashPasswordMixin(object):
+
+    def _model(self, success, password):
+        user = Mock(password=password)
+        user.pk_field.return_value = 'username'
+
+        class Base(object):
+            @classmethod
+            def authenticate_by_password(cls, params):
+                return success, user
+
+        class Model(passwords.RehashPasswordMixin, Base):
+            pass
+
+        return Model, user
+
+    @patch('ramses.passwords.hasher')
+    def test_password_rehashed(self, mock_hasher):
+        mock_hasher.needs_update.return_value = True
+        Model, user = self._model(True, 'oldhash')
+        assert Model.authenticate_by_password({'password': 'secret'}) == (
+            True, user)
+        mock_hasher.needs_update.assert_called_once_with('oldhash')
+        mock_hasher.encode.assert_called_once_with('secret')
+        user.update.assert_called_once_with(
+            {'password': mock_hasher.encode.return_value})
+
+    @patch('ramses.passwords.hasher')
+    def test_hash_up_to_date(self, mock_hasher):
+        mock_hasher.needs_update.return_value = False
+        Model, user = self._model(True, 'hash')
+        Model.authenticate_by_password({'password': 'secret'})
+        assert not user.update.called
+
+    @patch('ramses.passwords.hasher')
+    def test_login_failed(self, mock_hasher):
+        mock_hasher.needs_update.return_value = True
+        Model, user = self._model(False, 'oldhash')
+        assert Model.authenticate_by_password({'password': 'secret'}) == (
+            False, user)
+        assert not user.update.called
+
+
+@pytest.mark.usefixtures('engine_mock')
+class TestSetupPasswordHasher(object):
+
+    @patch('ramses.passwords.hasher')
+    def test_settings(self, mock_hasher):
+        from nefertari.authentication import models
+        crypt = models.crypt
+        config = Mock()
+        config.registry.settings = {
+            'bcrypt.rounds': '12', 'bcrypt.workers': '3',
+            'bcrypt.queue_size': '0', 'bcrypt.timeout': '2.5'}
+        try:
+            assert passwords.setup_password_hasher(config) is mock_hasher
+            mock_hasher.configure.assert_called_once_with(
+                rounds=12, workers=3, queue_size=0, timeout=2.5)
+            assert not mock_hasher.start.called
+            assert models.crypt is mock_hasher
+        finally:
+            models.crypt = crypt
+
+    @patch('ramses.passwords.hasher')
+    def test_defaults(self, mock_hasher):
+        from nefertari.authentication import models
+        crypt = models.crypt
+        config = Mock()
+        config.registry.settings = {}
+        try:
+            passwords.setup_password_hasher(config)
+            mock_hasher.configure.assert_called_once_with(
+                rounds=10, workers=0, queue_size=None, timeout=10)
+        finally:
+            models.crypt = crypt
@@ -0,0 +1,403 @@
+import json
+
+import pytest
+from mock import Mock, patch, call
+
+from ramses.scripts import reindex
+
+
+@pytest.fixture
+def engine_settings(request):
+    reindex._settings['nefertari.engine'] = 'nefertari_sqla'
+
+    def clear():
+        reindex._settings.clear()
+    request.addfinalizer(clear)
+
+
+def _command(*args):
+    return reindex.ReindexCommand(['-c', 'test.ini'] + list(args), Mock())
+
+
+class TestMongodbLoaders(object):
+
+    def test_pks(self):
+        model = Mock()
+        model.pk_field.return_value = 'id'
+        query = model.objects.return_value.order_by().limit()
+        query.scalar.return_value = [3, 4]
+        assert reindex._mongodb_pks(model, 2, 2) == [3, 4]
+        model.objects.assert_called_with(id__gt=2)
+        model.objects().order_by.assert_called_with('id')
+        model.objects().order_by().limit.assert_called_with(2)
+        query.scalar.assert_called_once_with('id')
+
+    def test_items(self):
+        model = Mock()
+        model.pk_field.return_value = 'id'
+        model.objects.return_value.order_by.return_value = ['a', 'b']
+        assert reindex._mongodb_items(model, 1, 2) == ['a', 'b']
+        model.objects.assert_called_once_with(id__gte=1, id__lte=2)
+
+    def test_existing(self):
+        model = Mock()
+        model.pk_field.return_value = 'id'
+        model.objects.return_value.scalar.return_value = [1]
+        assert reindex._mongodb_existing(model, [1, 2]) == {1}
+        model.objects.assert_called_once_with(id__in=[1, 2])
+        model.objects().scalar.assert_called_once_with('id')
+
+
+@pytest.mark.usefixtures('engine_settings')
+class TestIndexRange(object):
+
+    @patch('ramses.scripts.reindex.transaction')
+    @patch('ramses.scripts.reindex.to_dicts')
+    @patch('nefertari.elasticsearch.ES')
+    @patch('nefertari.engine', create=True)
+    def test_index_range(self, mock_eng, mock_es, mock_dicts, mock_trans):
+        mock_load = Mock(return_value=['a', 'b'])
+        mock_dicts.return_value = [{'id': 1}, {'id': 2}]
+        with patch.dict(reindex.items_loaders,
+                        {'nefertari_sqla': mock_load}):
+            assert reindex.index_range(('Story', 1, 2, None)) == (2, 2)
+        mock_eng.get_document_cls.assert_called_once_with('Story')
+        mock_load.assert_called_once_with(
+            mock_eng.get_document_cls(), 1, 2)
+        mock_dicts.assert_called_once_with(['a', 'b'])
+        mock_es.assert_called_once_with('Story')
+        mock_es().index.assert_called_once_with([{'id': 1}, {'id': 2}])
+        mock_trans.abort.assert_called_once_with()
+
+    @patch('ramses.scripts.reindex.delete_removed_documents')
+    @patch('ramses.scripts.reindex.create_documents')
+    @patch('ramses.scripts.reindex.transaction')
+    @patch('ramses.scripts.reindex.to_dicts')
+    @patch('nefertari.elasticsearch.ES')
+    @patch('nefertari.engine', create=True)
+    def test_index_range_rebuild(
+            self, mock_eng, mock_es, mock_dicts, mock_trans, mock_create,
+            mock_delete):
+        model_cls = mock_eng.get_document_cls()
+        model_cls.pk_field.return_value = 'id'
+        mock_load = Mock(return_value=[Mock(id=1)])
+        with patch.dict(reindex.items_loaders,
+                        {'nefertari_sqla': mock_load}):
+            reindex.index_range(('Story', 1, 2, 'foo_v2'))
+        assert not mock_es().index.called
+        mock_create.assert_called_once_with(
+            'Story', mock_dicts.return_value, 'foo_v2')
+        mock_delete.assert_called_once_with(model_cls, [1], 'foo_v2')
+        assert mock_trans.abort.call_count == 2
+
+
+@pytest.mark.usefixtures('engine_settings')
+class TestDeleteRemovedDocuments(object):
+
+    def _model(self):
+        model = Mock(__name__='Story')
+        return model
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_row_deleted_during_rebuild(self, mock_es, mock_bulk):
+        mock_es.return_value.doc_type = 'Story'
+        mock_bulk.return_value = (0, [{'delete': {'status': 404}}])
+        model = self._model()
+        mock_existing = Mock(return_value={1, 3})
+        with patch.dict(reindex.existing_loaders,
+                        {'nefertari_sqla': mock_existing}):
+            reindex.delete_removed_documents(model, [1, 2, 3], 'foo_v2')
+        mock_existing.assert_called_once_with(model, [1, 2, 3])
+        mock_es.assert_called_once_with('Story', index_name='foo_v2')
+        mock_bulk.assert_called_once_with(
+            client=mock_es.api, raise_on_error=False, actions=[{
+                '_op_type': 'delete', '_index': 'foo_v2',
+                '_type': 'Story', '_id': '2'}])
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_nothing_deleted(self, mock_es, mock_bulk):
+        with patch.dict(reindex.existing_loaders,
+                        {'nefertari_sqla': Mock(return_value={1})}):
+            reindex.delete_removed_documents(self._model(), [1], 'foo_v2')
+        assert not mock_bulk.called
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_errors(self, mock_es, mock_bulk):
+        mock_bulk.return_value = (0, [{'delete': {'status': 500}}])
+        with patch.dict(reindex.existing_loaders,
+                        {'nefertari_sqla': Mock(return_value=set())}):
+            with pytest.raises(Exception) as ex:
+                reindex.delete_removed_documents(
+                    self._model(), [1], 'foo_v2')
+        assert 'Errors happened' in str(ex.value)
+
+
+class TestCreateDocuments(object):
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_conflicts_ignored(self, mock_es, mock_bulk):
+        mock_es().prep_bulk_documents.return_value = ['action']
+        mock_bulk.return_value = (0, [{'create': {'status': 409}}])
+        reindex.create_documents('Story', [{'id': 1}], 'foo_v2')
+        mock_es.assert_called_with('Story', index_name='foo_v2')
+        mock_es().prep_bulk_documents.assert_called_once_with(
+            'create', [{'id': 1}])
+        mock_bulk.assert_called_once_with(
+            client=mock_es.api, actions=['action'], raise_on_error=False)
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_errors(self, mock_es, mock_bulk):
+        mock_es().prep_bulk_documents.return_value = ['action']
+        mock_bulk.return_value = (0, [{'create': {'status': 400}}])
+        with pytest.raises(Exception) as ex:
+            reindex.create_documents('Story', [{'id': 1}], 'foo_v2')
+        assert 'Errors happened' in str(ex.value)
+
+    @patch('elasticsearch.helpers.bulk')
+    @patch('nefertari.elasticsearch.ES')
+    def test_no_documents(self, mock_es, mock_bulk):
+        mock_es().prep_bulk_documents.return_value = []
+        reindex.create_documents('Story', [], 'foo_v2')
+        assert not mock_bulk.called
+
+
+class TestBootstrapApp(object):
+
+    @patch('ramses.scripts.reindex.bootstrap')
+    def test_mappings_not_setup(self, mock_boot):
+        from ramses import indexing
+
+        def boot(config_uri):
+            assert not indexing._mappings_enabled
+            registry = Mock(settings={'nefertari.engine': 'foo'})
+            registry.indexing_queue = None
+            return {'registry': registry}
+        mock_boot.side_effect = boot
+        try:
+            reindex.bootstrap_app('test.ini')
+            assert reindex._settings == {'nefertari.engine': 'foo'}
+            assert indexing._mappings_enabled
+        finally:
+            reindex._settings.clear()
+
+    @patch('ramses.scripts.reindex.bootstrap')
+    def test_indexing_queue_closed(self, mock_boot):
+        from nefertari import elasticsearch
+        bulk_body = elasticsearch._bulk_body
+        registry = Mock(settings={})
+        mock_boot.return_value = {'registry': registry}
+        reindex.bootstrap_app('test.ini')
+        assert elasticsearch._bulk_body is bulk_body
+        registry.indexing_queue.close.assert_called_once_with()
+
+
+@pytest.mark.usefixtures('engine_settings')
+class TestReindexCommand(object):
+
+    def test_options(self):
+        command = _command(
+            '--models', 'Story, User', '--chunk', '10',
+            '--processes', '4', '--rate', '100')
+        assert command.options.models == 'Story, User'
+        assert command.options.chunk == 10
+        assert command.options.processes == 4
+        assert command.options.rate == 100
+        assert command.get_model_names() == ['Story', 'User']
+
+    def test_target_indices_not_shared(self):
+        command = _command()
+        command.target_indices['Story'] = 'foo_v2'
+        assert _command().target_indices == {}
+
+    @patch('nefertari.engine', create=True)
+    def test_get_model_names_indexed(self, mock_eng):
+        mock_eng.get_document_classes.return_value = {
+            'User': Mock(_index_enabled=True),
+            'Story': Mock(_index_enabled=True),
+            'Profile': Mock(_index_enabled=False),
+        }
+        assert _command().get_model_names() == ['Story', 'User']
+
+    def test_checkpoint(self, tmpdir):
+        path = str(tmpdir.join('checkpoint.json'))
+        command = _command('--checkpoint', path)
+        assert command.load_checkpoint() == {}
+        command.save_checkpoint({'Story': {'last_pk': 1, 'done': False}})
+        assert command.load_checkpoint() == {
+            'Story': {'last_pk': 1, 'done': False}}
+        assert not tmpdir.join('checkpoint.json.tmp').check()
+
+    def test_no_checkpoint(self):
+        command = _command()
+        command.save_checkpoint({'Story': {}})
+        assert command.load_checkpoint() == {}
+
+    def test_iter_ranges(self):
+        mock_load = Mock(side_effect=[[1, 2], [3], []])
+        model = Mock(__name__='Story')
+        with patch.dict(reindex.pk_loaders, {'nefertari_sqla': mock_load}):
+            ranges = list(_command('--chunk', '2').iter_ranges(model, 0))
+        assert ranges == [('Story', 1, 2, None), ('Story', 3, 3, None)]
+        mock_load.assert_has_calls([
+            call(model, 0, 2), call(model, 2, 2), call(model, 3, 2)])
+
+    @patch('ramses.scripts.reindex.time')
+    def test_iter_ranges_throttled(self, mock_time):
+        mock_time.time.return_value = 10
+        mock_load = Mock(side_effect=[[1, 2], [3, 4], []])
+        model = Mock(__name__='Story')
+        command = _command('--chunk', '2', '--rate', '4')
+        with patch.dict(reindex.pk_loaders, {'nefertari_sqla': mock_load}):
+            list(command.iter_ranges(model))
+        mock_time.sleep.assert_called_once_with(0.5)
+
+    @patch('nefertari.engine', create=True)
+    def test_reindex_model(self, mock_eng):
+        model = mock_eng.get_document_cls.return_value
+        model.get_collection.return_value = 3
+        command = _command()
+        command.save_checkpoint = Mock()
+        command.iter_ranges = Mock(return_value=['range1', 'range2'])
+        imap = Mock(return_value=[(2, 2), (1, 3)])
+        checkpoint = {}
+        command.reindex_model('Story', checkpoint, imap)
+        command.iter_ranges.assert_called_once_with(model, after=None)
+        imap.assert_called_once_with(reindex.index_range, ['range1', 'range2'])
+        assert checkpoint == {
+            'Story': {'last_pk': 3, 'indexed': 3, 'done': True}}
+        assert command.save_checkpoint.call_count == 3
+
+    @patch('nefertari.engine', create=True)
+    def test_reindex_model_resumed(self, mock_eng):
+        model = mock_eng.get_document_cls.return_value
+        command = _command()
+        command.iter_ranges = Mock(return_value=[])
+        checkpoint = {'Story': {'last_pk': 2, 'indexed': 2, 'done': False}}
+        command.reindex_model('Story', checkpoint, Mock(return_value=[]))
+        command.iter_ranges.assert_called_once_with(model, after=2)
+        assert checkpoint == {
+            'Story': {'last_pk': 2, 'indexed': 2, 'done': True}}
+
+    @patch('nefertari.engine', create=True)
+    def test_reindex_model_done(self, mock_eng):
+        command = _command()
+        command.iter_ranges = Mock()
+        command.reindex_model('Story', {'Story': {'done': True}}, Mock())
+        assert not mock_eng.get_document_cls.called
+        assert not command.iter_ranges.called
+
+    @patch('ramses.scripts.reindex.multiprocessing')
+    def test_run(self, mock_mp):
+        command = _command('--models', 'Story,User')
+        command.bootstrap = (Mock(),)
+        command.reindex_model = Mock()
+        command.run()
+        command.bootstrap[0].assert_called_once_with('test.ini')
+        assert not mock_mp.Pool.called
+        assert command.reindex_model.call_count == 2
+        command.reindex_model.assert_any_call('User', {}, map)
+
+    @patch('ramses.scripts.reindex.multiprocessing')
+    def test_run_pool(self, mock_mp):
+        command = _command('--models', 'Story', '--processes', '3')
+        command.bootstrap = (Mock(),)
+        command.reindex_model = Mock()
+        command.run()
+        pool = mock_mp.Pool.return_value
+        mock_mp.Pool.assert_called_once_with(
+            processes=3, initializer=command.bootstrap[0],
+            initargs=('test.ini',))
+        command.reindex_model.assert_called_once_with(
+            'Story', {}, pool.imap)
+        pool.close.assert_called_once_with()
+        pool.join.assert_called_once_with()
+
+    def test_rebuild_with_models(self):
+        with pytest.raises(SystemExit):
+            _command('--rebuild', '--models', 'Story')
+
+    @patch('ramses.indexing.get_index_body')
+    @patch('ramses.indexing.get_index_models')
+    @patch('nefertari.elasticsearch.ES')
+    @patch('ramses.scripts.reindex.time')
+    def test_start_rebuild(self, mock_time, mock_es, mock_models, mock_body):
+        mock_es.settings.index_name = 'foo'
+        story, event = Mock(__name__='Story'), Mock(__name__='Event')
+        mock_models.side_effect = lambda name, default: {
+            'foo': [story], 'foo_event': [event]}[name]
+        alias = Mock(check_interval=5)
+        alias.start_rebuild.return_value = 'foo_v2'
+        event_alias = Mock(check_interval=5)
+        event_alias.start_rebuild.return_value = 'foo_event_v3'
+        registry = Mock(index_aliases={
+            'foo': alias, 'foo_event': event_alias})
+        command = _command('--rebuild')
+        checkpoint = {'_indices': ['foo_v1'], 'Story': {'done': True}}
+        assert command.start_rebuild(registry, checkpoint) == [
+            (alias, 'foo_v2'), (event_alias, 'foo_event_v3')]
+        alias.start_rebuild.assert_called_once_with(
+            [story], body=mock_body.return_value)
+        mock_body.assert_any_call('foo_event')
+        mock_models.assert_any_call('foo', 'foo')
+        assert command.target_indices == {
+            'Story': 'foo_v2', 'Event': 'foo_event_v3'}
+        assert checkpoint == {'_indices': ['foo_event_v3', 'foo_v2']}
+        mock_time.sleep.assert_called_once_with(5)
+
+    @patch('ramses.indexing.get_index_models')
+    @patch('nefertari.elasticsearch.ES')
+    @patch('ramses.scripts.reindex.time')
+    def test_start_rebuild_resumed(self, mock_time, mock_es, mock_models):
+        mock_models.return_value = []
+        alias = Mock(check_interval=5)
+        alias.start_rebuild.return_value = 'foo_v2'
+        registry = Mock(index_aliases={'foo': alias})
+        checkpoint = {'_indices': ['foo_v2'], 'Story': {'done': True}}
+        _command('--rebuild').start_rebuild(registry, checkpoint)
+        assert checkpoint == {'_indices': ['foo_v2'], 'Story': {'done': True}}
+
+    def test_start_rebuild_no_aliases(self):
+        registry = Mock(spec=[])
+        with pytest.raises(Exception) as ex:
+            _command('--rebuild').start_rebuild(registry, {})
+        assert 'not enabled' in str(ex.value)
+
+    def test_iter_ranges_target_index(self):
+        mock_load = Mock(side_effect=[[1, 2], []])
+        model = Mock(__name__='Story')
+        command = _command('--chunk', '2')
+        command.target_indices = {'Story': 'foo_v2'}
+        with patch.dict(reindex.pk_loaders, {'nefertari_sqla': mock_load}):
+            ranges = list(command.iter_ranges(model))
+        assert ranges == [('Story', 1, 2, 'foo_v2')]
+
+    @patch('ramses.scripts.reindex.multiprocessing')
+    def test_run_rebuild(self, mock_mp):
+        command = _command('--rebuild', '--delete-old')
+        registry = Mock()
+        command.bootstrap = (Mock(return_value={'registry': registry}),)
+        command.get_model_names = Mock(return_value=['Story'])
+        command.reindex_model = Mock()
+        command.save_checkpoint = Mock()
+        alias = Mock()
+        command.start_rebuild = Mock(return_value=[(alias, 'foo_v2')])
+        command.run()
+        command.start_rebuild.assert_called_once_with(registry, {})
+        command.reindex_model.assert_called_once_with('Story', {}, map)
+        alias.finish_rebuild.assert_called_once_with(
+            'foo_v2', delete_old=True)
+        command.save_checkpoint.assert_called_once_with({})
+
+
+def test_checkpoint_non_json_pk(tmpdir):
+    path = str(tmpdir.join('checkpoint.json'))
+    command = _command('--checkpoint', path)
+    pk = Mock(__str__=lambda self: 'abc')
+    command.save_checkpoint({'Story': {'last_pk': pk}})
+    with open(path) as checkpoint_file:
+        assert json.load(checkpoint_file)['Story']['last_pk']
@@ -409,3 +409,20 @@ class TestUtils(object):
         assert view_cls.Model is model1
         assert not model1.called
         model2.assert_called_once_with()
+
+    def test_call_after_commit_no_transaction(self):
+        func = Mock()
+        utils.call_after_commit(None, func)
+        utils.call_after_commit(Mock(environ={}), func)
+        assert func.call_count == 2
+
+    def test_call_after_commit(self):
+        func = Mock()
+        request = Mock(environ={'tm.active': True})
+        utils.call_after_commit(request, func)
+        assert not func.called
+        hook = request.tm.get().addAfterCommitHook.call_args[0][0]
+        hook(False)
+        assert not func.called
+        hook(True)
+        func.assert_called_once_with()
@@ -44,6 +44,246 @@ class TestSetObjectACLMixin(object):
         assert obj._acl == field.stringify_acl()
 
 
+class TestConditionalHelpers(object):
+    def test_parse_etags(self):
+        assert views.parse_etags('W/"foo", "bar" ,*') == {
+            'foo', 'bar', '*'}
+        assert views.parse_etags(None) == set()
+
+    def test_parse_version_date(self):
+        from datetime import datetime
+        expected = datetime(2015, 1, 2, 3, 4, 5)
+        assert views.parse_version_date(
+            '2015-01-02T03:04:05Z') == expected
+        assert views.parse_version_date(
+            '2015-01-02T03:04:05.123') == expected
+        assert views.parse_version_date(
+            datetime(2015, 1, 2, 3, 4, 5, 77)) == expected
+        assert views.parse_version_date('foo') is None
+        assert views.parse_version_date(3) is None
+
+
+class TestConditionalResponseMixin(ViewTestBase):
+    class view_cls(views.ConditionalResponseMixin, views.CollectionView):
+        pass
+
+    def _test_view(self, **headers):
+        view = super(TestConditionalResponseMixin, self)._test_view()
+        view.request.headers = headers
+        view.request.if_modified_since = None
+        view.request.effective_principals = ['system.Everyone']
+        view.request.response.headers = {}
+        view.Model = Mock(__name__='Story', _version_field=None)
+        return view
+
+    def _doc(self, **data):
+        from nefertari.utils import dict2obj
+        return dict2obj(data)
+
+    def test_weak_etag_from_data(self):
+        view = self._test_view()
+        etag, last_modified = view.get_etag(self._doc(_pk='1', name='a'))
+        assert etag.startswith('W/"')
+        assert last_modified is None
+        etag2, _ = view.get_etag(self._doc(_pk='1', name='b'))
+        assert etag != etag2
+
+    def test_etag_depends_on_principals_and_params(self):
+        view = self._test_view()
+        doc = self._doc(_pk='1', name='a')
+        etag, _ = view.get_etag(doc)
+        view.request.effective_principals = ['g:admin']
+        assert view.get_etag(doc)[0] != etag
+        view._query_params['_fields'] = 'name'
+        assert view.get_etag(doc)[0] != etag
+
+    def test_strong_etag_from_version_field(self):
+        from datetime import datetime
+        view = self._test_view()
+        view.Model._version_field = 'updated_at'
+        docs = [
+            self._doc(_pk='1', updated_at='2015-01-02T03:04:05'),
+            self._doc(_pk='2', updated_at='2015-02-02T03:04:05'),
+        ]
+        etag, last_modified = view.get_etag(docs[1])
+        assert etag.startswith('"')
+        assert last_modified == datetime(2015, 2, 2, 3, 4, 5)
+
+    def test_collection_without_last_modified(self):
+        from datetime import datetime
+        from pyramid.httpexceptions import HTTPNotModified
+        view = self._test_view()
+        view.Model._version_field = 'updated_at'
+        docs = [
+            self._doc(_pk='1', updated_at='2015-01-02T03:04:05'),
+            self._doc(_pk='2', updated_at='2015-02-02T03:04:05'),
+        ]
+        etag, last_modified = view.get_etag(docs, many=True)
+        assert etag.startswith('"')
+        assert last_modified is None
+        view.request.if_modified_since = datetime(2015, 3, 1)
+        resp = view.conditional_response(docs[:1], many=True)
+        assert not isinstance(resp, HTTPNotModified)
+        assert 'Last-Modified' not in view.request.response.headers
+
+    def test_version_field_missing_value(self):
+        view = self._test_view()
+        view.Model._version_field = 'updated_at'
+        etag, last_modified = view.get_etag(self._doc(_pk='1'))
+        assert etag.startswith('W/"')
+        assert last_modified is None
+
+    def test_conditional_response_sets_headers(self):
+        view = self._test_view()
+        doc = self._doc(_pk='1', name='a')
+        assert view.conditional_response(doc) is doc
+        headers = view.request.response.headers
+        assert headers['ETag'] == view.get_etag(doc)[0]
+        assert headers['Cache-Control'] == 'no-cache'
+
+    def test_conditional_response_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        view = self._test_view()
+        doc = self._doc(_pk='1', name='a')
+        etag, _ = view.get_etag(doc)
+        view.request.headers = {'If-None-Match': etag}
+        resp = view.conditional_response(doc)
+        assert isinstance(resp, HTTPNotModified)
+        assert resp.headers['ETag'] == etag
+        assert view.request.response.headers == {}
+
+    def test_conditional_response_if_modified_since(self):
+        from datetime import datetime
+        from pyramid.httpexceptions import HTTPNotModified
+        view = self._test_view()
+        view.Model._version_field = 'updated_at'
+        doc = self._doc(_pk='1', updated_at='2015-01-02T03:04:05')
+        view.request.if_modified_since = datetime(2015, 1, 3)
+        resp = view.conditional_response(doc)
+        assert isinstance(resp, HTTPNotModified)
+        assert 'Last-Modified' in resp.headers
+        view.request.if_modified_since = datetime(2015, 1, 1)
+        assert view.conditional_response(doc) is doc
+
+    def test_conditional_response_skipped(self):
+        view = self._test_view()
+        assert view.conditional_response(5) == 5
+        view.request.method = 'POST'
+        doc = self._doc(_pk='1')
+        assert view.conditional_response(doc) is doc
+        assert view.request.response.headers == {}
+
+    def test_index_and_show(self):
+        view = self._test_view()
+        view.conditional_response = Mock()
+        view.get_collection = Mock()
+        view.get_item = Mock()
+        view.index()
+        view.conditional_response.assert_called_with(
+            view.get_collection(), many=True)
+        view.show(foo=1)
+        view.conditional_response.assert_called_with(view.get_item())
+
+
+class TestCacheViewMixin(ViewTestBase):
+    class view_cls(views.CacheViewMixin, views.CollectionView):
+        pass
+
+    def _test_view(self):
+        from ramses.cache import ResourceCache, LRUCache
+        view = super(TestCacheViewMixin, self)._test_view()
+        view.request.path = '/stories'
+        view.request.effective_principals = ['system.Everyone']
+        view._cache = ResourceCache('Story', backend=LRUCache())
+        return view
+
+    @patch('ramses.views.CollectionView.index')
+    def test_index_no_cache(self, mock_index):
+        view = self._test_view()
+        view._cache = None
+        assert view.index(foo=1) == mock_index.return_value
+        mock_index.assert_called_once_with(foo=1)
+
+    @patch('ramses.views.CollectionView.index')
+    def test_index_cached(self, mock_index):
+        mock_index.return_value = [1, 2]
+        view = self._test_view()
+        assert view.index() == [1, 2]
+        assert view.index() == [1, 2]
+        mock_index.assert_called_once_with()
+        view._query_params['foo'] = 'baz'
+        view.index()
+        assert mock_index.call_count == 2
+        view.request.effective_principals = ['g:admin']
+        view.index()
+        assert mock_index.call_count == 3
+
+    def test_index_loads_with_view_copy(self):
+        view = self._test_view()
+        loaded_by = []
+
+        def index(self, **kwargs):
+            loaded_by.append(self)
+            self._query_params['id'] = ['1']
+            return [1]
+
+        with patch('ramses.views.CollectionView.index', index):
+            view.index()
+        assert loaded_by[0] is not view
+        assert 'id' not in view._query_params
+
+    def test_index_refreshed_from_snapshot(self):
+        view = self._test_view()
+        view._cache = Mock()
+        view.index()
+        view.request.effective_principals = ['g:admin']
+        view._query_params['foo'] = 'baz'
+        refresh = view._cache.get_or_load.call_args[1]['refresh_loader']
+        loaded = []
+
+        def index(self, **kwargs):
+            loaded.append((self.request, self._query_params))
+            return [1]
+
+        with patch('ramses.views.CollectionView.index', index):
+            with patch('ramses.views.background_request') as mock_bg:
+                assert refresh() == [1]
+        request, params = loaded[0]
+        assert isinstance(request, views.RequestSnapshot)
+        mock_bg.assert_called_once_with(request)
+        assert request.effective_principals == ['system.Everyone']
+        assert params['foo'] == 'bar'
+
+
+class TestRequestSnapshot(object):
+
+    def test_snapshot(self):
+        request = Mock(effective_principals=['system.Everyone'])
+        snapshot = views.RequestSnapshot(request)
+        request.effective_principals.append('g:admin')
+        assert snapshot.effective_principals == ['system.Everyone']
+        assert snapshot.registry is request.registry
+
+    @patch('pyramid.threadlocal.manager')
+    @patch('transaction.abort')
+    @patch('transaction.begin')
+    def test_background_request(self, mock_begin, mock_abort, mock_manager):
+        import sys
+        request = views.RequestSnapshot(Mock(effective_principals=[]))
+        request.registry.settings = {'nefertari.engine': 'nefertari_sqla'}
+        sqla = Mock()
+        with patch.dict(sys.modules, {'pyramid_sqlalchemy': sqla}):
+            with pytest.raises(ValueError):
+                with views.background_request(request):
+                    mock_manager.push.assert_called_once_with(
+                        {'registry': request.registry, 'request': request})
+                    mock_begin.assert_called_once_with()
+                    raise ValueError
+        mock_abort.assert_called_once_with()
+        sqla.Session.remove.assert_called_once_with()
+        mock_manager.pop.assert_called_once_with()
+
+
 class TestBaseView(ViewTestBase):
     view_cls = views.BaseView
 
@@ -363,6 +603,131 @@ class TestESBaseView(ViewTestBase):
         mock_es().get_collection.assert_called_once_with(
             _limit=20, foo='bar', id=[1, 2])
 
+    @patch('nefertari.elasticsearch.ES')
+    def test_get_collection_es_acl_filter(self, mock_es):
+        mock_es.settings.asbool.return_value = False
+        view = self._test_view()
+        view._parent_queryset_es = Mock(return_value=None)
+        view._acl_query_filter = Mock(return_value='(owner:bob)')
+        view.Model = Mock(__name__='Foo')
+        view._query_params['q'] = 'name:a OR name:b'
+        view.get_collection_es()
+        mock_es().get_collection.assert_called_once_with(
+            _limit=20, foo='bar', q='(name:a OR name:b) AND ((owner:bob))')
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_get_collection_es_acl_filter_nothing_permitted(self, mock_es):
+        view = self._test_view()
+        view._parent_queryset_es = Mock(return_value=None)
+        view._acl_query_filter = Mock(return_value=False)
+        assert view.get_collection_es() == []
+        assert not mock_es().get_collection.called
+
+    @patch('ramses.indexing.get_partitioned_index')
+    @patch('nefertari.elasticsearch.ES')
+    def test_get_collection_es_partitioned(self, mock_es, mock_get):
+        mock_es.settings.asbool.return_value = False
+        view = self._test_view()
+        view._parent_queryset_es = Mock(return_value=None)
+        view.Model = Mock(__name__='Foo')
+        partitioned = mock_get.return_value
+        partitioned.search_index.return_value = 'foo-2015.01,foo-2015.02'
+        view.get_collection_es()
+        mock_get.assert_called_once_with('Foo')
+        partitioned.search_index.assert_called_once_with(
+            view._query_params)
+        mock_es.assert_called_once_with(
+            'Foo', index_name='foo-2015.01,foo-2015.02')
+        mock_es().get_collection.assert_called_once_with(
+            _limit=20, foo='bar')
+
+    @patch('ramses.indexing.get_partitioned_index')
+    @patch('nefertari.elasticsearch.ES')
+    def test_get_collection_es_no_partitions(self, mock_es, mock_get):
+        view = self._test_view()
+        view._parent_queryset_es = Mock(return_value=None)
+        view.Model = Mock(__name__='Foo')
+        mock_get.return_value.search_index.return_value = None
+        assert view.get_collection_es() == []
+        assert not mock_es().get_collection.called
+
+    def test_acl_query_filter(self):
+        view = self._test_view()
+        view._auth_enabled = True
+        view.request.action = 'delete_many'
+        view._factory = Mock()
+        result = view._acl_query_filter()
+        view._factory().item_query_filter.assert_called_once_with('delete')
+        assert result == view._factory().item_query_filter()
+
+    def _page(self, *ids):
+        from nefertari.elasticsearch import _ESDocs
+        from nefertari.utils import dict2obj
+        page = _ESDocs([dict2obj({'_pk': id_}) for id_ in ids])
+        page._nefertari_meta = {'total': 10}
+        return page
+
+    def test_check_items_acl(self):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from pyramid.security import Allow
+        from ramses.acl import BaseACL, batch_principal
+        calls = []
+
+        @batch_principal
+        def owners(ace, request, objs):
+            calls.append('owners')
+            return [(Allow, 'u:bob', 'view') if obj._pk != '2' else None
+                    for obj in objs]
+
+        def per_item(ace, request, obj):
+            calls.append('per_item')
+
+        class ACL(BaseACL):
+            _collection_acl = ()
+            _item_acl = [(Allow, owners, 'view'), (Allow, per_item, 'view')]
+
+        policy = ACLAuthorizationPolicy()
+        view = self._test_view()
+        view._factory = ACL
+        request = Mock(action='index', _acl_principals_memo=None,
+                       effective_principals=['u:bob'])
+        request.has_permission = lambda perm, ctx: policy.permits(
+            ctx, request.effective_principals, perm)
+
+        result = view.check_items_acl(
+            request=request, result=self._page('1', '2', '3'))
+        assert [doc._pk for doc in result] == ['1', '3']
+        assert result._nefertari_meta == {'total': 10, 'acl_filtered': 1}
+        assert calls.count('owners') == 1
+        assert calls.count('per_item') == 3
+
+    def test_check_items_acl_not_needed(self):
+        view = self._test_view()
+        view._factory = Mock()
+        view._factory().items_need_check.return_value = False
+        page = self._page('1')
+        assert view.check_items_acl(request=Mock(), result=page) is page
+        assert not view._factory().generate_items_acl.called
+        view._factory = Mock(spec=[])
+        assert view.check_items_acl(request=Mock(), result=page) is page
+
+    def test_check_items_acl_wrapper(self):
+        view = self._test_view()
+        assert view.check_items_acl not in view._after_calls['index']
+        view._auth_enabled = True
+        view.setup_default_wrappers()
+        assert view.check_items_acl not in view._after_calls['index']
+        view._check_items_acl = True
+        view.setup_default_wrappers()
+        assert view._after_calls['index'][0] == view.check_items_acl
+
+    def test_acl_query_filter_auth_disabled(self):
+        view = self._test_view()
+        view._auth_enabled = False
+        view._factory = Mock()
+        assert view._acl_query_filter() is None
+        assert not view._factory.called
+
     def test_get_item_es_no_parent(self):
         view = self._test_view()
         view._get_context_key = Mock(return_value=1)
@@ -413,6 +778,58 @@ class TestESBaseView(ViewTestBase):
         assert resp == view.context
 
 
+class TestIndexACLFilterViewMixin(ViewTestBase):
+    from nefertari_guards.view import ACLFilterViewMixin
+
+    class view_cls(views.ESBaseView, views.IndexACLFilterViewMixin,
+                   ACLFilterViewMixin):
+        pass
+
+    @patch('nefertari_guards.engine.ACLField', create=True)
+    @patch('ramses.indexing.get_partitioned_index')
+    def test_partitioned_collection_acl_filtered(self, mock_get, mock_field):
+        from nefertari.elasticsearch import ES
+        from nefertari_guards.base import ACLEncoderMixin
+        mock_field.stringify_acl = ACLEncoderMixin.stringify_acl
+        mock_field._stringify_action = ACLEncoderMixin._stringify_action
+        from nefertari.utils import dictset
+        view = self._test_view()
+        view._parent_queryset_es = Mock(return_value=None)
+        view._acl_query_filter = Mock(return_value=None)
+        view.Model = Mock(__name__='Story')
+        view.request.action = 'index'
+        view.request.registry.settings = {'auth': 'true'}
+        view.request.effective_principals = ['system.Everyone', 'g:editor']
+        mock_get.return_value.search_index.return_value = 'story-2015.01'
+        api = Mock()
+        api.search.return_value = {'took': 1, 'hits': {'total': 1, 'hits': [
+            {'_source': {'_pk': '1'}, '_score': 1, '_type': 'Story'}]}}
+        settings = dictset(index_name='foo', chunk_size=500)
+        with patch.object(ES, 'api', api):
+            with patch.object(ES, 'settings', settings):
+                documents = view.get_collection_es()
+
+        assert [doc._pk for doc in documents] == ['1']
+        search = api.search.call_args[1]
+        assert search['index'] == 'story-2015.01'
+        query = search['body']['query']['bool']
+        allowed = query['must'][0]['nested']['filter']['bool']['must']
+        assert {'terms': {'_acl.principal': [
+            'everyone', 'g:editor']}} in allowed
+        denied = query['must_not']['nested']['filter']['bool']['must']
+        assert {'term': {'_acl.action': 'deny'}} in denied
+
+    @patch('nefertari_guards.elasticsearch.ACLFilterES')
+    def test_get_collection_es(self, mock_es):
+        view = self._test_view()
+        view.Model = Mock(__name__='Story')
+        mixin = views.IndexACLFilterViewMixin
+        mixin.get_collection_es(view, index_name='story-2015.01')
+        mock_es.assert_called_once_with('Story', index_name='story-2015.01')
+        mock_es().get_collection.assert_called_once_with(
+            request=view.request, _limit=20, foo='bar')
+
+
 class TestESCollectionView(ViewTestBase):
     view_cls = views.ESCollectionView
 
@@ -681,6 +1098,43 @@ class TestRestViewGeneration(object):
         assert issubclass(view_cls, views.CollectionView)
         assert view_cls.Model == 'foo'
 
+    def test_etag_option(self):
+        config = config_mock()
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'])
+        assert not issubclass(view_cls, views.ConditionalResponseMixin)
+        config.registry.settings = {'etag.enable': 'true'}
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'])
+        assert issubclass(view_cls, views.ConditionalResponseMixin)
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'], singular=True)
+        assert not issubclass(view_cls, views.ConditionalResponseMixin)
+
+    def test_check_items_option(self):
+        config = config_mock()
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'])
+        assert not view_cls._check_items_acl
+        config.registry.settings = {'acl.check_items': 'true'}
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'])
+        assert view_cls._check_items_acl
+
+    def test_cache_option(self):
+        config = config_mock()
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'])
+        assert not issubclass(view_cls, views.CacheViewMixin)
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'], cache='bar')
+        assert issubclass(view_cls, views.CacheViewMixin)
+        assert view_cls._cache == 'bar'
+        view_cls = views.generate_rest_view(
+            config, model_cls='foo', attrs=['show'], cache='bar',
+            es_based=False)
+        assert not issubclass(view_cls, views.CacheViewMixin)
+
     def test_database_acls_option(self):
         from nefertari_guards.view import ACLFilterViewMixin
         config = config_mock()
@@ -700,3 +1154,6 @@ class TestRestViewGeneration(object):
             es_based=False, attr_view=False, singular=False)
         assert issubclass(view_cls, views.SetObjectACLMixin)
         assert issubclass(view_cls, ACLFilterViewMixin)
+        mro = view_cls.__mro__
+        assert mro.index(views.IndexACLFilterViewMixin) < mro.index(
+            ACLFilterViewMixin)